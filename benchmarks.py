@@ -0,0 +1,453 @@
+import numpy as np
+
+import json
+import platform
+from time import perf_counter, strftime
+from typing import Union
+
+from numba import config, get_num_threads, set_num_threads
+import numba
+
+from hestonmc import HestonParameters, MarketState, RunningStats, heston_price_cos, mc_price, normal_quantile, simulate_heston_euler, simulate_heston_andersen_qe, simulate_heston_andersen_tg, tg_lookup_tables
+from derivatives import european_call_payoff, evaluate_payoffs
+
+# Parameter sets of the evaluation (see presentation/part4)
+PARAMETER_SETS = [HestonParameters(kappa = 1.3125, gamma = 0.5125, rho = -0.3937, vbar = 0.0641, v0 = 0.3),
+                  HestonParameters(kappa = 1.,     gamma = 0.4,    rho = -0.1,    vbar = 0.2,    v0 = 0.2),
+                  HestonParameters(kappa = 0.5,    gamma = 1.,     rho = -0.9,    vbar = 0.04,   v0 = 0.04),
+                  HestonParameters(kappa = 0.3,    gamma = 0.9,    rho = -0.5,    vbar = 0.04,   v0 = 0.04),
+                  HestonParameters(kappa = 1.,     gamma = 1.,     rho = -0.3,    vbar = 0.04,   v0 = 0.09)]
+
+def _best_time(f, repeats: int) -> float:
+    f()
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        f()
+        times.append(perf_counter() - start)
+    return min(times)
+
+def benchmark_kernel_layout(heston_params: HestonParameters,
+                            state:         MarketState = MarketState(100., 0.),
+                            T:             float = 1.,
+                            N_T:           int   = 100,
+                            n_simulations: int   = 10_000,
+                            block_sizes:   tuple = (16, 32, 64, 128),
+                            repeats:       int   = 7,
+                            random_seed:   int   = 42) -> dict:
+    """Time the path-by-path and the time-major (block_size > 0) QE and TG kernels on the same normals.
+    Args:
+        heston_params (HestonParameters): Heston parameters.
+        state (MarketState, optional):    Market state. Defaults to MarketState(100., 0.).
+        T (float, optional):              Contract expiration T. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations per call. Defaults to 10_000.
+        block_sizes (tuple, optional):    Block sizes of the time-major kernel. Defaults to (16, 32, 64, 128).
+        repeats (int, optional):          Number of timed calls; the best one is reported. Defaults to 7.
+        random_seed (int, optional):      Seed of the normals. Defaults to 42.
+    Raises:
+        AssertionError: The kernels do not produce the same paths.
+    Returns:
+        A dict {engine name: {block size: seconds per call}} where block size 0 is the path-by-path kernel.
+    """
+    Z       = np.random.default_rng(random_seed).standard_normal((2, n_simulations, N_T))
+    engines = [(simulate_heston_andersen_qe, {}), (simulate_heston_andersen_tg, tg_lookup_tables())]
+    results = {}
+
+    for simulate, kwargs in engines:
+        args      = {'state': state, 'heston_params': heston_params, 'T': T, 'N_T': N_T, 'n_simulations': n_simulations, 'normals': Z, **kwargs}
+        reference = simulate(**args)
+        timings   = {}
+
+        for block_size in (0,) + tuple(block_sizes):
+            if block_size > 0:
+                S, V = simulate(**args, block_size = block_size)
+                assert np.array_equal(S, reference[0]) and np.array_equal(V, reference[1]), "The kernels diverge."
+            timings[block_size] = _best_time(lambda: simulate(**args, block_size = block_size), repeats)
+
+        results[simulate.__name__] = timings
+
+    return results
+
+def float32_regression(parameter_sets:  list  = PARAMETER_SETS,
+                       strikes:         tuple = (70., 100., 120.),
+                       maturities:      tuple = (0.1, 1., 5.),
+                       state:           MarketState = MarketState(100., 0.),
+                       N_T:             int   = 50,
+                       batch_size:      int   = 10_000,
+                       n_batches:       int   = 5,
+                       absolute_error:  float = 0.01,
+                       tolerance:       float = 0.1,
+                       random_seed:     int   = 42) -> list:
+    """Compare single- and double-precision prices of European calls on the evaluation grid (Data/evaluation).
+    Both precisions are driven by the same counter-based normals, so the difference of the prices is the effect of
+    the rounding alone and not Monte-Carlo noise.
+    Args:
+        parameter_sets (list, optional):  Heston parameters. Defaults to PARAMETER_SETS.
+        strikes (tuple, optional):        Strikes. Defaults to (70., 100., 120.).
+        maturities (tuple, optional):     Maturities. Defaults to (0.1, 1., 5.).
+        state (MarketState, optional):    Market state. Defaults to MarketState(100., 0.).
+        N_T (int, optional):              Number of steps in time. Defaults to 50.
+        batch_size (int, optional):       Path-batch size. Defaults to 10_000.
+        n_batches (int, optional):        Number of batches per price. Defaults to 5.
+        absolute_error (float, optional): Target absolute error of the prices. Defaults to 0.01.
+        tolerance (float, optional):      Largest admissible difference as a share of absolute_error. Defaults to 0.1.
+        random_seed (int, optional):      Key of the counter-based generator. Defaults to 42.
+    Returns:
+        A list of dicts with the scheme, the parameter set number, the strike, the maturity, both prices, their 
+        difference and whether it is within tolerance*absolute_error.
+    """
+    engines = [(simulate_heston_euler, {}), (simulate_heston_andersen_qe, {}), (simulate_heston_andersen_tg, tg_lookup_tables())]
+    results = []
+
+    for simulate, kwargs in engines:
+        for number, heston_params in enumerate(parameter_sets, 1):
+            for T in maturities:
+                # the engines stop one step short of T (see control_variate_mean)
+                payoffs = [european_call_payoff(T*(N_T - 1)/N_T, K, state.interest_rate) for K in strikes]
+                prices  = {}
+                for dtype in (np.float64, np.float32):
+                    stats = RunningStats()
+                    for b in range(n_batches):
+                        S = simulate(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = batch_size,
+                                     seed = random_seed, path_offset = b*batch_size, dtype = dtype, **kwargs)[0]
+                        stats.update(evaluate_payoffs(payoffs, S))
+                    prices[dtype] = stats.mean
+
+                for k, K in enumerate(strikes):
+                    difference = prices[np.float32][k] - prices[np.float64][k]
+                    results.append({'scheme':         simulate.__name__,
+                                    'heston_params#': number,
+                                    'strike':         K,
+                                    'T':              T,
+                                    'float64':        prices[np.float64][k],
+                                    'float32':        prices[np.float32][k],
+                                    'difference':     difference,
+                                    'passed':         abs(difference) <= tolerance*absolute_error})
+
+    return results
+
+SUITE_ENGINES = {'euler': (simulate_heston_euler, None), 'qe': (simulate_heston_andersen_qe, None), 'tg': (simulate_heston_andersen_tg, tg_lookup_tables)}
+
+def _memory_kib(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise OSError(f"No {field} in /proc/self/status.")
+
+def _reset_peak_memory() -> bool:
+    # writing 5 to clear_refs resets the high-water mark of the resident set (Linux 4.0+), so that the peak of a
+    # single case can be measured; ru_maxrss cannot be reset and only bounds the peak of the whole process
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+def _case_key(row: dict) -> str:
+    batch_size = "auto" if row['batch_size'] is None else row['batch_size']
+    return f"{row['scheme']}/N_T={row['N_T']}/batch_size={batch_size}/threads={row['threads']}/#{row['heston_params#']}"
+
+def benchmark_suite(schemes:          tuple = ("euler", "qe", "tg"),
+                    N_Ts:             tuple = (50, 100),
+                    batch_sizes:      tuple = (None, 10_000),
+                    threads:          tuple = None,
+                    parameter_sets:   Union[list, dict] = PARAMETER_SETS,
+                    state:            MarketState = MarketState(100., 0.),
+                    strike:           float = 100.,
+                    T:                float = 1.,
+                    absolute_error:   float = 0.05,
+                    confidence_level: float = 0.05,
+                    repeats:          int   = 3,
+                    random_seed:      int   = 42,
+                    verbose:          bool  = False) -> dict:
+    """Throughput, time to tolerance, peak memory and bias of mc_price on scheme x N_T x batch size x threads x
+    parameter set for an at-the-money European call, the setting of the grid tests in Data/evaluation.
+
+    Every case prices the call with the counter-based generator and a fixed key, so the price, the number of paths
+    and hence the bias are reproducible and independent of the number of threads; only the timings vary between runs.
+    The engines are compiled before the first case and the best of `repeats` runs is timed. The bias is measured
+    against the COS price at the horizon of the engines, T(N_T - 1)/N_T (see control_variate_mean), so it is the
+    discretization bias of the scheme plus Monte-Carlo noise of the order of the confidence interval.
+    Args:
+        schemes (tuple, optional):          Keys of SUITE_ENGINES. Defaults to ("euler", "qe", "tg").
+        N_Ts (tuple, optional):             Numbers of steps in time. Defaults to (50, 100).
+        batch_sizes (tuple, optional):      Path-batch sizes of mc_price, None for the calibrated one. Defaults to (None, 10_000).
+        threads (tuple, optional):          Numbers of Numba threads. Defaults to None (1 and all available).
+        parameter_sets (list, optional):    Heston parameters, numbered from 1, or a dict {number: HestonParameters}.
+                                            Defaults to PARAMETER_SETS.
+        state (MarketState, optional):      Market state. Defaults to MarketState(100., 0.).
+        strike (float, optional):           Strike of the call. Defaults to 100..
+        T (float, optional):                Contract expiration T. Defaults to 1..
+        absolute_error (float, optional):   Target absolute error of the prices. Defaults to 0.05.
+        confidence_level (float, optional): Confidence level of the prices. Defaults to 0.05.
+        repeats (int, optional):            Number of timed runs per case; the best one is reported. Defaults to 3.
+        random_seed (int, optional):        Key of the counter-based generator. Defaults to 42.
+        verbose (bool, optional):           Verbose flag. If true, every case is printed when done. Defaults to False.
+    Returns:
+        A dict with the machine description ('meta') and one dict per case ('results') with the scheme, N_T, the batch
+        size, the number of threads, the parameter set number, the price, the reference price, the bias, the length of
+        the confidence interval, the number of paths, the time to tolerance in seconds, paths per second and the peak
+        resident memory of the case in MiB (None where it cannot be measured).
+    """
+    if threads is None:
+        threads = tuple(sorted({1, config.NUMBA_NUM_THREADS}))
+    if not isinstance(parameter_sets, dict):
+        parameter_sets = dict(enumerate(parameter_sets, 1))
+    initial_threads = get_num_threads()
+    horizon         = lambda N_T: T*(N_T - 1)/N_T
+    C               = -2*normal_quantile(confidence_level*0.5)
+    engines         = {name: (SUITE_ENGINES[name][0], SUITE_ENGINES[name][1]() if SUITE_ENGINES[name][1] is not None else {}) for name in schemes}
+
+    # compile the engines and the payoff kernel for the arguments mc_price passes
+    for simulate, kwargs in engines.values():
+        S = simulate(state = state, heston_params = next(iter(parameter_sets.values())), T = T, N_T = min(N_Ts), n_simulations = 16,
+                     seed = random_seed, path_offset = 0, **kwargs)[0]
+        european_call_payoff(horizon(min(N_Ts)), strike, state.interest_rate)(S)
+
+    meta = {'date':             strftime("%Y-%m-%dT%H:%M:%S"),
+            'machine':          platform.machine(),
+            'processor':        platform.processor(),
+            'system':           platform.platform(),
+            'python':           platform.python_version(),
+            'numpy':            np.__version__,
+            'numba':            numba.__version__,
+            'numba_threads':    config.NUMBA_NUM_THREADS,
+            'absolute_error':   absolute_error,
+            'confidence_level': confidence_level,
+            'strike':           strike,
+            'T':                T,
+            'random_seed':      random_seed}
+    results = []
+
+    try:
+        for name, (simulate, kwargs) in engines.items():
+            for N_T in N_Ts:
+                payoff     = european_call_payoff(horizon(N_T), strike, state.interest_rate)
+                references = {number: float(heston_price_cos(state, heston_params, [strike], [horizon(N_T)])[0, 0]) for number, heston_params in parameter_sets.items()}
+
+                for batch_size in batch_sizes:
+                    for n_threads in threads:
+                        set_num_threads(n_threads)
+                        for number, heston_params in parameter_sets.items():
+                            times   = []
+                            tracked = _reset_peak_memory()
+                            before  = _memory_kib("VmRSS") if tracked else None
+                            for _ in range(repeats):
+                                start = perf_counter()
+                                price, stats, _ = mc_price(payoff, simulate, state, heston_params, T = T, N_T = N_T,
+                                                           absolute_error = absolute_error, confidence_level = confidence_level, batch_size = batch_size,
+                                                           random_seed = random_seed, counter_rng = True, full_output = True, **kwargs)
+                                times.append(perf_counter() - start)
+                                if len(times) == 1 and tracked:
+                                    peak = (_memory_kib("VmHWM") - before) / 1024.
+
+                            row = {'scheme':            simulate.__name__,
+                                   'N_T':               N_T,
+                                   'batch_size':        batch_size,
+                                   'threads':           n_threads,
+                                   'heston_params#':    number,
+                                   'price':             float(price),
+                                   'reference':         references[number],
+                                   'bias':              float(price) - references[number],
+                                   'ci_length':         float(stats.ci_length(C)),
+                                   'paths':             int(stats.count),
+                                   'time_to_tolerance': min(times),
+                                   'paths_per_second':  int(stats.count) / min(times),
+                                   'peak_memory_mb':    max(peak, 0.) if tracked else None}
+                            results.append(row)
+                            if verbose:
+                                print(f"{_case_key(row):<72} {row['time_to_tolerance']:>8.3f} s {row['paths_per_second']:>12.4g} paths/s "
+                                      f"bias {row['bias']:>+9.4f} (ci {row['ci_length']:.4f})")
+    finally:
+        set_num_threads(initial_threads)
+
+    return {'meta': meta, 'results': results}
+
+def compare_to_baseline(current:       dict,
+                        baseline:      dict,
+                        slowdown:      float = 0.1,
+                        memory_growth: float = 0.2,
+                        memory_floor:  float = 8.) -> list:
+    """Regressions of a benchmark_suite run against a stored one. Cases are matched by scheme, N_T, batch size,
+    threads and parameter set; cases missing from either run are skipped.
+
+    A case regresses if its time to tolerance grows or its throughput drops by more than `slowdown`, if its peak
+    memory grows by more than `memory_growth` and `memory_floor` MiB, or if its absolute bias grows by more than the
+    target absolute error of the baseline: the prices are computed on the same counter-based paths, so a bias that
+    moves by more than the Monte-Carlo error comes from a change of the scheme or of mc_price.
+    Args:
+        current (dict):                  Result of benchmark_suite.
+        baseline (dict):                 Stored result of benchmark_suite.
+        slowdown (float, optional):      Admissible relative slowdown. Defaults to 0.1.
+        memory_growth (float, optional): Admissible relative growth of the peak memory. Defaults to 0.2.
+        memory_floor (float, optional):  Admissible absolute growth of the peak memory in MiB. Defaults to 8..
+    Returns:
+        A list of dicts with the case, the metric, the baseline and the current value; empty if nothing regressed.
+    """
+    previous    = {_case_key(row): row for row in baseline['results']}
+    tolerance   = baseline['meta']['absolute_error']
+    regressions = []
+
+    for row in current['results']:
+        key = _case_key(row)
+        if key not in previous:
+            continue
+        old    = previous[key]
+        checks = [('time_to_tolerance', row['time_to_tolerance'] > (1. + slowdown)*old['time_to_tolerance']),
+                  ('paths_per_second',  row['paths_per_second'] < (1. - slowdown)*old['paths_per_second']),
+                  ('bias',              abs(row['bias']) > abs(old['bias']) + tolerance)]
+        if row['peak_memory_mb'] is not None and old['peak_memory_mb'] is not None:
+            checks.append(('peak_memory_mb', row['peak_memory_mb'] > (1. + memory_growth)*old['peak_memory_mb'] + memory_floor))
+
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append({'case': key, 'metric': metric, 'baseline': old[metric], 'current': row[metric]})
+
+    return regressions
+
+def benchmark_service(n_requests:       int   = 500,
+                      rate:             float = 100.,
+                      schemes:          tuple = ("qe",),
+                      N_T:              int   = 50,
+                      parameter_sets:   Union[list, dict] = PARAMETER_SETS,
+                      state:            MarketState = MarketState(100., 0.),
+                      strikes:          tuple = (80., 90., 100., 110., 120.),
+                      T:                float = 1.,
+                      absolute_error:   float = 0.05,
+                      deadline:         float = 1.,
+                      coalesce:         bool  = True,
+                      max_workers:      int   = 1,
+                      random_seed:      int   = 42) -> dict:
+    """Local load generator of the pricing service: n_requests with Poisson arrivals at `rate` per second, each for
+    a European or an arithmetic Asian call on a random strike, scheme and parameter set, with a latency budget of 
+    `deadline` seconds. Every tenth request has priority 1. The engines are compiled before the clock starts.
+    Returns:
+        A dict with the latency percentiles 'p50' and 'p99' and the 'mean' latency in seconds, the share of requests
+        that met their target ('converged'), the mean number of requests per batch ('shared'), the requests per
+        second served, the service counters and the settings.
+    """
+    import asyncio
+    from pricingservice import PricingService
+    from derivatives import european_call_streaming_payoff, asian_call_AM_streaming_payoff
+
+    if not isinstance(parameter_sets, dict):
+        parameter_sets = dict(enumerate(parameter_sets, 1))
+    rng = np.random.default_rng(random_seed)
+
+    async def run():
+        async with PricingService(max_workers=max_workers, random_seed=random_seed, coalesce=coalesce) as service:
+            for scheme in schemes:
+                await service.price(european_call_streaming_payoff(T, 100.), scheme, state, parameter_sets[min(parameter_sets)],
+                                    N_T=N_T, absolute_error=np.inf)
+
+            async def client(delay, payoff, scheme, heston_params, priority):
+                await asyncio.sleep(delay)
+                return await service.price(payoff, scheme, state, heston_params, N_T=N_T, absolute_error=absolute_error,
+                                           priority=priority, deadline=deadline)
+
+            arrivals = np.cumsum(rng.exponential(1./rate, n_requests))
+            clients  = []
+            for i, delay in enumerate(arrivals):
+                make_payoff = european_call_streaming_payoff if rng.random() < 0.5 else asian_call_AM_streaming_payoff
+                clients.append(client(delay, make_payoff(T, float(rng.choice(strikes))), str(rng.choice(schemes)),
+                                      parameter_sets[int(rng.choice(list(parameter_sets)))], int(i % 10 == 0)))
+            service.counters = dict.fromkeys(service.counters, 0)
+            start   = perf_counter()
+            replies = await asyncio.gather(*clients)
+            return replies, perf_counter() - start, dict(service.counters)
+
+    replies, seconds, counters = asyncio.run(run())
+    latencies = np.array([reply['latency'] for reply in replies])
+    return {'p50':                 float(np.percentile(latencies, 50)),
+            'p99':                 float(np.percentile(latencies, 99)),
+            'mean':                float(latencies.mean()),
+            'converged':           float(np.mean([reply['converged'] for reply in replies])),
+            'shared':              float(np.mean([reply['shared'] for reply in replies])),
+            'requests_per_second': n_requests / seconds,
+            'counters':            counters,
+            'settings':            {'n_requests': n_requests, 'rate': rate, 'schemes': list(schemes), 'N_T': N_T,
+                                    'absolute_error': absolute_error, 'deadline': deadline, 'coalesce': coalesce,
+                                    'max_workers': max_workers, 'numba_threads': get_num_threads()}}
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks and regression checks of the simulation engines.")
+    parser.add_argument("benchmark", choices=["layout", "float32", "suite", "service"])
+    parser.add_argument("--schemes", nargs="+", default=["euler", "qe", "tg"], choices=list(SUITE_ENGINES), help="Schemes of the suite.")
+    parser.add_argument("--N_T", nargs="+", type=int, default=[50, 100], help="Numbers of steps in time of the suite.")
+    parser.add_argument("--batch-sizes", nargs="+", default=["auto", "10000"], help="Batch sizes of the suite, 'auto' for the calibrated one.")
+    parser.add_argument("--threads", nargs="+", type=int, default=None, help="Numbers of Numba threads of the suite. Defaults to 1 and all.")
+    parser.add_argument("--parameter-sets", nargs="+", type=int, default=list(range(1, len(PARAMETER_SETS) + 1)), help="Parameter set numbers of the suite.")
+    parser.add_argument("--absolute-error", type=float, default=0.05, help="Target absolute error of the suite.")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per case of the suite.")
+    parser.add_argument("--output", default=None, help="Write the results of the suite to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="Compare the suite with this stored JSON result; exit with 1 on a regression.")
+    parser.add_argument("--slowdown", type=float, default=0.1, help="Admissible relative slowdown against the baseline.")
+    parser.add_argument("--requests", type=int, default=500, help="Number of requests of the service load test.")
+    parser.add_argument("--rate", type=float, default=100., help="Arrival rate (requests per second) of the service load test.")
+    parser.add_argument("--deadline", type=float, default=1., help="Latency budget in seconds of the service requests.")
+    parser.add_argument("--workers", type=int, default=1, help="Executor workers of the pricing service.")
+    cli = parser.parse_args()
+
+    if cli.benchmark == "layout":
+        for number, heston_params in enumerate(PARAMETER_SETS, 1):
+            print(f"Parameter set #{number}")
+            for name, timings in benchmark_kernel_layout(heston_params).items():
+                print(f"  {name}")
+                for block_size, seconds in timings.items():
+                    label = "path-by-path" if block_size == 0 else f"block_size = {block_size}"
+                    print(f"    {label:<20} {seconds*1e3:8.1f} ms   x{timings[0]/seconds:.2f}")
+
+    elif cli.benchmark == "float32":
+        results = float32_regression()
+        print(f"{'scheme':<30} {'#':>2} {'strike':>7} {'T':>5} {'float64':>12} {'float32':>12} {'difference':>12}")
+        for row in results:
+            print(f"{row['scheme']:<30} {row['heston_params#']:>2} {row['strike']:>7.1f} {row['T']:>5.2f} {row['float64']:>12.6f} {row['float32']:>12.6f} {row['difference']:>12.2e}{'' if row['passed'] else '  FAILED'}")
+        failed = sum(not row['passed'] for row in results)
+        print(f"\n{len(results) - failed}/{len(results)} prices within tolerance")
+        exit(1 if failed else 0)
+
+    elif cli.benchmark == "suite":
+        run = benchmark_suite(schemes        = tuple(cli.schemes),
+                              N_Ts           = tuple(cli.N_T),
+                              batch_sizes    = tuple(None if size == "auto" else int(size) for size in cli.batch_sizes),
+                              threads        = tuple(cli.threads) if cli.threads is not None else None,
+                              parameter_sets = {number: PARAMETER_SETS[number - 1] for number in cli.parameter_sets},
+                              absolute_error = cli.absolute_error,
+                              repeats        = cli.repeats,
+                              verbose        = True)
+        if cli.output is not None:
+            with open(cli.output, "w") as output:
+                json.dump(run, output, indent=1)
+
+        if cli.baseline is not None:
+            with open(cli.baseline) as baseline:
+                regressions = compare_to_baseline(run, json.load(baseline), slowdown = cli.slowdown)
+            for regression in regressions:
+                print(f"REGRESSION {regression['case']}: {regression['metric']} {regression['baseline']:.6g} -> {regression['current']:.6g}")
+            print(f"\n{len(regressions)} regressions against {cli.baseline}")
+            exit(1 if regressions else 0)
+
+    elif cli.benchmark == "service":
+        print(f"{'coalescing':<12} {'p50':>8} {'p99':>8} {'mean':>8} {'req/s':>8} {'converged':>10} {'shared':>7} {'batches':>8}")
+        results = []
+        for coalesce in (True, False):
+            result = benchmark_service(n_requests     = cli.requests,
+                                       rate           = cli.rate,
+                                       schemes        = tuple(cli.schemes),
+                                       N_T            = cli.N_T[0],
+                                       parameter_sets = {number: PARAMETER_SETS[number - 1] for number in cli.parameter_sets},
+                                       absolute_error = cli.absolute_error,
+                                       deadline       = cli.deadline,
+                                       coalesce       = coalesce,
+                                       max_workers    = cli.workers)
+            print(f"{'on' if coalesce else 'off':<12} {result['p50']*1e3:>6.0f}ms {result['p99']*1e3:>6.0f}ms {result['mean']*1e3:>6.0f}ms "
+                  f"{result['requests_per_second']:>8.1f} {result['converged']:>10.1%} {result['shared']:>7.2f} {result['counters']['batches']:>8}")
+            results.append(result)
+        if cli.output is not None:
+            with open(cli.output, "w") as output:
+                json.dump(results, output, indent=1)
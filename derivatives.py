@@ -1,80 +1,432 @@
 import numpy as np
-from numba import njit
+from math import exp, log
+from numba import njit, prange
 
 if __name__ == '__main__':
     print("This is a module. Please import it.\n")
     exit(-1)
 
+# Column layout of the per-path accumulator matrix returned by the streaming engines.
+# Averages are taken over the same N_T grid points the full-path payoffs sum over. The minimum and the maximum are
+# taken over the grid points or, if the engine runs with bridge=True, over the Brownian bridges between them.
+ACC_TERMINAL    = 0
+ACC_AVERAGE     = 1
+ACC_LOG_AVERAGE = 2
+ACC_MIN         = 3
+ACC_MAX         = 4
+N_ACC           = 5
+
+# Payoff type codes understood by the payoff kernels.
+EUROPEAN_CALL = 0
+EUROPEAN_PUT  = 1
+ASIAN_CALL_AM = 2
+ASIAN_PUT_AM  = 3
+ASIAN_CALL_GM = 4
+ASIAN_PUT_GM  = 5
+DIGITAL_CALL  = 6
+DIGITAL_PUT   = 7
+DISCOUNTED_STOCK = 8
+# barrier options: bit 0 of code - UP_AND_OUT_CALL is knock-in, bit 1 a down barrier and bit 2 a put
+UP_AND_OUT_CALL   = 9
+UP_AND_IN_CALL    = 10
+DOWN_AND_OUT_CALL = 11
+DOWN_AND_IN_CALL  = 12
+UP_AND_OUT_PUT    = 13
+UP_AND_IN_PUT     = 14
+DOWN_AND_OUT_PUT  = 15
+DOWN_AND_IN_PUT   = 16
+# lookback options on the running minimum or maximum, with a floating (the extremum) or a fixed strike
+LOOKBACK_CALL_FLOATING = 17
+LOOKBACK_PUT_FLOATING  = 18
+LOOKBACK_CALL_FIXED    = 19
+LOOKBACK_PUT_FIXED     = 20
+
+PAYOFF_NAMES  = {EUROPEAN_CALL: "european_call",
+                 EUROPEAN_PUT:  "european_put",
+                 ASIAN_CALL_AM: "asian_call_AM",
+                 ASIAN_PUT_AM:  "asian_put_AM",
+                 ASIAN_CALL_GM: "asian_call_GM",
+                 ASIAN_PUT_GM:  "asian_put_GM",
+                 DIGITAL_CALL:  "digital_call",
+                 DIGITAL_PUT:   "digital_put",
+                 DISCOUNTED_STOCK: "discounted_stock",
+                 UP_AND_OUT_CALL:   "up_and_out_call",
+                 UP_AND_IN_CALL:    "up_and_in_call",
+                 DOWN_AND_OUT_CALL: "down_and_out_call",
+                 DOWN_AND_IN_CALL:  "down_and_in_call",
+                 UP_AND_OUT_PUT:    "up_and_out_put",
+                 UP_AND_IN_PUT:     "up_and_in_put",
+                 DOWN_AND_OUT_PUT:  "down_and_out_put",
+                 DOWN_AND_IN_PUT:   "down_and_in_put",
+                 LOOKBACK_CALL_FLOATING: "lookback_call_floating",
+                 LOOKBACK_PUT_FLOATING:  "lookback_put_floating",
+                 LOOKBACK_CALL_FIXED:    "lookback_call_fixed",
+                 LOOKBACK_PUT_FIXED:     "lookback_put_fixed"}
+
+# Payoffs that depend on the terminal stock price only, and those among them that are Lipschitz (pathwise Greeks apply).
+TERMINAL_CODES = (EUROPEAN_CALL, EUROPEAN_PUT, DIGITAL_CALL, DIGITAL_PUT, DISCOUNTED_STOCK)
+LIPSCHITZ_CODES = (EUROPEAN_CALL, EUROPEAN_PUT, DISCOUNTED_STOCK)
+
+# Layout of the payoff parameter vector.
+PARAM_MATURITY      = 0
+PARAM_STRIKE        = 1
+PARAM_INTEREST_RATE = 2
+PARAM_BARRIER       = 3
+N_PARAMS            = 4
+
+@njit(cache=True, nogil=True)
+def _payoff_value(code:        int,
+                  params:      np.ndarray,
+                  terminal:    float,
+                  average:     float,
+                  log_average: float,
+                  minimum:     float,
+                  maximum:     float) -> float:
+    maturity = params[PARAM_MATURITY]
+    strike   = params[PARAM_STRIKE]
+    DF       = exp( - params[PARAM_INTEREST_RATE] * maturity)
+
+    if code == EUROPEAN_CALL:
+        return max(terminal - strike, 0.)*DF
+    if code == EUROPEAN_PUT:
+        return max(strike - terminal, 0.)*DF
+    if code == ASIAN_CALL_AM:
+        return max(average*maturity - strike, 0.)*DF
+    if code == ASIAN_PUT_AM:
+        return max(strike - average*maturity, 0.)*DF
+    if code == ASIAN_CALL_GM:
+        return max(exp(log_average*maturity) - strike, 0.)*DF
+    if code == ASIAN_PUT_GM:
+        return max(strike - exp(log_average*maturity), 0.)*DF
+    if code == DIGITAL_CALL:
+        return DF if terminal > strike else 0.
+    if code == DIGITAL_PUT:
+        return DF if terminal < strike else 0.
+    if code == DISCOUNTED_STOCK:
+        return terminal*DF
+    if code >= UP_AND_OUT_CALL and code <= DOWN_AND_IN_PUT:
+        flags   = code - UP_AND_OUT_CALL
+        barrier = params[PARAM_BARRIER]
+        hit     = minimum <= barrier if flags & 2 else maximum >= barrier
+        vanilla = max(strike - terminal, 0.) if flags & 4 else max(terminal - strike, 0.)
+        return vanilla*DF if hit == (flags & 1 == 1) else 0.
+    if code == LOOKBACK_CALL_FLOATING:
+        return (terminal - minimum)*DF
+    if code == LOOKBACK_PUT_FLOATING:
+        return (maximum - terminal)*DF
+    if code == LOOKBACK_CALL_FIXED:
+        return max(maximum - strike, 0.)*DF
+    if code == LOOKBACK_PUT_FIXED:
+        return max(strike - minimum, 0.)*DF
+    return np.nan
+
+@njit(cache=True, nogil=True)
+def _terminal_payoff_derivative(code:     int,
+                                params:   np.ndarray,
+                                terminal: float) -> float:
+    DF = exp( - params[PARAM_INTEREST_RATE] * params[PARAM_MATURITY])
+
+    if code == EUROPEAN_CALL:
+        return DF if terminal > params[PARAM_STRIKE] else 0.
+    if code == EUROPEAN_PUT:
+        return -DF if terminal < params[PARAM_STRIKE] else 0.
+    if code == DISCOUNTED_STOCK:
+        return DF
+    return 0.
+
+@njit(parallel=True, cache=True, nogil=True)
+def _evaluate_payoffs(codes:  np.ndarray,
+                      params: np.ndarray,
+                      S:      np.ndarray) -> np.ndarray:
+    n_paths, N_T = S.shape
+    n_payoffs    = codes.shape[0]
+    out          = np.empty((n_payoffs, n_paths))
+
+    need_log = False
+    for q in range(n_payoffs):
+        if codes[q] == ASIAN_CALL_GM or codes[q] == ASIAN_PUT_GM:
+            need_log = True
+
+    for p in prange(n_paths):
+        # single-precision paths are read as they are and accumulated in double precision
+        total, log_total = 0., 0.
+        minimum, maximum = S[p, 0], S[p, 0]
+        for i in range(N_T):
+            total  += S[p, i]
+            minimum = min(minimum, S[p, i])
+            maximum = max(maximum, S[p, i])
+            if need_log:
+                log_total += log(S[p, i])
+
+        for q in range(n_payoffs):
+            out[q, p] = _payoff_value(codes[q], params[q], S[p, N_T-1], total/N_T, log_total/N_T, minimum, maximum)
+
+    return out
+
+@njit(parallel=True, cache=True, nogil=True)
+def _evaluate_payoffs_accumulated(codes:  np.ndarray,
+                                  params: np.ndarray,
+                                  A:      np.ndarray) -> np.ndarray:
+    n_paths   = A.shape[0]
+    n_payoffs = codes.shape[0]
+    out       = np.empty((n_payoffs, n_paths))
+
+    for p in prange(n_paths):
+        for q in range(n_payoffs):
+            out[q, p] = _payoff_value(codes[q], params[q], A[p, ACC_TERMINAL], A[p, ACC_AVERAGE], 
+                                      A[p, ACC_LOG_AVERAGE], A[p, ACC_MIN], A[p, ACC_MAX])
+
+    return out
+
+@njit(parallel=True, cache=True, nogil=True)
+def _evaluate_payoffs_scenarios(codes:  np.ndarray,
+                                params: np.ndarray,
+                                A:      np.ndarray) -> np.ndarray:
+    n_scenarios, n_paths = A.shape[0], A.shape[1]
+    out                  = np.empty((n_scenarios, n_paths))
+
+    for q in prange(n_scenarios*n_paths):
+        c, p      = q // n_paths, q % n_paths
+        out[c, p] = _payoff_value(codes[c], params[c], A[c, p, ACC_TERMINAL], A[c, p, ACC_AVERAGE], 
+                                  A[c, p, ACC_LOG_AVERAGE], A[c, p, ACC_MIN], A[c, p, ACC_MAX])
+
+    return out
+
+@njit(parallel=True, cache=True, nogil=True)
+def _evaluate_terminal(code:   int,
+                       params: np.ndarray,
+                       S_T:    np.ndarray):
+    values      = np.empty(S_T.shape[0])
+    derivatives = np.empty(S_T.shape[0])
+
+    for p in prange(S_T.shape[0]):
+        values[p]      = _payoff_value(code, params, S_T[p], S_T[p], log(S_T[p]), S_T[p], S_T[p])
+        derivatives[p] = _terminal_payoff_derivative(code, params, S_T[p])
+
+    return values, derivatives
+
+class Payoff:
+    """A payoff given by a type code and a parameter vector.
+
+    All payoffs share the same precompiled, cache-backed kernels, so a new strike or maturity costs no compilation.
+    A Payoff is called like the old payoff closures: on the stock price matrix S of shape (n_paths, N_T) produced by 
+    the full-path engines or, if streaming is set, on the accumulator matrix produced by the streaming engines.
+    Barrier and lookback payoffs are monitored on the grid of the full-path engines and continuously on the
+    accumulators of the streaming engines run with bridge=True.
+    """
+    def __init__(self,
+                 code:          int,
+                 maturity:      float,
+                 strike:        float,
+                 interest_rate: float = 0.,
+                 streaming:     bool  = False,
+                 barrier:       float = np.nan):
+        if code not in PAYOFF_NAMES:
+            raise ValueError(f"Unknown payoff type code {code}.")
+
+        self.code      = code
+        self.params    = np.array([maturity, strike, interest_rate, barrier], dtype=np.float64)
+        self.streaming = streaming
+        self._codes    = np.array([code], dtype=np.int64)
+
+    @property
+    def __name__(self):
+        return PAYOFF_NAMES[self.code] + ("_streaming" if self.streaming else "")
+
+    @property
+    def maturity(self):
+        return self.params[PARAM_MATURITY]
+
+    @property
+    def strike(self):
+        return self.params[PARAM_STRIKE]
+
+    @property
+    def interest_rate(self):
+        return self.params[PARAM_INTEREST_RATE]
+
+    @property
+    def barrier(self):
+        return self.params[PARAM_BARRIER]
+
+    def __call__(self, S: np.ndarray) -> np.ndarray:
+        if self.streaming:
+            return _evaluate_payoffs_accumulated(self._codes, self.params[None, :], S)[0]
+        return _evaluate_payoffs(self._codes, self.params[None, :], S)[0]
+
+    def __repr__(self):
+        barrier = "" if np.isnan(self.barrier) else f", barrier={self.barrier}"
+        return f"Payoff({self.__name__}, maturity={self.maturity}, strike={self.strike}, interest_rate={self.interest_rate}{barrier})"
+
+def evaluate_terminal(payoff: Payoff,
+                      S_T:    np.ndarray):
+    """Values and derivatives with respect to S_T of a payoff that depends on the terminal stock price only.
+    Args:
+        payoff (Payoff):  Payoff with a code in TERMINAL_CODES.
+        S_T (np.ndarray): Terminal stock prices.
+    Raises:
+        ValueError: The payoff is path-dependent.
+    Returns:
+        A tuple of the payoff values and their derivatives (zero almost everywhere for the digitals).
+    """
+    if payoff.code not in TERMINAL_CODES:
+        raise ValueError(f"{payoff.__name__} is not a function of the terminal stock price.")
+    return _evaluate_terminal(payoff.code, payoff.params, S_T)
+
+def stack_payoffs(payoffs: list):
+    """Stack the type codes and the parameter vectors of several payoffs for the vectorized kernels."""
+    codes  = np.array([payoff.code for payoff in payoffs], dtype=np.int64)
+    params = np.ascontiguousarray(np.stack([payoff.params for payoff in payoffs]))
+    return codes, params
+
+def evaluate_payoffs(payoffs: list,
+                     S:       np.ndarray) -> np.ndarray:
+    """Evaluate several payoffs on the stock price matrix S in one pass over the paths.
+    Args:
+        payoffs (list): Payoffs to evaluate.
+        S (np.ndarray): Stock prices of shape (n_paths, N_T).
+    Returns:
+        The payoff matrix of shape (len(payoffs), n_paths).
+    """
+    return _evaluate_payoffs(*stack_payoffs(payoffs), S)
+
+def evaluate_payoffs_accumulated(payoffs: list,
+                                 A:       np.ndarray) -> np.ndarray:
+    """Evaluate several payoffs on the accumulator matrix A returned by a streaming engine.
+    Args:
+        payoffs (list): Payoffs to evaluate.
+        A (np.ndarray): Accumulators of shape (n_paths, N_ACC).
+    Returns:
+        The payoff matrix of shape (len(payoffs), n_paths).
+    """
+    return _evaluate_payoffs_accumulated(*stack_payoffs(payoffs), A)
+
+def evaluate_payoffs_scenarios(payoffs: list,
+                               A:       np.ndarray) -> np.ndarray:
+    """Evaluate one payoff per scenario on the accumulator tensor A returned by a batched engine.
+    Args:
+        payoffs (list): Payoffs, one per scenario.
+        A (np.ndarray): Accumulators of shape (n_scenarios, n_paths, N_ACC).
+    Returns:
+        The payoff matrix of shape (n_scenarios, n_paths).
+    """
+    return _evaluate_payoffs_scenarios(*stack_payoffs(payoffs), A)
+
 def european_call_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
-
-    @njit(parallel=True, cache=True)
-    def european_call(S: np.ndarray):
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(S[:, -1] - strike, 0.)*DF
-
-    return european_call
+    return Payoff(EUROPEAN_CALL, maturity, strike, interest_rate)
 
 def european_put_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
-
-    @njit(parallel=True, cache=True)
-    def european_put(S: np.ndarray):
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - S[:, -1], 0.)*DF
-
-    return european_put
+    return Payoff(EUROPEAN_PUT, maturity, strike, interest_rate)
 
 def asian_call_AM_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
-
-    @njit(parallel=True, cache=True)
-    def asian_call_AM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.sum(S, axis=1) * dt
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(I - strike, 0.)*DF
-
-    return asian_call_AM
+    return Payoff(ASIAN_CALL_AM, maturity, strike, interest_rate)
 
 def asian_put_AM_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
-
-    @njit(parallel=True, cache=True)
-    def asian_put_AM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.sum(S, axis=1) * dt
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - I, 0.)*DF
-
-    return asian_put_AM
+    return Payoff(ASIAN_PUT_AM, maturity, strike, interest_rate)
 
 def asian_call_GM_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
+    return Payoff(ASIAN_CALL_GM, maturity, strike, interest_rate)
+
+def asian_put_GM_payoff(maturity: float,
+                        strike: float,
+                        interest_rate: float = 0.):
+    return Payoff(ASIAN_PUT_GM, maturity, strike, interest_rate)
 
-    @njit(parallel=True, cache=True)
-    def asian_call_GM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.exp(np.sum(np.log(S), axis=1) * dt)
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(I - strike, 0.)*DF
+def european_call_streaming_payoff(maturity: float,
+                                   strike: float,
+                                   interest_rate: float = 0.):
+    return Payoff(EUROPEAN_CALL, maturity, strike, interest_rate, streaming=True)
 
-    return asian_call_GM
+def european_put_streaming_payoff(maturity: float,
+                                  strike: float,
+                                  interest_rate: float = 0.):
+    return Payoff(EUROPEAN_PUT, maturity, strike, interest_rate, streaming=True)
 
-def asian_put_GM_payoff(maturity: float,
+def asian_call_AM_streaming_payoff(maturity: float,
+                                   strike: float,
+                                   interest_rate: float = 0.):
+    return Payoff(ASIAN_CALL_AM, maturity, strike, interest_rate, streaming=True)
+
+def asian_put_AM_streaming_payoff(maturity: float,
+                                  strike: float,
+                                  interest_rate: float = 0.):
+    return Payoff(ASIAN_PUT_AM, maturity, strike, interest_rate, streaming=True)
+
+def asian_call_GM_streaming_payoff(maturity: float,
+                                   strike: float,
+                                   interest_rate: float = 0.):
+    return Payoff(ASIAN_CALL_GM, maturity, strike, interest_rate, streaming=True)
+
+def asian_put_GM_streaming_payoff(maturity: float,
+                                  strike: float,
+                                  interest_rate: float = 0.):
+    return Payoff(ASIAN_PUT_GM, maturity, strike, interest_rate, streaming=True)
+
+def digital_call_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
+    return Payoff(DIGITAL_CALL, maturity, strike, interest_rate)
+
+def digital_put_payoff(maturity: float,
+                       strike: float,
+                       interest_rate: float = 0.):
+    return Payoff(DIGITAL_PUT, maturity, strike, interest_rate)
+
+def digital_call_streaming_payoff(maturity: float,
+                                  strike: float,
+                                  interest_rate: float = 0.):
+    return Payoff(DIGITAL_CALL, maturity, strike, interest_rate, streaming=True)
+
+def digital_put_streaming_payoff(maturity: float,
+                                 strike: float,
+                                 interest_rate: float = 0.):
+    return Payoff(DIGITAL_PUT, maturity, strike, interest_rate, streaming=True)
+
+def discounted_stock_payoff(maturity: float,
+                            interest_rate: float = 0.):
+    # the discounted terminal stock, a control variate with a known mean (see hestonmc.control_variate_mean)
+    return Payoff(DISCOUNTED_STOCK, maturity, 0., interest_rate)
+
+def discounted_stock_streaming_payoff(maturity: float,
+                                      interest_rate: float = 0.):
+    return Payoff(DISCOUNTED_STOCK, maturity, 0., interest_rate, streaming=True)
 
-    @njit(parallel=True, cache=True)
-    def asian_put_GM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.exp(np.sum(np.log(S), axis=1) * dt)
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - I, 0.)*DF
+def barrier_payoff(maturity:      float,
+                   strike:        float,
+                   barrier:       float,
+                   direction:     str   = "up",
+                   knock:         str   = "out",
+                   call:          bool  = True,
+                   interest_rate: float = 0.,
+                   streaming:     bool  = False):
+    """Knock-out or knock-in call or put with an up or a down barrier. A knock-out pays the vanilla payoff if the
+    stock never reaches the barrier, a knock-in if it does; their sum is the vanilla option. Streaming payoffs are
+    monitored continuously if the engine runs with bridge=True.
+    Raises:
+        ValueError: direction is not "up" or "down", or knock is not "out" or "in".
+    """
+    if direction not in ("up", "down") or knock not in ("out", "in"):
+        raise ValueError("direction must be 'up' or 'down' and knock 'out' or 'in'.")
+    code = UP_AND_OUT_CALL + (knock == "in") + 2*(direction == "down") + 4*(not call)
+    return Payoff(code, maturity, strike, interest_rate, streaming=streaming, barrier=barrier)
 
-    return asian_put_GM
\ No newline at end of file
+def lookback_payoff(maturity:      float,
+                    strike:        float = None,
+                    call:          bool  = True,
+                    interest_rate: float = 0.,
+                    streaming:     bool  = False):
+    """Lookback call or put: S_T - min S and max S - S_T with a floating strike (strike None), (max S - K)+ and 
+    (K - min S)+ with a fixed one. Streaming payoffs are monitored continuously if the engine runs with bridge=True."""
+    if strike is None:
+        return Payoff(LOOKBACK_CALL_FLOATING if call else LOOKBACK_PUT_FLOATING, maturity, 0., interest_rate, streaming=streaming)
+    return Payoff(LOOKBACK_CALL_FIXED if call else LOOKBACK_PUT_FIXED, maturity, strike, interest_rate, streaming=streaming)
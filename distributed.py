@@ -0,0 +1,268 @@
+import numpy as np
+
+import os
+import queue
+import importlib
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.managers import BaseManager, EventProxy
+
+from typing import Callable
+
+from hestonmc import HestonParameters, MarketState, RunningStats, normal_quantile
+
+def _job_description(payoff:        Callable,
+                     simulate:      Callable,
+                     state:         MarketState,
+                     heston_params: HestonParameters,
+                     T:             float,
+                     N_T:           int,
+                     batch_size:    int,
+                     seed:          int,
+                     n_threads:     int,
+                     kwargs:        dict) -> dict:
+    # njit dispatchers do not survive pickling across processes reliably, so the engine is shipped by its qualified
+    # name and the market state and the model as plain tuples
+    return {'payoff':        payoff,
+            'simulate':      (simulate.__module__, simulate.__name__),
+            'state':         (state.stock_price, state.interest_rate),
+            'heston_params': (heston_params.kappa, heston_params.gamma, heston_params.rho, heston_params.vbar, heston_params.v0),
+            'T':             T,
+            'N_T':           N_T,
+            'batch_size':    batch_size,
+            'seed':          seed,
+            'n_threads':     n_threads,
+            'kwargs':        kwargs}
+
+def _worker_loop(job:     dict,
+                 tasks,
+                 results,
+                 stop) -> None:
+    """Simulate the batches whose indices arrive on tasks and send back (index, count, mean, M2) until stop is set.
+    A failure is sent back as (None, traceback, None, None), so that the coordinator raises it instead of waiting."""
+    try:
+        if job['n_threads'] is not None:
+            from numba import set_num_threads
+            set_num_threads(job['n_threads'])
+
+        simulate = getattr(importlib.import_module(job['simulate'][0]), job['simulate'][1])
+        args     = {'state':         MarketState(*job['state']),
+                    'heston_params': HestonParameters(*job['heston_params']),
+                    'T':             job['T'],
+                    'N_T':           job['N_T'],
+                    'n_simulations': job['batch_size'],
+                    'seed':          job['seed'],
+                    **job['kwargs']}
+
+        while not stop.is_set():
+            try:
+                batch_index = tasks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch_index is None:
+                break
+
+            args['path_offset'] = batch_index * job['batch_size']
+            stats               = RunningStats.from_batch(job['payoff'](simulate(**args)[0]))
+            results.put((batch_index, stats.count, stats.mean, stats.M2))
+    except (EOFError, ConnectionError):
+        # the coordinator is gone, there is nobody to report to
+        raise
+    except Exception:
+        results.put((None, traceback.format_exc(), None, None))
+
+# State of the coordinator server process of the socket backend, set up by _start_coordinator
+_coordinator = {}
+
+def _start_coordinator(job: dict) -> None:
+    _coordinator.update(job=job, tasks=queue.Queue(), results=queue.Queue(), stop=threading.Event())
+
+class _CoordinatorManager(BaseManager):
+    pass
+
+def _coordinator_job() -> dict:
+    return _coordinator['job']
+
+def _coordinator_tasks() -> queue.Queue:
+    return _coordinator['tasks']
+
+def _coordinator_results() -> queue.Queue:
+    return _coordinator['results']
+
+def _coordinator_stop() -> threading.Event:
+    return _coordinator['stop']
+
+# registered once with module-level functions, which the spawned server process can unpickle
+_CoordinatorManager.register('get_job',     callable=_coordinator_job)
+_CoordinatorManager.register('get_tasks',   callable=_coordinator_tasks)
+_CoordinatorManager.register('get_results', callable=_coordinator_results)
+_CoordinatorManager.register('get_stop',    callable=_coordinator_stop, proxytype=EventProxy)
+
+def run_worker(address: tuple,
+               authkey: bytes,
+               n_threads: int = None) -> None:
+    """Connect to a coordinator started by mc_price_distributed(backend='socket') and serve batches until it stops.
+    Args:
+        address (tuple):           (host, port) of the coordinator.
+        authkey (bytes):           Authentication key of the coordinator.
+        n_threads (int, optional): Number of Numba threads of this worker. Defaults to the job setting.
+    """
+    manager = _CoordinatorManager(address=address, authkey=authkey)
+    manager.connect()
+
+    job = manager.get_job()._getvalue()
+    if n_threads is not None:
+        job['n_threads'] = n_threads
+
+    try:
+        _worker_loop(job, manager.get_tasks(), manager.get_results(), manager.get_stop())
+    except (EOFError, ConnectionError, BrokenPipeError):
+        # the coordinator has finished and shut its server down
+        pass
+
+def _local_worker(address: tuple,
+                  authkey: bytes,
+                  n_threads: int) -> None:
+    run_worker(address, authkey, n_threads)
+
+def mc_price_distributed(payoff:           Callable,
+                         simulate:         Callable,
+                         state:            MarketState,
+                         heston_params:    HestonParameters,
+                         T:                float = 1.,
+                         N_T:              int   = 100,
+                         absolute_error:   float = 0.01,
+                         confidence_level: float = 0.05,
+                         batch_size:       int   = 10_000,
+                         MAX_ITER:         int   = 100_000,
+                         verbose:          bool  = False,
+                         random_seed:      int   = None,
+                         n_workers:        int   = None,
+                         n_threads:        int   = None,
+                         backend:          str   = "process",
+                         address:          tuple = ("127.0.0.1", 0),
+                         authkey:          bytes = None,
+                         **kwargs):
+    """Monte-Carlo pricing with the batches spread over several processes or hosts.
+
+    Batch b is simulated from the counter-based stream with path_offset = b*batch_size, so the workers never
+    share random numbers. The coordinator merges the RunningStats of the batches in index order and stops every
+    worker once the confidence interval of the merged prefix reaches absolute_error; hence the result coincides
+    with mc_price(..., counter_rng=True, batch_size=batch_size) with the same random_seed, whatever the number of
+    workers. The batch size must be given to mc_price explicitly: its default calibrated plan cuts the batches
+    differently and stops at a different number of paths.
+
+    Args:
+        payoff (Callable):                  Payoff function (must be picklable, e.g. a derivatives.Payoff).
+        simulate (Callable):                Module-level simulation engine accepting seed and path_offset.
+        state (MarketState):                Market state.
+        heston_params (HestonParameters):   Heston parameters.
+        T (float, optional):                Contract expiration T. Defaults to 1..
+        N_T (int, optional):                Number of steps in time. Defaults to 100.
+        absolute_error (float, optional):   Absolute error of the price. Defaults to 0.01 (corresponds to 1 cent).
+        confidence_level (float, optional): Confidence level for the price. Defaults to 0.05.
+        batch_size (int, optional):         Path-batch size. Defaults to 10_000.
+        MAX_ITER (int, optional):           Maximum number of batches. Defaults to 100_000.
+        verbose (bool, optional):           Verbose flag. If true, the technical information is printed. Defaults to False.
+        random_seed (int, optional):        Key of the counter-based generator. Defaults to a random key.
+        n_workers (int, optional):          Number of local worker processes. Defaults to the number of CPUs.
+        n_threads (int, optional):          Number of Numba threads per local worker. Defaults to CPUs // n_workers.
+        backend (str, optional):            "process" for a local process pool, "socket" to serve the batches over TCP so
+                                            that workers on other hosts can join with run_worker. Defaults to "process".
+        address (tuple, optional):          (host, port) the socket backend listens on. Defaults to ("127.0.0.1", 0).
+        authkey (bytes, optional):          Authentication key of the socket backend; it is never printed, so pass it to
+                                            let workers on other hosts join. Defaults to a random key known to the
+                                            local workers only.
+        **kwargs:                           Additional arguments for the simulation engine.
+    Raises:
+        ValueError: Unknown backend.
+        RuntimeError: A worker raised an exception or a local worker died.
+    Returns:
+        The price of the derivative.
+    """
+    if backend not in ("process", "socket"):
+        raise ValueError(f"Unknown backend {backend}.")
+
+    n_cpus    = os.cpu_count() or 1
+    n_workers = n_cpus if n_workers is None else n_workers
+    n_threads = max(1, n_cpus // max(n_workers, 1)) if n_threads is None else n_threads
+    seed      = random_seed if random_seed is not None else int(np.random.randint(2**62))
+    job       = _job_description(payoff, simulate, state, heston_params, T, N_T, batch_size, seed, n_threads, kwargs)
+    ctx       = mp.get_context("spawn")
+
+    if backend == "process":
+        tasks, results, stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+        workers              = [ctx.Process(target=_worker_loop, args=(job, tasks, results, stop), daemon=True) for _ in range(n_workers)]
+    else:
+        # the queues live in a server process, which shutdown() stops together with its listening socket
+        authkey              = authkey if authkey is not None else os.urandom(16)
+        manager              = _CoordinatorManager(address=address, authkey=authkey, ctx=ctx)
+        manager.start(_start_coordinator, (job,))
+        tasks, results, stop = manager.get_tasks(), manager.get_results(), manager.get_stop()
+        address = manager.address
+        workers = [ctx.Process(target=_local_worker, args=(address, authkey, n_threads), daemon=True) for _ in range(n_workers)]
+
+        if verbose:
+            # the key stays secret: whoever starts remote workers passes it to them deliberately
+            print(f"Coordinator listening on {address[0]}:{address[1]}, join with: python distributed.py {address[0]} {address[1]} <authkey>")
+
+    for worker in workers:
+        worker.start()
+
+    C                    = -2*normal_quantile(confidence_level*0.5)
+    stats                = RunningStats()
+    length_conf_interval = 1.
+    pending              = {}
+    next_task            = 0
+    iter_count           = 0
+    in_flight            = 2*max(n_workers, 1)
+
+    try:
+        while length_conf_interval > absolute_error and iter_count < MAX_ITER:
+            while next_task < min(iter_count + in_flight, MAX_ITER):
+                tasks.put(next_task)
+                next_task += 1
+
+            try:
+                batch_index, count, mean, M2 = results.get(timeout=1.)
+            except queue.Empty:
+                # a local worker that died without reporting has taken its batches with it
+                exit_codes = [worker.exitcode for worker in workers if not worker.is_alive()]
+                if exit_codes:
+                    raise RuntimeError(f"{len(exit_codes)} worker(s) exited with codes {exit_codes} before the target was reached.")
+                continue
+            if batch_index is None:
+                raise RuntimeError(f"A worker failed:\n{count}")
+            pending[batch_index] = RunningStats(count, mean, M2)
+
+            # merging in index order keeps the result independent of the scheduling
+            while iter_count in pending and length_conf_interval > absolute_error:
+                stats.merge(pending.pop(iter_count))
+                iter_count          += 1
+                length_conf_interval = stats.ci_length(C)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=5.)
+            if worker.is_alive():
+                worker.terminate()
+        if backend == "socket":
+            manager.shutdown()
+
+    if verbose:
+        print(f"Random seed:                {seed}\nBackend:                    {backend}\nLocal workers:              {n_workers} x {n_threads} threads\nNumber of batches:          {iter_count}\nBatches scheduled:          {next_task}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {stats.count}\nAbsolute error:             {absolute_error}\nLength of the conf intl:    {length_conf_interval}\nConfidence level:           {confidence_level}\n")
+
+    return stats.mean
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Join a mc_price_distributed(backend='socket') coordinator as a worker.")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("authkey", help="hex-encoded authentication key")
+    parser.add_argument("--threads", type=int, default=None)
+    cli = parser.parse_args()
+
+    run_worker((cli.host, cli.port), bytes.fromhex(cli.authkey), cli.threads)
@@ -1,18 +1,22 @@
 import numpy as np
+import os
 
-from math import erf, sqrt, exp, log
+from math import erf, sqrt, exp, log, cos, sin, pi
 sqrt2 = 1/sqrt(2)
 
-from scipy.stats import norm
+# scipy is imported where it is needed (randomized QMC), it takes longer to import than the rest of the module
+from statistics import NormalDist
 
 from typing import Union, Callable, Optional
+from collections import namedtuple
 from copy import error
-from scipy.interpolate import RectBivariateSpline
-from scipy.optimize import newton, root_scalar
+from time import perf_counter
 
-from numba import jit, njit, prange, float64
-from numba.experimental import jitclass
-from numba_stats import norm, uniform
+from numba import jit, njit, prange, float64, get_num_threads
+
+from derivatives import ACC_TERMINAL, ACC_AVERAGE, ACC_LOG_AVERAGE, ACC_MIN, ACC_MAX, N_ACC
+from derivatives import LIPSCHITZ_CODES, EUROPEAN_CALL, EUROPEAN_PUT, DISCOUNTED_STOCK, Payoff, evaluate_terminal
+from derivatives import evaluate_payoffs_scenarios
 
 @njit
 def Phi(x):
@@ -22,25 +26,148 @@ if __name__ == '__main__':
     print("This is a module. Please import it.\n")
     exit(-1)
 
-@jitclass([("kappa", float64),
-           ("gamma", float64),
-           ("rho", float64), 
-           ("vbar", float64),
-           ("v0", float64)])
-class HestonParameters:
-    def __init__(self, kappa, gamma, rho, vbar, v0):
-        self.kappa = kappa
-        self.gamma = gamma
-        self.rho = rho
-        self.vbar = vbar
-        self.v0 = v0
-        
-@jitclass([("stock_price", float64),
-           ("interest_rate", float64)])
-class MarketState:
-    def __init__(self, stock_price, interest_rate):
-        self.stock_price = stock_price
-        self.interest_rate = interest_rate
+# Named tuples rather than jitclasses: Numba types them by their (importable) class, so the engines that take them
+# are loaded from the on-disk cache in a new process, and they need no compiled constructor. The fields are cast to
+# float so that MarketState(100, 0) and MarketState(100., 0.) select the same compiled specialization.
+class HestonParameters(namedtuple("HestonParameters", ["kappa", "gamma", "rho", "vbar", "v0"])):
+    __slots__ = ()
+
+    def __new__(cls, kappa, gamma, rho, vbar, v0):
+        return super().__new__(cls, float(kappa), float(gamma), float(rho), float(vbar), float(v0))
+
+class MarketState(namedtuple("MarketState", ["stock_price", "interest_rate"])):
+    __slots__ = ()
+
+    def __new__(cls, stock_price, interest_rate):
+        return super().__new__(cls, float(stock_price), float(interest_rate))
+
+def _log1p(z: np.ndarray) -> np.ndarray:
+    # log(1 + z) of complex z: numpy's complex log1p loses the real part of a small z, so small arguments use the series
+    z = np.asarray(z, dtype=np.complex128)
+    return np.where(np.abs(z) < 1e-3, z*(1. - z*(1./2. - z*(1./3. - z*(1./4. - z/5.)))), np.log(1. + z))
+
+def heston_characteristic_function(u:             np.ndarray,
+                                   tau:           np.ndarray,
+                                   heston_params: HestonParameters,
+                                   interest_rate: float = 0.) -> np.ndarray:
+    """Characteristic function E[exp(iu log(S_tau/S_0))] of the Heston model (the "little trap" form of Albrecher et al.,
+    which has no branch cut problem for long maturities). u and tau are broadcast against each other.
+    Args:
+        u (np.ndarray):                   Arguments of the characteristic function.
+        tau (np.ndarray):                 Times to maturity.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        interest_rate (float, optional):  Interest rate. Defaults to 0..
+    Returns:
+        The values of the characteristic function.
+    """
+    kappa, gamma, rho, vbar, v0 = heston_params.kappa, heston_params.gamma, heston_params.rho, heston_params.vbar, heston_params.v0
+
+    u     = np.asarray(u, dtype=np.complex128)
+    beta  = kappa - 1j*rho*gamma*u
+    d     = np.sqrt(beta**2 + gamma**2*(1j*u + u**2))
+    # (beta - d)/gamma^2 without the cancellation of beta - d, which wipes out the function for a small vol-of-vol
+    q     = -(1j*u + u**2)/(beta + d)
+    g     = gamma**2*q/(beta + d)
+    e     = np.exp(-d*tau)
+    C     = 1j*u*interest_rate*tau + kappa*vbar*(q*tau - 2.*(_log1p(-g*e) - _log1p(-g))/gamma**2)
+    D     = q*(1. - e)/(1. - g*e)
+    return np.exp(C + D*v0)
+
+def _heston_cumulants(tau:           np.ndarray,
+                      heston_params: HestonParameters,
+                      interest_rate: float,
+                      h:             float = 1e-3) -> tuple:
+    # first two cumulants of log(S_tau/S_0) for the COS truncation range: the mean in closed form, the variance by a
+    # central difference of the cumulant generating function (the closed form of Fang and Oosterlee underestimates 
+    # it badly when the Feller condition is violated)
+    kappa, vbar, v0 = heston_params.kappa, heston_params.vbar, heston_params.v0
+
+    c1 = interest_rate*tau + (1. - np.exp(-kappa*tau))*(vbar - v0)/(2.*kappa) - 0.5*vbar*tau
+    lf = np.log(heston_characteristic_function(np.array([-h, h]), tau, heston_params, interest_rate))
+    c2 = -np.real(lf[..., :1] + lf[..., 1:])/h**2
+    return c1, np.abs(c2)
+
+def heston_price_cos(state:         MarketState,
+                     heston_params: HestonParameters,
+                     strikes:       np.ndarray,
+                     maturities:    np.ndarray,
+                     call:          bool  = True,
+                     N:             int   = 512,
+                     L:             float = 16.) -> np.ndarray:
+    """Semi-analytic prices of European options under the Heston model by the COS method (Fang and Oosterlee, 2008).
+    All the strikes and maturities are priced in one vectorized call: the characteristic function is evaluated once
+    per maturity and shared by the strikes. Puts are computed from the cosine expansion and calls by the put-call parity,
+    which is more stable for deep in-the-money calls.
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        strikes (np.ndarray):             Strikes of the options.
+        maturities (np.ndarray):          Maturities of the options expressed as a number of years.
+        call (bool, optional):            Price calls if true and puts otherwise. Defaults to True.
+        N (int, optional):                Number of terms of the cosine expansion; increase it (with L) for long maturities
+                                          when the Feller condition is strongly violated. Defaults to 512.
+        L (float, optional):              Half-width of the truncation range in standard deviations of log(S_T/S_0). Defaults to 16..
+    Returns:
+        The matrix of prices of shape (len(maturities), len(strikes)).
+    """
+    strikes    = np.atleast_1d(np.asarray(strikes, dtype=np.float64))
+    maturities = np.atleast_1d(np.asarray(maturities, dtype=np.float64))[:, None]
+    r, s0      = state.interest_rate, state.stock_price
+
+    x          = np.log(s0/strikes)                                                 # (n_strikes,)
+
+    # the expansion is in y = log(S_T/K) = x + log(S_T/S_0), so one range per maturity has to cover every strike
+    c1, c2     = _heston_cumulants(maturities, heston_params, r)
+    a          = c1 + x.min() - L*np.sqrt(c2)
+    b          = c1 + x.max() + L*np.sqrt(c2)
+    u          = np.arange(N)*pi/(b - a)                                             # (n_mat, N)
+
+    # put payoff coefficients: 2/(b-a) * (psi_k(a, 0) - chi_k(a, 0)), in units of the strike
+    ua         = -u*a
+    chi        = (np.cos(ua) - np.exp(a) + u*np.sin(ua))/(1. + u**2)
+    psi        = np.empty_like(u)
+    psi[:, 0]  = -a[:, 0]
+    psi[:, 1:] = np.sin(ua[:, 1:])/u[:, 1:]
+    U          = 2./(b - a)*(psi - chi)
+    U[:, 0]   *= 0.5
+
+    phi        = heston_characteristic_function(u, maturities, heston_params, r)*np.exp(-1j*u*a)*U
+    puts       = strikes*np.exp(-r*maturities)*np.real(np.exp(1j*u[:, None, :]*x[None, :, None]) * phi[:, None, :]).sum(axis=2)
+
+    if call:
+        return puts + s0 - strikes*np.exp(-r*maturities)
+    return puts
+
+def control_variate_mean(payoff:        Callable,
+                         state:         MarketState,
+                         heston_params: HestonParameters,
+                         T:             float = 1.,
+                         N_T:           int   = 100) -> Optional[float]:
+    """Exact mean of a European call/put or a discounted stock payoff on the paths of the simulation engines, to be used 
+    as mu in mc_price. The engines return N_T grid points t_i = i*T/N_T, i < N_T, so the stock price the payoff sees 
+    is S at T*(N_T-1)/N_T, while the payoff discounts over its own maturity.
+    Args:
+        payoff (Callable):                Control variate payoff.
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract expiration T passed to the engine. Defaults to 1..
+        N_T (int, optional):              Number of steps in time passed to the engine. Defaults to 100.
+    Returns:
+        The mean of the payoff or None if it is not a European call, put or the discounted stock.
+    """
+    if not isinstance(payoff, Payoff) or payoff.code not in (EUROPEAN_CALL, EUROPEAN_PUT, DISCOUNTED_STOCK):
+        return None
+
+    horizon = T*(N_T - 1)/N_T
+    if payoff.code == DISCOUNTED_STOCK:
+        return state.stock_price*exp(state.interest_rate*horizon - payoff.interest_rate*payoff.maturity)
+
+    price   = heston_price_cos(state, heston_params, payoff.strike, horizon, call = payoff.code == EUROPEAN_CALL)[0, 0]
+    return price*exp(state.interest_rate*horizon - payoff.interest_rate*payoff.maturity)
+
+def normal_quantile(p: float) -> float:
+    """Quantile of the standard normal distribution."""
+    return NormalDist().inv_cdf(p)
 
 def get_len_conf_interval(data:             np.ndarray, 
                           confidence_level: float = 0.05):
@@ -52,12 +179,365 @@ def get_len_conf_interval(data:             np.ndarray,
     Returns:
         The confidence interval.
     """
-    return -2*norm.ppf(confidence_level*0.5) * sqrt(np.var(data) / len(data))
+    return -2*normal_quantile(confidence_level*0.5) * sqrt(np.var(data) / len(data))
+
+class RunningStats:
+    """Mergeable sufficient statistics of a sample: count, mean and the sum of squared deviations M2.
+
+    Batches are folded in with the pairwise update of Chan, Golub and LeVeque, which is numerically stable and
+    exact, so statistics gathered by several workers can be merged in any grouping. mean and M2 may be arrays,
+    in which case the last axis of a batch runs over the paths.
+    """
+    def __init__(self,
+                 count: int                      = 0,
+                 mean:  Union[float, np.ndarray] = 0.,
+                 M2:    Union[float, np.ndarray] = 0.):
+        self.count = count
+        self.mean  = mean
+        self.M2    = M2
+
+    @classmethod
+    def from_batch(cls, batch: np.ndarray):
+        # single-precision payoffs are accumulated in double precision
+        batch = np.asarray(batch, dtype=np.float64)
+        mean  = np.mean(batch, axis=-1)
+        return cls(batch.shape[-1], mean, np.sum((batch - np.expand_dims(mean, -1))**2, axis=-1))
+
+    def merge(self, other):
+        """Fold the statistics of another sample into this one (in place) and return self. The counts may be arrays
+        too, one per component, when the components are sampled a different number of times (see mc_price_scenarios)."""
+        if np.all(other.count == 0):
+            return self
+        if np.all(self.count == 0):
+            self.count, self.mean, self.M2 = other.count, other.mean, other.M2
+            return self
+
+        count      = self.count + other.count
+        delta      = other.mean - self.mean
+        self.mean  = self.mean + delta * (other.count / count)
+        self.M2    = self.M2 + other.M2 + delta**2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def update(self, batch: np.ndarray):
+        return self.merge(RunningStats.from_batch(batch))
+
+    @property
+    def variance(self):
+        return self.M2 / self.count
+
+    def ci_length(self, C: float):
+        """Length of the confidence interval of the mean for the two-sided quantile multiplier C."""
+        return C * np.sqrt(self.variance / self.count)
+
+    def __repr__(self):
+        return f"RunningStats(count={self.count}, mean={self.mean}, M2={self.M2})"
+
+class RunningCovariance:
+    """Mergeable count, mean vector and co-moment matrix M (sum of the outer products of the deviations) of a sample
+    of vectors, with the same pairwise update as RunningStats. The first axis of a batch runs over the components,
+    the last one over the paths."""
+    def __init__(self,
+                 count: int        = 0,
+                 mean:  np.ndarray = None,
+                 M:     np.ndarray = None):
+        self.count = count
+        self.mean  = mean
+        self.M     = M
+
+    @classmethod
+    def from_batch(cls, batch: np.ndarray):
+        batch     = np.asarray(batch, dtype=np.float64)
+        mean      = np.mean(batch, axis=-1)
+        deviation = batch - mean[:, None]
+        return cls(batch.shape[-1], mean, deviation @ deviation.T)
+
+    def merge(self, other):
+        """Fold the statistics of another sample into this one (in place) and return self."""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.M = other.count, other.mean, other.M
+            return self
+
+        count      = self.count + other.count
+        delta      = other.mean - self.mean
+        self.mean  = self.mean + delta * (other.count / count)
+        self.M     = self.M + other.M + np.outer(delta, delta) * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def update(self, batch: np.ndarray):
+        return self.merge(RunningCovariance.from_batch(batch))
+
+    def regression(self, mu: np.ndarray) -> tuple:
+        """Control-variate estimate of the mean of component 0 with the components 1: as controls of known means mu.
+        The coefficients are the least-squares ones on every path seen so far, beta = M_xx^-1 M_xy. Returns RunningStats of
+        the estimate Y - beta (X - mu) with the residual sum of squares M_yy - M_yx beta as M2, and beta."""
+        M_xx, M_xy = self.M[1:, 1:], self.M[1:, 0]
+        beta       = np.linalg.lstsq(M_xx, M_xy, rcond=None)[0]
+        mean       = self.mean[0] - beta @ (self.mean[1:] - mu)
+        return RunningStats(self.count, mean, max(self.M[0, 0] - M_xy @ beta, 0.)), beta
+
+    def __repr__(self):
+        return f"RunningCovariance(count={self.count}, mean={self.mean}, M={self.M})"
+
+class BatchPlanner:
+    """Path-batch sizes of a Monte-Carlo loop that stops on the length of the confidence interval.
+
+    The first batch is a warm-up (it may include the compilation of the engine) of about 2^18 path steps. From the 
+    second one on every batch size is timed twice and doubled as long as the throughput (paths per second of 
+    simulation and payoff) grows by more than 5%, and the best size is kept; the throughput depends on the number of threads and on N_T, 
+    so it is measured rather than guessed. After every batch the number of paths needed for the target is projected 
+    from the current variance, (C sigma / absolute_error)^2, and once the remainder fits into one batch the final 
+    batch is cut to it, so the loop does not overshoot the target by a whole batch.
+    """
+    def __init__(self,
+                 N_T:             int,
+                 absolute_error:  float,
+                 C:               float,
+                 batch_size:      int   = None,
+                 max_batch_steps: int   = 2**24,
+                 margin:          float = 0.02):
+        self.N_T            = N_T
+        self.absolute_error = absolute_error
+        self.C              = C
+        self.margin         = margin
+        self.threads        = get_num_threads()
+        self.adaptive       = batch_size is None
+        self.max_batch      = max(1, max_batch_steps // N_T)
+        self.min_batch      = 16 * self.threads
+        self.batch_size     = batch_size if batch_size is not None else int(min(self.max_batch, max(self.min_batch, 2**18 // N_T)))
+        self.calibrating    = self.adaptive
+        self.best           = None   # (batch size, paths per second)
+        self.trial          = None   # first timing of the size being calibrated
+        self.paths_per_call = None   # paths per simulation, e.g. 4 with the antithetic engines
+        self.projected      = None
+        self.batches        = []
+
+    def next(self, stats: RunningStats) -> int:
+        """Size (n_simulations) of the next batch given the statistics gathered so far."""
+        if not self.adaptive or self.paths_per_call is None:
+            return self.batch_size
+
+        self.projected = int(np.ceil((self.C / self.absolute_error)**2 * np.max(stats.variance)))
+        remaining      = int(np.ceil((self.projected - stats.count) * (1. + self.margin) / self.paths_per_call))
+        if remaining < self.batch_size:
+            return max(remaining, self.min_batch)
+        return self.batch_size
+
+    def record(self, n_simulations: int, n_paths: int, seconds: float):
+        """Account for a batch of n_simulations that produced n_paths paths and took seconds."""
+        self.batches.append((n_simulations, seconds))
+        if len(self.batches) == 1:
+            # the batch's own paths: the statistics may start from the cached estimate of an earlier run
+            self.paths_per_call = n_paths / n_simulations
+            return
+        if not self.calibrating or n_simulations != self.batch_size:
+            return
+
+        # every size is timed twice and the faster run counts, which filters out most of the timer noise
+        throughput = n_simulations * self.paths_per_call / seconds
+        if self.trial is None or self.trial[0] != n_simulations:
+            self.trial = (n_simulations, throughput)
+            return
+        throughput = max(throughput, self.trial[1])
+        if self.best is None or throughput > 1.05 * self.best[1]:
+            self.best = (n_simulations, throughput)
+            if 2 * n_simulations <= self.max_batch:
+                self.batch_size = 2 * n_simulations
+                return
+        self.batch_size  = self.best[0]
+        self.calibrating = False
+
+    def report(self) -> str:
+        # runs of equal sizes are collapsed, e.g. "2621 x 3, 5242 x 2, 1321"
+        runs = []
+        for n, _ in self.batches:
+            if runs and runs[-1][0] == n:
+                runs[-1][1] += 1
+            else:
+                runs.append([n, 1])
+        sizes = ", ".join(f"{n} x {k}" if k > 1 else f"{n}" for n, k in runs)
+        if not self.adaptive:
+            return f"Batch size:                 {self.batch_size} (fixed)\nBatches:                    {sizes}"
+        best = (f"Calibrated batch size:      {self.best[0]} ({self.best[1]:.4g} paths/s)" if self.best is not None else
+                f"Batch size:                 {self.batch_size} (stopped before the calibration)")
+        return (f"Batch plan:                 {self.threads} threads, N_T = {self.N_T}\n"
+                f"{best}\n"
+                f"Projected number of paths:  {self.projected}\n"
+                f"Final batch:                {self.batches[-1][0] if self.batches else 0}\n"
+                f"Batches:                    {sizes}")
 
 @njit
 def set_seed(value):
     np.random.seed(value)
 
+# Philox4x32-10 constants (Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", 2011).
+PHILOX_M0 = np.uint64(0xD2511F53)
+PHILOX_M1 = np.uint64(0xCD9E8D57)
+PHILOX_W0 = np.uint64(0x9E3779B9)
+PHILOX_W1 = np.uint64(0xBB67AE85)
+MASK32    = np.uint64(0xFFFFFFFF)
+SHIFT32   = np.uint64(32)
+SHIFT11   = np.uint64(11)
+INV_2_53  = 1./9007199254740992.
+
+@njit(cache=True, nogil=True)
+def philox4x32(c0, c1, c2, c3, k0, k1):
+    """Philox4x32-10 block: maps the 128-bit counter (c0, c1, c2, c3) and the 64-bit key (k0, k1) to four 32-bit words."""
+    c0, c1, c2, c3 = np.uint64(c0), np.uint64(c1), np.uint64(c2), np.uint64(c3)
+    k0, k1         = np.uint64(k0), np.uint64(k1)
+
+    for _ in range(10):
+        p0             = PHILOX_M0 * c0
+        p1             = PHILOX_M1 * c2
+        c0, c1, c2, c3 = ((p1 >> SHIFT32) ^ c1 ^ k0) & MASK32, p1 & MASK32, ((p0 >> SHIFT32) ^ c3 ^ k1) & MASK32, p0 & MASK32
+        k0             = (k0 + PHILOX_W0) & MASK32
+        k1             = (k1 + PHILOX_W1) & MASK32
+
+    return c0, c1, c2, c3
+
+@njit(cache=True, nogil=True)
+def philox_uniform_pair(seed, path, step, stream=0):
+    """Two independent uniforms on (0, 1) with 53-bit resolution keyed by (seed, path, step, stream)."""
+    seed, path     = np.uint64(seed), np.uint64(path)
+    x0, x1, x2, x3 = philox4x32(path & MASK32, path >> SHIFT32, np.uint64(step), np.uint64(stream), seed & MASK32, seed >> SHIFT32)
+    u1             = (float(((x0 << SHIFT32) | x1) >> SHIFT11) + 0.5) * INV_2_53
+    u2             = (float(((x2 << SHIFT32) | x3) >> SHIFT11) + 0.5) * INV_2_53
+    return u1, u2
+
+@njit(cache=True, nogil=True)
+def philox_normal_pair(seed, path, step, stream=0):
+    """Two independent standard normals keyed by (seed, path, step, stream) (Box-Muller transform of philox_uniform_pair).
+    Any path can be regenerated on its own and the values do not depend on the number of threads."""
+    u1, u2 = philox_uniform_pair(seed, path, step, stream)
+    r      = sqrt(-2.*log(u1))
+    return r*cos(2.*pi*u2), r*sin(2.*pi*u2)
+
+@njit(cache=True, nogil=True)
+def _draw_normal_pair(seed, path, step):
+    if seed < 0:
+        return np.random.standard_normal(), np.random.standard_normal()
+    return philox_normal_pair(seed, path, step)
+
+# Philox stream of the uniforms that sample the extremes of the Brownian bridges between grid points (bridge=True)
+BRIDGE_STREAM = 2
+
+@njit(cache=True, nogil=True)
+def _draw_uniform_pair(seed, path, step):
+    if seed < 0:
+        return 1. - np.random.random(), 1. - np.random.random()
+    return philox_uniform_pair(seed, path, step, BRIDGE_STREAM)
+
+@njit(parallel=True, cache=True, nogil=True)
+def _standard_normal_tensor(seed, path_offset, n_simulations, N_T, dtype=np.float64):
+    if seed < 0:
+        return np.asarray(np.random.standard_normal(size=(2, n_simulations, N_T)), dtype)
+
+    Z = np.empty((2, n_simulations, N_T), dtype)
+    for n in prange(n_simulations):
+        for i in range(N_T):
+            Z[0, n, i], Z[1, n, i] = philox_normal_pair(seed, path_offset + n, i)
+    return Z
+
+def path_construction_matrix(n_steps:  int,
+                             ordering: str = "bridge") -> np.ndarray:
+    """Matrix B such that W = B z maps independent standard normals z to a Brownian path W sampled at t = 1, ..., n_steps.
+    The leading coordinates of z carry the most variance of the path, which is what low-discrepancy points need.
+    Args:
+        n_steps (int):            Number of time steps.
+        ordering (str, optional): "bridge" (Brownian bridge), "pca" (principal components) or "none" (forward 
+                                  increments). Defaults to "bridge".
+    Raises:
+        ValueError: Unknown ordering.
+    Returns:
+        The matrix B of shape (n_steps, n_steps).
+    """
+    t = np.arange(1., n_steps + 1.)
+
+    if ordering == "none":
+        return np.tril(np.ones((n_steps, n_steps)))
+
+    if ordering == "pca":
+        eigenvalues, eigenvectors = np.linalg.eigh(np.minimum.outer(t, t))
+        order                     = np.argsort(eigenvalues)[::-1]
+        return eigenvectors[:, order] * np.sqrt(eigenvalues[order])
+
+    if ordering != "bridge":
+        raise ValueError(f"Unknown path ordering {ordering}.")
+
+    B            = np.zeros((n_steps, n_steps))
+    B[-1, 0]     = sqrt(t[-1])
+    intervals    = [(-1, n_steps - 1)]
+    k            = 1
+    while intervals:
+        left, right = intervals.pop(0)
+        if right - left <= 1:
+            continue
+        mid          = (left + right) // 2
+        t_l, t_r     = (t[left] if left >= 0 else 0.), t[right]
+        w_l          = B[left] if left >= 0 else np.zeros(n_steps)
+        B[mid]       = ((t_r - t[mid]) * w_l + (t[mid] - t_l) * B[right]) / (t_r - t_l)
+        B[mid, k]    = sqrt((t[mid] - t_l) * (t_r - t[mid]) / (t_r - t_l))
+        k           += 1
+        intervals   += [(left, mid), (mid, right)]
+    return B
+
+def sobol_normals(sobol:         "scipy.stats.qmc.Sobol",
+                  n_simulations: int,
+                  N_T:           int,
+                  B:             np.ndarray) -> np.ndarray:
+    """Draw the next n_simulations points of a scrambled Sobol sequence of dimension 2*(N_T-1) and turn them into 
+    the standard normals (2, n_simulations, N_T) consumed by the full-path engines.
+    The coordinates are interleaved between the two Brownian drivers and mapped through the path construction
+    matrix B (see path_construction_matrix), so the first Sobol coordinates drive the coarse shape of both paths.
+    """
+    from scipy.special import ndtri
+
+    n_steps = N_T - 1
+    U       = sobol.random(n_simulations)
+    Z       = np.zeros((2, n_simulations, N_T))
+
+    for d in range(2):
+        W                  = ndtri(U[:, d::2]) @ B.T
+        Z[d, :, :n_steps]  = np.diff(W, axis=1, prepend=0.)
+    return Z
+
+def _specializations(dispatcher) -> int:
+    # a new specialization of an engine means that the call compiled it or loaded it from the cache
+    return len(getattr(dispatcher, 'overloads', ()))
+
+def _batch_event(method:         str,
+                 iteration:      int,
+                 start:          float,
+                 spans:          dict,
+                 compiled:       bool,
+                 outputs:        tuple,
+                 n_simulations:  int,
+                 paths:          int,
+                 stats:          RunningStats,
+                 ci_length:      float,
+                 absolute_error: float,
+                 run_start:      float) -> dict:
+    # the telemetry record of one batch of mc_price, see mc_price(observer=...) and telemetry.py
+    seconds = perf_counter() - start
+    return {'event':            "batch",
+            'method':           method,
+            'iteration':        iteration,
+            'n_simulations':    n_simulations,
+            'paths':            paths,
+            'seconds':          seconds,
+            'spans':            spans,
+            'compiled':         compiled,
+            'paths_per_second': paths / seconds if seconds > 0. else float('inf'),
+            'bytes':            sum(output.nbytes for output in outputs if isinstance(output, np.ndarray)),
+            'n':                int(np.max(stats.count)),
+            'mean':             np.asarray(stats.mean).tolist(),
+            'ci_length':        float(np.max(ci_length)),
+            'absolute_error':   absolute_error,
+            'elapsed':          perf_counter() - run_start}
+
 def mc_price(payoff:                 Callable,
              simulate:               Callable,
              state:                  MarketState,
@@ -66,13 +546,21 @@ def mc_price(payoff:                 Callable,
              N_T:                    int      = 100,
              absolute_error:         float    = 0.01,
              confidence_level:       float    = 0.05,
-             batch_size:             int      = 10_000,
+             batch_size:             int      = None,
              MAX_ITER:               int      = 100_000,
-             control_variate_payoff: Callable = None,
+             control_variate_payoff: Union[Callable, list] = None,
              control_variate_iter:   int      = 1_000,
-             mu:                     float    = None,
+             mu:                     Union[float, list] = None,
              verbose:                bool     = False,
              random_seed:            int      = None,
+             counter_rng:            bool     = False,
+             qmc_replications:       int      = 0,
+             qmc_ordering:           str      = "bridge",
+             greeks:                 tuple    = None,
+             initial_stats:          RunningStats = None,
+             path_offset:            int      = 0,
+             full_output:            bool     = False,
+             observer:               Callable = None,
              **kwargs):
     """A function that performs a Monte-Carlo based pricing of a derivative with a given payoff (possibly path-dependent) under the Heston model.
     Args:
@@ -84,15 +572,54 @@ def mc_price(payoff:                 Callable,
         N_T (int, optional):                         Number of steps in time. Defaults to 100.
         absolute_error (float, optional):            Absolute error of the price. Defaults to 0.01 (corresponds to 1 cent). 
         confidence_level (float, optional):          Confidence level for the price. Defaults to 0.05.
-        batch_size (int, optional):                  Path-batch size. Defaults to 10_000.
+        batch_size (int, optional):                  Path-batch size. Defaults to None: the batch size is calibrated on the
+                                                     throughput of the first batches and the last batch is cut to the number 
+                                                     of paths projected from the variance (see BatchPlanner).
         MAX_ITER (int, optional):                    Maximum number of iterations. Defaults to 100_000.  
-        control_variate_payoff (Callable, optional): Control variate payoff. Defaults to None.
-        control_variate_iter (int, optional):        Number of iterations for the control variate. Defaults to 1_000.
+        control_variate_payoff (Callable, optional): Control variate payoff or a list of them. The coefficients are the
+                                                     least-squares ones on all paths simulated so far and are updated after
+                                                     every batch (see RunningCovariance.regression). Defaults to None.
+        control_variate_iter (int, optional):        Number of simulations of the first (pilot) batch of the control variate
+                                                     estimator; its paths count towards the price. Defaults to 1_000.
+        mu (float, optional):                        Mean of the control variate payoff or a list of means, one per control
+                                                     (None entries are filled in). Defaults to the COS price for a European 
+                                                     call/put and to the forward for the discounted stock (see 
+                                                     control_variate_mean).
         verbose (bool, optional):                    Verbose flag. If true, the technical information is printed. Defaults to False.
         random_seed (int, optional):                 Random seed. Defaults to None.
+        counter_rng (bool, optional):                If true, the paths are drawn from the counter-based Philox stream keyed by
+                                                     (random_seed, path index, step), so the price does not depend on the number 
+                                                     of threads. Defaults to False.
+        qmc_replications (int, optional):            If positive, the full-path engine is driven by this many (at least 2) independently
+                                                     scrambled Sobol sequences (randomized QMC) and the confidence interval is
+                                                     computed from the spread of the replication means. batch_size is rounded 
+                                                     up to a power of two. Defaults to 0 (pseudo-random numbers).
+        qmc_ordering (str, optional):                Path construction for QMC: "bridge", "pca" or "none". Defaults to "bridge".
+        greeks (tuple, optional):                    Names from GREEKS ("delta", "gamma", "vega" = d/dv0, "kappa", "rho") estimated
+                                                     on the same paths as the price. The Euler and QE engines are replaced by their
+                                                     greeks engines (see GREEK_ENGINES) and the payoff must be a terminal 
+                                                     derivatives.Payoff. Defaults to None.
+        initial_stats (RunningStats, optional):      Statistics of paths simulated before, e.g. by an earlier call with the
+                                                     same settings, which are continued rather than started over (plain 
+                                                     Monte-Carlo only). Defaults to None.
+        path_offset (int, optional):                 Index of the first path in the counter-based stream; with counter_rng 
+                                                     and initial_stats it is the offset returned by the earlier call. 
+                                                     Defaults to 0.
+        full_output (bool, optional):                If true, return the price, the RunningStats of the estimate and the
+                                                     path offset at which the counter-based stream continues. Defaults to False.
+        observer (Callable, optional):               Telemetry callback called with a dict after every batch ('event': "batch":
+                                                     the timing spans, paths per second, bytes of the engine output and the
+                                                     convergence n, mean, ci_length) and once at the end ('event': "done"); see
+                                                     telemetry.py for recorders and exporters. Defaults to None (no telemetry).
         **kwargs:                                    Additional arguments for the simulation engine.
+    Raises:
+        error: Greeks with a control variate, randomized QMC or an engine without tangent recursions; initial_stats 
+               or full_output with anything but plain Monte-Carlo.
+        ValueError: Unknown Greek, a path-dependent payoff, not as many means as control variates or fewer than two
+                    QMC replications.
     Returns:    
-        The price(-s) of the derivative(-s).    
+        The price(-s) of the derivative(-s). With greeks, a tuple of the price and a dict {name: (estimate, length of 
+        the confidence interval)}.
     """
 
     arg = {'state':         state,
@@ -103,67 +630,230 @@ def mc_price(payoff:                 Callable,
 
     args       = {**arg, **kwargs}
     iter_count = 0   
+    run_start  = perf_counter()
 
     length_conf_interval = 1.
     n                    = 0
-    C                    = -2*norm.ppf(confidence_level*0.5, loc = 0., scale = 1.)
-    sigma_n              = 0.
-    batch_new            = np.zeros(batch_size, dtype=np.float64)
-    current_Pt_sum       = 0.        
-
-    if random_seed is not None:
+    C                    = -2*normal_quantile(confidence_level*0.5)
+    stats                = RunningStats()
+    planner              = BatchPlanner(N_T, absolute_error, C, batch_size)
+    args['n_simulations'] = planner.batch_size
+
+    if counter_rng:
+        args['seed']        = random_seed if random_seed is not None else int(np.random.randint(2**62))
+        args['path_offset'] = path_offset
+    elif random_seed is not None:
         set_seed(random_seed)
 
-    if control_variate_payoff is None:
+    if initial_stats is not None or full_output:
+        if greeks is not None or qmc_replications > 0 or control_variate_payoff is not None:
+            raise error("initial_stats and full_output are supported by plain Monte-Carlo only.")
+    if initial_stats is not None and initial_stats.count > 0:
+        stats                = RunningStats(initial_stats.count, initial_stats.mean, initial_stats.M2)
+        n                    = stats.count
+        length_conf_interval = stats.ci_length(C)
+
+    if greeks is not None:
+        if control_variate_payoff is not None or qmc_replications > 0:
+            raise error("Greeks are estimated with plain Monte-Carlo only.")
+        if simulate not in GREEK_ENGINES:
+            raise error(f"No greeks engine for {simulate.__name__}.")
+        for name in greeks:
+            if name not in GREEKS:
+                raise ValueError(f"Unknown Greek {name}.")
+
+        engine       = GREEK_ENGINES[simulate]
+        greek_stats  = {name: RunningStats() for name in greeks}
+
         while length_conf_interval > absolute_error and iter_count < MAX_ITER:
-            temp  = simulate(**args)[0]
-            batch_new = payoff(temp)
+            args['n_simulations'] = planner.next(stats)
+            overloads = _specializations(engine) if observer is not None else 0
+            start     = perf_counter()
+            outputs   = engine(**args)
+            simulated = perf_counter()
+            temp      = outputs[0]
+            if counter_rng:
+                args['path_offset'] += args['n_simulations']
+            batch_new, samples = _greek_samples(payoff, temp, state.stock_price, greeks)
+            evaluated = perf_counter()
 
             iter_count+=1
 
-            sigma_n = (sigma_n*(n-1.) + np.var(batch_new)*(4.*batch_size - 1.))/(n + 4.*batch_size - 1.)
-            current_Pt_sum = current_Pt_sum + np.sum(batch_new) 
+            stats.update(batch_new)
+            for name in greeks:
+                greek_stats[name].update(samples[name])
+            planner.record(args['n_simulations'], np.shape(batch_new)[-1], perf_counter() - start)
+            n                    = stats.count
+            length_conf_interval = stats.ci_length(C)
+            if observer is not None:
+                compiled = _specializations(engine) > overloads
+                observer(_batch_event("greeks", iter_count, start, {'compile' if compiled else 'simulate': simulated - start,
+                                                                    'payoff': evaluated - simulated, 'update': perf_counter() - evaluated},
+                                      compiled, outputs, args['n_simulations'], len(batch_new), stats, length_conf_interval,
+                                      absolute_error, run_start))
+
+    elif qmc_replications > 0:
+        if control_variate_payoff is not None:
+            raise error("Randomized QMC does not support control variates.")
+        if qmc_replications < 2:
+            raise ValueError("qmc_replications must be at least 2")
+        from scipy.stats import qmc, t as student_t
+
+        # Sobol points keep their balance properties only in blocks of 2^m
+        batch_size            = 1 << int(np.ceil(np.log2(batch_size if batch_size is not None else 10_000)))
+        planner               = BatchPlanner(N_T, absolute_error, C, batch_size)
+        args['n_simulations'] = batch_size
+        B                     = path_construction_matrix(N_T - 1, qmc_ordering)
+        sobols                = [qmc.Sobol(2*(N_T - 1), scramble=True, seed=np.random.default_rng(rng))
+                                 for rng in np.random.SeedSequence(random_seed).spawn(qmc_replications)]
+        replications          = [RunningStats() for _ in range(qmc_replications)]
+        # few replications: the replication means are Student-distributed, not normal
+        C                     = -2*student_t.ppf(confidence_level*0.5, max(qmc_replications - 1, 1))
+
+        while length_conf_interval > absolute_error and iter_count < MAX_ITER:
+            overloads = _specializations(simulate) if observer is not None else 0
+            start     = perf_counter()
+            spans     = {'rng': 0., 'simulate': 0., 'payoff': 0.}
+            paths     = 0
+            for sobol, replication in zip(sobols, replications):
+                t_0             = perf_counter()
+                args['normals'] = sobol_normals(sobol, batch_size, N_T, B)
+                t_1             = perf_counter()
+                outputs         = simulate(**args)
+                t_2             = perf_counter()
+                batch_new       = payoff(outputs[0])
+                replication.update(batch_new)
+                spans['rng']      += t_1 - t_0
+                spans['simulate'] += t_2 - t_1
+                spans['payoff']   += perf_counter() - t_2
+                paths             += len(batch_new)
+
+            iter_count          += 1
+            planner.batches.append((batch_size, None))
+
+            stats                = RunningStats.from_batch(np.array([replication.mean for replication in replications]))
+            n                    = sum(replication.count for replication in replications)
+            length_conf_interval = C * sqrt(stats.M2 / (qmc_replications - 1.) / qmc_replications)
+            if observer is not None:
+                compiled = _specializations(simulate) > overloads
+                if compiled:
+                    spans['compile'] = spans.pop('simulate')
+                observer(_batch_event("qmc", iter_count, start, spans, compiled, (*outputs, args['normals']), batch_size*qmc_replications,
+                                      paths, RunningStats(n, stats.mean, stats.M2), length_conf_interval, absolute_error, run_start))
+
+    elif control_variate_payoff is None:
+        while length_conf_interval > absolute_error and iter_count < MAX_ITER:
+            args['n_simulations'] = planner.next(stats)
+            overloads = _specializations(simulate) if observer is not None else 0
+            start     = perf_counter()
+            outputs   = simulate(**args)
+            simulated = perf_counter()
+            temp      = outputs[0]
+            if counter_rng:
+                args['path_offset'] += args['n_simulations']
+            batch_new = payoff(temp)
+            evaluated = perf_counter()
+
+            iter_count+=1
 
-            n+=4*batch_size
-            length_conf_interval = C * sqrt(sigma_n / n)
+            stats.update(batch_new)
+            planner.record(args['n_simulations'], np.shape(batch_new)[-1], perf_counter() - start)
+            n                    = stats.count
+            length_conf_interval = stats.ci_length(C)
+            if observer is not None:
+                compiled = _specializations(simulate) > overloads
+                observer(_batch_event("mc", iter_count, start, {'compile' if compiled else 'simulate': simulated - start,
+                                                                'payoff': evaluated - simulated, 'update': perf_counter() - evaluated},
+                                      compiled, outputs, args['n_simulations'], temp.shape[0], stats, length_conf_interval,
+                                      absolute_error, run_start))
     else:
-        if mu == None:
+        controls = list(control_variate_payoff) if isinstance(control_variate_payoff, (list, tuple)) else [control_variate_payoff]
+        mus      = list(mu) if isinstance(mu, (list, tuple, np.ndarray)) else [mu]*len(controls)
+        if len(mus) != len(controls):
+            raise ValueError("mu must give one mean per control variate payoff.")
+        mus      = [m if m is not None else control_variate_mean(c, state, heston_params, T, N_T) for c, m in zip(controls, mus)]
+        if any(m is None for m in mus):
             return "NaN"
+        mus = np.array(mus, dtype=np.float64)
 
-        S = simulate(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = control_variate_iter)[0]
-        s1 = payoff(S)
-        s2 = control_variate_payoff(S)
-        c = np.cov(s1, s2)
-        theta = c[0, 1] / c[1, 1]
+        joint = RunningCovariance()
+        theta = np.zeros(len(controls))
+        args['n_simulations'] = control_variate_iter
         while length_conf_interval > absolute_error and iter_count < MAX_ITER:
-            temp  = simulate(**args)[0]
-            batch_new = payoff(temp) - theta * (control_variate_payoff(temp) - mu)
+            overloads = _specializations(simulate) if observer is not None else 0
+            start     = perf_counter()
+            outputs   = simulate(**args)
+            simulated = perf_counter()
+            temp      = outputs[0]
+            if counter_rng:
+                args['path_offset'] += args['n_simulations']
+            samples   = np.vstack([payoff(temp)] + [control(temp) for control in controls])
+            evaluated = perf_counter()
+            joint.update(samples)
             iter_count+=1
 
-            sigma_n = (sigma_n*(n-1.) + np.var(batch_new)*(4*batch_size - 1.))/(n + 4*batch_size - 1.)
-            current_Pt_sum = current_Pt_sum + np.sum(batch_new) 
-
-            n+=4*batch_size
-            length_conf_interval = C * np.sqrt(sigma_n / n)
+            stats, theta = joint.regression(mus)
+            planner.record(args['n_simulations'], samples.shape[1], perf_counter() - start)
+            n_simulations         = args['n_simulations']
+            args['n_simulations'] = planner.next(stats)
+            n                    = stats.count
+            length_conf_interval = stats.ci_length(C)
+            if observer is not None:
+                compiled = _specializations(simulate) > overloads
+                observer(_batch_event("control_variate", iter_count, start, {'compile' if compiled else 'simulate': simulated - start,
+                                                                             'payoff': evaluated - simulated, 'update': perf_counter() - evaluated},
+                                      compiled, outputs, n_simulations, temp.shape[0], stats, length_conf_interval,
+                                      absolute_error, run_start))
 
     if verbose:
         if random_seed is not None:
             print(f"Random seed:                {random_seed}")
 
         if control_variate_payoff is not None:
-            print(f"Control variate payoff:     {control_variate_payoff.__name__}")
+            for control, m, coefficient in zip(controls, mus, theta):
+                print(f"Control variate payoff:     {control.__name__} (mean {m:.6f}, coefficient {coefficient:.6f})")
             print(f"Control variate iterations: {control_variate_iter}")
+            print(f"Variance reduction factor:  {joint.M[0, 0]/max(stats.M2, 1e-300):.2f}")
+
+        if qmc_replications > 0:
+            print(f"QMC replications:           {qmc_replications} ({qmc_ordering} ordering)")
         
+        print(planner.report())
         print(f"Number of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {n}\nAbsolute error:             {absolute_error}\nLength of the conf intl:    {length_conf_interval}\nConfidence level:           {confidence_level}\n")
 
-    return current_Pt_sum/n
+        if greeks is not None:
+            for name in greeks:
+                print(f"{name + ':':<28}{greek_stats[name].mean:.6f} +- {0.5*greek_stats[name].ci_length(C):.6f}")
+            print()
+
+    if observer is not None:
+        observer({'event':          "done",
+                  'iterations':     iter_count,
+                  'n':              int(np.max(n)),
+                  'mean':           np.asarray(stats.mean).tolist(),
+                  'ci_length':      float(np.max(length_conf_interval)),
+                  'absolute_error': absolute_error,
+                  'converged':      bool(np.all(length_conf_interval <= absolute_error)),
+                  'seconds':        perf_counter() - run_start})
+
+    if greeks is not None:
+        return stats.mean, {name: (greek_stats[name].mean, greek_stats[name].ci_length(C)) for name in greeks}
+
+    if full_output:
+        return stats.mean, stats, args.get('path_offset', path_offset)
+
+    return stats.mean
 
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_euler(state:           MarketState,
                           heston_params:   HestonParameters,
                           T:               float = 1.,
                           N_T:             int   = 100,
-                          n_simulations:   int   = 10_000
+                          n_simulations:   int   = 10_000,
+                          seed:            int   = -1,
+                          path_offset:     int   = 0,
+                          normals:         np.ndarray = None,
+                          dtype                       = np.float64
                           ) -> np.ndarray:
     """Simulation engine for the Heston model using the Euler scheme.
     Args:
@@ -172,6 +862,11 @@ def simulate_heston_euler(state:           MarketState,
         T (float, optional):              Contract termination time expressed as a number of years. Defaults to 1..
         N_T (int, optional):              Number of steps in time. Defaults to 100.
         n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        normals (np.ndarray, optional):   Standard normals of shape (2, n_simulations, N_T) to drive the paths with, e.g. from sobol_normals. Defaults to None.
+        dtype (optional):                 Floating-point type of the paths, np.float64 or np.float32; in single precision the paths, 
+                                          the normals and the step arithmetic take half the memory traffic. Defaults to np.float64.
     Raises:
         error: Contract termination time must be positive.
     Returns:
@@ -181,43 +876,48 @@ def simulate_heston_euler(state:           MarketState,
     if T <= 0:
         raise error("Contract termination time must be positive.")
     
-    r, s0 = state.interest_rate, state.stock_price
-    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    r, s0 = dtype(state.interest_rate), state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, dtype(heston_params.rho), dtype(heston_params.kappa), dtype(heston_params.vbar), dtype(heston_params.gamma)
     
-    dt         = T/float(N_T)
+    dt         = dtype(T/float(N_T))
+    zero, half = dtype(0.), dtype(0.5)
     
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
-    V          = np.empty((4*n_simulations, N_T))
+    if normals is None:
+        Z      = _standard_normal_tensor(seed, path_offset, n_simulations, N_T, dtype)
+    else:
+        Z      = np.asarray(normals, dtype)
+    V          = np.empty((4*n_simulations, N_T), dtype)
     V[:, 0]    = v0
     
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
+    # log-returns log(S/s0): they start at 0, so single precision does not round the increments to the spacing of log(s0)
+    logS       = np.empty((4*n_simulations, N_T), dtype)
+    logS[:, 0] = 0.
 
-    sqrt1_rho2 = sqrt(1-rho**2)
+    sqrt1_rho2 = dtype(sqrt(1-rho**2))
 
     for n in prange(n_simulations):
         for i in range(0,  N_T-1):
-            vmax             = max(V[4*n, i],0)
+            vmax             = max(V[4*n, i], zero)
             sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n, i+1]   = logS[4*n, i] + (r - 0.5 * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
+            logS[4*n, i+1]   = logS[4*n, i] + (r - half * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
             V[4*n, i+1]      = V[4*n, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(rho*Z[0, n, i]+sqrt1_rho2*Z[1, n, i])
 
-            vmax             = max(V[4*n+1, i],0)
+            vmax             = max(V[4*n+1, i], zero)
             sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+1, i+1] = logS[4*n+1, i] + (r - 0.5 * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
+            logS[4*n+1, i+1] = logS[4*n+1, i] + (r - half * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
             V[4*n+1, i+1]    = V[4*n+1, i] + kappa*(vbar - vmax)*dt - gamma*sqrtvmaxdt*(rho*Z[0, n, i]+sqrt1_rho2*Z[1, n, i])
 
-            vmax             = max(V[4*n+2, i],0)
+            vmax             = max(V[4*n+2, i], zero)
             sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+2, i+1] = logS[4*n+2, i] + (r - 0.5 * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
+            logS[4*n+2, i+1] = logS[4*n+2, i] + (r - half * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
             V[4*n+2, i+1]    = V[4*n+2, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(rho*Z[0, n, i]-sqrt1_rho2*Z[1, n, i])
 
-            vmax             = max(V[4*n+3, i],0)
+            vmax             = max(V[4*n+3, i], zero)
             sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+3, i+1] = logS[4*n+3, i] + (r - 0.5 * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
+            logS[4*n+3, i+1] = logS[4*n+3, i] + (r - half * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
             V[4*n+3, i+1]    = V[4*n+3, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(-rho*Z[0, n, i] + sqrt1_rho2*Z[1, n, i])
 
-    return [np.exp(logS), V]
+    return [dtype(s0)*np.exp(logS), V]
 
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_andersen_qe(state:         MarketState,
@@ -226,7 +926,12 @@ def simulate_heston_andersen_qe(state:         MarketState,
                                 N_T:           int   = 100,
                                 n_simulations: int   = 10_000,
                                 Psi_c:         float = 1.5,
-                                gamma_1:       float = 0.0     
+                                gamma_1:       float = 0.0,
+                                seed:          int   = -1,
+                                path_offset:   int   = 0,
+                                normals:       np.ndarray = None,
+                                block_size:    int   = 0,
+                                dtype                = np.float64
                                 ) -> np.ndarray: 
     """Simulation engine for the Heston model using the Quadratic-Exponential Andersen scheme.
 
@@ -238,6 +943,13 @@ def simulate_heston_andersen_qe(state:         MarketState,
         n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
         Psi_c (float, optional):          Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
         gamma_1 (float, optional):        Integration parameter. Defaults to 0.5.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        normals (np.ndarray, optional):   Standard normals of shape (2, n_simulations, N_T) to drive the paths with, e.g. from sobol_normals. Defaults to None.
+        block_size (int, optional):       If positive, the paths are stepped forward together in blocks of this many paths by the 
+                                          time-major kernel _simulate_andersen_blocked; the paths are the same. Defaults to 0.
+        dtype (optional):                 Floating-point type of the paths, np.float64 or np.float32; in single precision the paths, 
+                                          the normals and the step arithmetic take half the memory traffic. Defaults to np.float64.
 
     Raises:
         Error: The critical value \psi_c must be in the interval [1,2]
@@ -268,18 +980,29 @@ def simulate_heston_andersen_qe(state:         MarketState,
     K_3        = gamma_1 * dt * (1.0 - rho**2)
     K_4        = gamma_2 * dt * (1.0 - rho**2)
         
-    V          = np.empty((4*n_simulations, N_T))
-    V[:, 0]    = v0
-
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
-
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
+    if normals is None:
+        Z      = _standard_normal_tensor(seed, path_offset, n_simulations, N_T, dtype)
+    else:
+        Z      = np.asarray(normals, dtype)
     p1         = (1. - E)*(gamma**2)*E/kappa
     p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
     p3         = vbar * (1.- E)
     rdtK0      = r*dt + K_0
 
+    E, p1, p2, p3, rdtK0        = dtype(E), dtype(p1), dtype(p2), dtype(p3), dtype(rdtK0)
+    K_1, K_2, K_3, K_4          = dtype(K_1), dtype(K_2), dtype(K_3), dtype(K_4)
+    zero, one, two              = dtype(0.), dtype(1.), dtype(2.)
+
+    if block_size > 0:
+        return _simulate_andersen_blocked(dtype(s0), v0, Z, N_T, rdtK0, K_1, K_2, K_3, K_4, E, p1, p2, p3, Psi_c, 
+                                          None, None, None, block_size)
+
+    V          = np.empty((4*n_simulations, N_T), dtype)
+    V[:, 0]    = v0
+    # log-returns log(S/s0): they start at 0, so single precision does not round the increments to the spacing of log(s0)
+    logS       = np.empty((4*n_simulations, N_T), dtype)
+    logS[:, 0] = 0.
+
     u = 0.
 
     for n in prange(n_simulations):
@@ -289,93 +1012,185 @@ def simulate_heston_andersen_qe(state:         MarketState,
             Psi = s_2/(m**2) 
 
             if Psi <= Psi_c:
-                c           = 2. / Psi
-                b           = c - 1. + sqrt(c*(c - 1.))
-                a           = m/(1.+b)
+                c           = two / Psi
+                b           = c - one + sqrt(c*(c - one))
+                a           = m/(one+b)
                 b           = sqrt(b)
                 V[4*n, i+1] = a*((b+Z[1, n, i])**2)
             else:
-                p           = (Psi - 1)/(Psi + 1)
-                beta        = (1.0 - p)/m
+                p           = (Psi - one)/(Psi + one)
+                beta        = (one - p)/m
                 u           = Phi(Z[1, n, i])
-                V[4*n,i+1]  = 0. if u < p else log((1-p)/(1-u))/beta
+                V[4*n,i+1]  = zero if u < p else log((1-p)/(1-u))/beta
 
-            logS[4*n,i+1] = logS[4*n,i] + rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0,n,i]
+            logS[4*n,i+1] = logS[4*n,i] + (rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0,n,i])
 
             m   = p3 + V[4*n+1, i]*E
             s_2 = V[4*n+1, i]*p1 + p2
             Psi = s_2/(m**2) 
 
             if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
+                c             = two / Psi
+                b             = c - one + sqrt(c*(c - one))
+                a             = m/(one+b)
                 b             = sqrt(b)
                 V[4*n+1, i+1] = a*((b-Z[1,n, i])**2)
             else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
+                p             = (Psi - one)/(Psi + one)
+                beta          = (one - p)/m
                 u             = Phi(- Z[1, n, i])
-                V[4*n+1,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
+                V[4*n+1,i+1]  = zero if u < p else log((1.-p)/(1.-u))/beta
 
-            logS[4*n+1,i+1] = logS[4*n+1,i] + rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i]
+            logS[4*n+1,i+1] = logS[4*n+1,i] + (rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i])
 
             m   = p3 + V[4*n+2, i]*E
             s_2 = V[4*n+2, i]*p1 + p2
             Psi = s_2/(m**2)
 
             if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
+                c             = two / Psi
+                b             = c - one + sqrt(c*(c - one))
+                a             = m/(one+b)
                 b             = sqrt(b)
                 V[4*n+2, i+1] = a*((b-Z[1,n, i])**2)
             else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
+                p             = (Psi - one)/(Psi + one)
+                beta          = (one - p)/m
                 u             = Phi(- Z[1, n, i])
-                V[4*n+2,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
+                V[4*n+2,i+1]  = zero if u < p else log((1.-p)/(1.-u))/beta
 
-            logS[4*n+2,i+1] = logS[4*n+2,i] + rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i]
+            logS[4*n+2,i+1] = logS[4*n+2,i] + (rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i])
 
             m   = p3 + V[4*n+3, i]*E
             s_2 = V[4*n+3, i]*p1 + p2
             Psi = s_2/(m**2)
 
             if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
+                c             = two / Psi
+                b             = c - one + sqrt(c*(c - one))
+                a             = m/(one+b)
                 b             = sqrt(b)
                 V[4*n+3, i+1] = a*((b+Z[1,n, i])**2)
             else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
+                p             = (Psi - one)/(Psi + one)
+                beta          = (one - p)/m
                 u             = Phi(Z[1, n, i])
-                V[4*n+3,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
+                V[4*n+3,i+1]  = zero if u < p else log((1.-p)/(1.-u))/beta
 
-            logS[4*n+3,i+1] = logS[4*n+3,i] + rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i]
+            logS[4*n+3,i+1] = logS[4*n+3,i] + (rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i])
            
-    return [np.exp(logS), V]
+    return [dtype(s0)*np.exp(logS), V]
+
+@njit(cache=True, nogil=True)
+def _tg_r(psi:     float,
+          tol:     float = 1e-12,
+          maxiter: int   = 200) -> float:
+    # root r of E[((r+Z)^+)^2] = (1+Psi) E[(r+Z)^+]^2; the left-hand side minus the right-hand side is positive for 
+    # r -> -inf and negative beyond 1/sqrt(Psi), so the Newton steps are safeguarded by bisection
+    lo, hi = -10., 2./sqrt(psi) + 5.
+    r      = min(1./sqrt(psi), 0.5*(lo + hi))
+
+    for _ in range(maxiter):
+        phi    = exp(-0.5*r**2)/sqrt(2.*pi)
+        Phi_r  = Phi(r)
+        first  = phi + r*Phi_r
+        h      = r*phi + (1. + r**2)*Phi_r - (1. + psi)*first**2
+        if h > 0.:
+            lo = r
+        else:
+            hi = r
+
+        dh     = 2.*first*(1. - (1. + psi)*Phi_r)
+        r_new  = r - h/dh if dh != 0. else lo - 1.
+        if not lo < r_new < hi:
+            r_new = 0.5*(lo + hi)
+        if abs(r_new - r) <= tol*max(1., abs(r)):
+            return r_new
+        r = r_new
+
+    return r
 
 def calculate_r_for_andersen_tg(x_:      float,
                                 maxiter: int = 2500, 
                                 tol:     float = 1e-5
                                 ):
-    def foo(x: float):
-        return x*norm.pdf(x) + norm.cdf(x)*(1+x**2) - (1+x_)*(norm.pdf(x) + x*norm.cdf(x))**2
-
-    def foo_dif(x: float):
-        return norm.pdf(x) - x**2 * norm.pdf(x) + norm.pdf(x)*(1+x**2) + 2*norm.cdf(x)*x - \
-                2*(1+x_)*(norm.pdf(x) + x*norm.cdf(x))*(-norm.pdf(x)*x + norm.cdf(x) + x*norm.pdf(x) )
+    """Root r(Psi) of the moment-matching equation of the Truncated Gaussian scheme (see tg_lookup_tables)."""
+    return _tg_r(x_, tol, maxiter)
 
-    def foo_dif2(x: float):
-        return -x*norm.pdf(x) - 2*x* norm.pdf(x) + x**3 * norm.pdf(x) -x*norm.pdf(x)*(1+x**2) + \
-                2*norm.cdf(x)*x + 2*norm.pdf(x)*x + 2*norm.cdf(x) + \
-                2*(1+x_)*(-norm.pdf(x)*x + norm.cdf(x) + x*norm.pdf(x))**2 + \
-                2*(1+x_)*(norm.pdf(x) + x*norm.cdf(x))*(x**2*norm.pdf(x) + norm.pdf(x) + norm.pdf(x) -x*norm.pdf(x) )
+@njit(parallel=True, cache=True, nogil=True)
+def _tg_table(x_grid: np.ndarray) -> np.ndarray:
+    table    = np.empty((3, x_grid.shape[0]))
+    table[0] = x_grid
+
+    for q in prange(x_grid.shape[0]):
+        psi = x_grid[q]
+        if psi <= 0.:
+            # limits of f_nu and f_sigma as r(Psi) -> +inf
+            table[1, q] = 1.
+            table[2, q] = 1.
+            continue
+        r           = _tg_r(psi)
+        first       = exp(-0.5*r**2)/sqrt(2.*pi) + r*Phi(r)
+        table[1, q] = r/first
+        table[2, q] = 1./(sqrt(psi)*first)
+
+    return table
+
+# Per-user cache of the generated tables, so that read-only installs work and the sources stay clean; 
+# HESTONMC_CACHE_DIR overrides it.
+TG_CACHE_DIR = os.environ.get("HESTONMC_CACHE_DIR",
+                              os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "hestonmc"))
+
+def tg_lookup_tables(psi_max:   float = 100.,
+                     n_points:  int   = 4096,
+                     cache_dir: str   = TG_CACHE_DIR) -> dict:
+    """Lookup tables of f_nu(Psi) and f_sigma(Psi) for the Truncated Gaussian scheme, to be passed as **kwargs to
+    simulate_heston_andersen_tg(_streaming).
+
+    The grid is Psi_i = psi_max*(i/(n_points-1))^2, dense near small Psi, and the engines interpolate linearly between
+    its points; 4096 points reproduce the functions to about 1e-6. The table is solved in one parallel batch and saved
+    under cache_dir keyed by (psi_max, n_points); later calls memory-map the file instead of solving again.
+    Args:
+        psi_max (float, optional):  Largest tabulated Psi; larger values use the last point. Defaults to 100..
+        n_points (int, optional):   Number of grid points. Defaults to 4096.
+        cache_dir (str, optional):  Directory of the on-disk cache, None to disable it. Defaults to TG_CACHE_DIR.
+    Returns:
+        A dict with the keys x_grid, f_nu_grid and f_sigma_grid.
+    """
+    path  = None if cache_dir is None else os.path.join(cache_dir, f"tg_table start=0 stop={psi_max:g} N={n_points}.npy")
 
-    return newton(foo,  x0 = 1/x_,fprime = foo_dif, fprime2 = foo_dif2, maxiter = maxiter , tol= tol )
+    if path is not None and os.path.exists(path):
+        table = np.load(path, mmap_mode='r')
+    else:
+        table = _tg_table(psi_max*np.linspace(0., 1., n_points)**2)
+        if path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # write to a temporary file first so that concurrent readers never see a partial table
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    np.save(f, table)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    return {'x_grid': table[0], 'f_nu_grid': table[1], 'f_sigma_grid': table[2]}
+
+@njit(cache=True, nogil=True)
+def _tg_moments(m, s_2, x_grid, f_nu_grid, f_sigma_grid):
+    # mean and standard deviation of the Gaussian before truncation, with f_nu and f_sigma interpolated linearly 
+    # in Psi on an increasing (possibly non-uniform) grid and held constant outside of it
+    Psi  = s_2/(m**2)
+    last = x_grid.shape[0] - 1
+
+    if Psi >= x_grid[last]:
+        return m*f_nu_grid[last], sqrt(s_2)*f_sigma_grid[last]
+    if Psi <= x_grid[0]:
+        return m*f_nu_grid[0], sqrt(s_2)*f_sigma_grid[0]
+
+    inx = np.searchsorted(x_grid, Psi) - 1
+    w   = (Psi - x_grid[inx])/(x_grid[inx+1] - x_grid[inx])
+    return m*((1. - w)*f_nu_grid[inx] + w*f_nu_grid[inx+1]), sqrt(s_2)*((1. - w)*f_sigma_grid[inx] + w*f_sigma_grid[inx+1])
 
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_andersen_tg(state:         MarketState,
@@ -386,20 +1201,32 @@ def simulate_heston_andersen_tg(state:         MarketState,
                                 T:             float = 1.,
                                 N_T:           int   = 100,
                                 n_simulations: int   = 10_000,
-                                gamma_1:       float = 0.0
+                                gamma_1:       float = 0.0,
+                                seed:          int   = -1,
+                                path_offset:   int   = 0,
+                                normals:       np.ndarray = None,
+                                block_size:    int   = 0,
+                                dtype                = np.float64
                                 ) -> np.ndarray: 
     """ Simulation engine for the Heston model using the Truncated Gaussian Andersen scheme.
 
     Args:
         state (MarketState):              Market state.
         heston_params (HestonParameters): Parameters of the Heston model.
-        x_grid (np.ndarray):              _description_
-        f_nu_grid (np.ndarray):           _description_
-        f_sigma_grid (np.ndarray):        _description_
+        x_grid (np.ndarray):              Increasing grid of \psi values (see tg_lookup_tables).
+        f_nu_grid (np.ndarray):           Values of f_\nu on x_grid.
+        f_sigma_grid (np.ndarray):        Values of f_\sigma on x_grid.
         T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
         dt (float, optional):             Time step. Defaults to 1e-2.
         n_simulations (int, optional):    number of the simulations. Defaults to 10_000.
         gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        normals (np.ndarray, optional):   Standard normals of shape (2, n_simulations, N_T) to drive the paths with, e.g. from sobol_normals. Defaults to None.
+        block_size (int, optional):       If positive, the paths are stepped forward together in blocks of this many paths by the 
+                                          time-major kernel _simulate_andersen_blocked; the paths are the same. Defaults to 0.
+        dtype (optional):                 Floating-point type of the paths, np.float64 or np.float32; in single precision the paths, 
+                                          the normals and the step arithmetic take half the memory traffic. Defaults to np.float64.
 
     Raises:
         error: The parameter \gamma_1 must be in the interval [0,1].
@@ -426,70 +1253,1243 @@ def simulate_heston_andersen_tg(state:         MarketState,
     K_3        = gamma_1 * dt * (1.0 - rho**2)
     K_4        = gamma_2 * dt * (1.0 - rho**2)
         
-    V          = np.empty((4*n_simulations, N_T))
-    V[:, 0]    = v0
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
-
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
+    if normals is None:
+        Z      = _standard_normal_tensor(seed, path_offset, n_simulations, N_T, dtype)
+    else:
+        Z      = np.asarray(normals, dtype)
     p1         = (1. - E)*(gamma**2)*E/kappa
     p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
     p3         = vbar * (1.- E)
     rdtK0      = r*dt + K_0
-    dx         = x_grid[1] - x_grid[0]
+
+    E, p1, p2, p3, rdtK0        = dtype(E), dtype(p1), dtype(p2), dtype(p3), dtype(rdtK0)
+    K_1, K_2, K_3, K_4          = dtype(K_1), dtype(K_2), dtype(K_3), dtype(K_4)
+    zero, one, two              = dtype(0.), dtype(1.), dtype(2.)
+
+    x_grid, f_nu_grid, f_sigma_grid = x_grid.astype(dtype), f_nu_grid.astype(dtype), f_sigma_grid.astype(dtype)
+
+    if block_size > 0:
+        return _simulate_andersen_blocked(dtype(s0), v0, Z, N_T, rdtK0, K_1, K_2, K_3, K_4, E, p1, p2, p3, zero, 
+                                          x_grid, f_nu_grid, f_sigma_grid, block_size)
+
+    V          = np.empty((4*n_simulations, N_T), dtype)
+    V[:, 0]    = v0
+    # log-returns log(S/s0): they start at 0, so single precision does not round the increments to the spacing of log(s0)
+    logS       = np.empty((4*n_simulations, N_T), dtype)
+    logS[:, 0] = 0.
     
     for n in prange(n_simulations):
         for i in range(N_T - 1):
             m               = p3 + V[4*n, i]*E
             s_2             = V[4*n, i]*p1 + p2
-            Psi             = s_2/(m**2) 
+            nu, sigma       = _tg_moments(m, s_2, x_grid, f_nu_grid, f_sigma_grid)
 
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx         = int(Psi/dx)
-        
-            nu              = m*f_nu_grid[inx]
-            sigma           = sqrt(s_2)*f_sigma_grid[inx]
-
-            V[4*n, i+1]     = max(nu + sigma*Z[1, n, i], 0)
-            logS[4*n,i+1]   = logS[4*n,i] + rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0, n,i]
+            V[4*n, i+1]     = max(nu + sigma*Z[1, n, i], zero)
+            logS[4*n,i+1]   = logS[4*n,i] + (rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0, n,i])
 
             m               = p3 + V[4*n+1, i]*E
             s_2             = V[4*n+1, i]*p1 + p2
-            Psi             = s_2/(m**2) 
+            nu, sigma       = _tg_moments(m, s_2, x_grid, f_nu_grid, f_sigma_grid)
 
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx         = int(Psi/dx)
-        
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
+            V[4*n+1,i+1]    = max(nu - sigma*Z[1, n, i], zero)
+            logS[4*n+1,i+1] = logS[4*n+1,i] + (rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i])
 
-            V[4*n+1,i+1]    = max(nu - sigma*Z[1, n, i], 0)
-            logS[4*n+1,i+1] = logS[4*n+1,i] + rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i]
-            
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
+            m               = p3 + V[4*n+2, i]*E
+            s_2             = V[4*n+2, i]*p1 + p2
+            nu, sigma       = _tg_moments(m, s_2, x_grid, f_nu_grid, f_sigma_grid)
+
+            V[4*n+2,i+1]    = max(nu - sigma*Z[1, n, i], zero)
+            logS[4*n+2,i+1] = logS[4*n+2,i] + (rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i])
+
+            m               = p3 + V[4*n+3, i]*E
+            s_2             = V[4*n+3, i]*p1 + p2
+            nu, sigma       = _tg_moments(m, s_2, x_grid, f_nu_grid, f_sigma_grid)
+
+            V[4*n+3,i+1]    = max(nu + sigma*Z[1, n, i], zero)
+            logS[4*n+3,i+1] = logS[4*n+3,i] + (rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i])
+
+    return [dtype(s0)*np.exp(logS), V]
+
+# Signs applied to (Z_S, Z_V) for the four antithetic copies of a path, in the order used by the full-path engines.
+ANTITHETIC_SIGNS = np.array([[1., 1.], [-1., -1.], [1., -1.], [-1., 1.]])
+
+@njit(cache=True, nogil=True)
+def _euler_step(logS, v, dt, r, kappa, vbar, gamma, z_s, z_v):
+    vmax       = max(v, 0.)
+    sqrtvmaxdt = sqrt(vmax*dt)
+    return logS + (r - 0.5 * vmax) * dt + sqrtvmaxdt * z_s, v + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*z_v
+
+@njit(cache=True, nogil=True)
+def _qe_variance_step(v, z_v, E, p1, p2, p3, Psi_c):
+    m   = p3 + v*E
+    s_2 = v*p1 + p2
+    Psi = s_2/(m**2)
+
+    if Psi <= Psi_c:
+        c = 2. / Psi
+        b = c - 1. + sqrt(c*(c - 1.))
+        a = m/(1.+b)
+        b = sqrt(b)
+        return a*((b + z_v)**2)
+
+    p    = (Psi - 1.)/(Psi + 1.)
+    beta = (1.0 - p)/m
+    u    = Phi(z_v)
+    return 0. if u < p else log((1.-p)/(1.-u))/beta
+
+@njit(cache=True, nogil=True)
+def _tg_variance_step(v, z_v, E, p1, p2, p3, x_grid, f_nu_grid, f_sigma_grid):
+    nu, sigma = _tg_moments(p3 + v*E, v*p1 + p2, x_grid, f_nu_grid, f_sigma_grid)
+    return max(nu + sigma*z_v, 0.)
+
+@njit(cache=True, nogil=True)
+def _andersen_log_step(logS, v, v_next, rdtK0, K_1, K_2, K_3, K_4, z_s):
+    return logS + (rdtK0 + K_1*v + K_2*v_next + sqrt(K_3*v + K_4*v_next) * z_s)
+
+@njit(parallel=True, cache=True, nogil=True)
+def _simulate_andersen_blocked(s0, v0, Z, N_T, rdtK0, K_1, K_2, K_3, K_4, E, p1, p2, p3, Psi_c,
+                               x_grid, f_nu_grid, f_sigma_grid, block_size):
+    """Time-major kernel of the QE (x_grid is None) and TG Andersen schemes.
+
+    The paths are split into blocks of block_size paths distributed over the threads. Within a block, all the 
+    4*block_size lanes (lane 4p + k is path p with the antithetic signs ANTITHETIC_SIGNS[k]) are stepped forward 
+    together, so the state at step i is a contiguous row of the block history and the inner loops run over lanes.
+    For QE the quadratic branch is evaluated for every lane without a jump (a loop LLVM vectorizes) and the lanes 
+    with Psi > Psi_c are then overwritten by the exponential branch, which needs the normal cdf and a logarithm.
+    The history holds the log-returns log(S/s0) and is copied out transposed with the exponential taken on the fly,
+    so the output and the paths are the same as those of the path-by-path kernels."""
+    n_simulations = Z.shape[1]
+    n_blocks      = (n_simulations + block_size - 1) // block_size
+
+    S             = np.empty((4*n_simulations, N_T), Z.dtype)
+    V             = np.empty((4*n_simulations, N_T), Z.dtype)
+
+    for b in prange(n_blocks):
+        lo    = b*block_size
+        B     = min(block_size, n_simulations - lo)
+        W     = 4*B
+        Z_s   = np.empty((N_T, W), Z.dtype)
+        Z_v   = np.empty((N_T, W), Z.dtype)
+        X_blk = np.empty((N_T, W), Z.dtype)
+        V_blk = np.empty((N_T, W), Z.dtype)
+        Psi   = np.empty(W, Z.dtype)
+
+        for q in range(B):
+            for i in range(N_T):
+                for k in range(4):
+                    Z_s[i, 4*q+k] = ANTITHETIC_SIGNS[k, 0]*Z[0, lo+q, i]
+                    Z_v[i, 4*q+k] = ANTITHETIC_SIGNS[k, 1]*Z[1, lo+q, i]
+        X_blk[0, :] = 0.
+        V_blk[0, :] = v0
+
+        for i in range(N_T - 1):
+            x, v, x_next, v_next, z_s, z_v = X_blk[i], V_blk[i], X_blk[i+1], V_blk[i+1], Z_s[i], Z_v[i]
+
+            if x_grid is None:
+                n_exponential = 0
+                for j in range(W):
+                    m         = p3 + v[j]*E
+                    Psi[j]    = (v[j]*p1 + p2)/(m**2)
+                    c         = 2. / Psi[j]
+                    b2        = c - 1. + sqrt(max(c*(c - 1.), 0.))
+                    v_next[j] = m/(1. + b2)*((sqrt(b2) + z_v[j])**2)
+                    n_exponential += Psi[j] > Psi_c
+
+                if n_exponential > 0:
+                    for j in range(W):
+                        if Psi[j] > Psi_c:
+                            m         = p3 + v[j]*E
+                            p         = (Psi[j] - 1.)/(Psi[j] + 1.)
+                            # (1-p)/(1-u) < 1 exactly when u < p, where the exponential branch returns 0
+                            v_next[j] = log(max((1. - p)/(1. - Phi(z_v[j])), 1.))/((1. - p)/m)
             else:
-                inx             = int(Psi/dx)
+                for j in range(W):
+                    nu, sigma = _tg_moments(p3 + v[j]*E, v[j]*p1 + p2, x_grid, f_nu_grid, f_sigma_grid)
+                    v_next[j] = max(nu + sigma*z_v[j], 0.)
+
+            for j in range(W):
+                x_next[j] = x[j] + (rdtK0 + K_1*v[j] + K_2*v_next[j] + sqrt(K_3*v[j] + K_4*v_next[j])*z_s[j])
+
+        for j in range(W):
+            for i in range(N_T):
+                S[4*lo+j, i] = s0*exp(X_blk[i, j])
+                V[4*lo+j, i] = V_blk[i, j]
+
+    return [S, V]
+
+@njit(cache=True, nogil=True)
+def _init_accumulators(A, j, logS):
+    S                      = exp(logS)
+    A[j, ACC_AVERAGE]      = S
+    A[j, ACC_LOG_AVERAGE]  = logS
+    A[j, ACC_MIN]          = S
+    A[j, ACC_MAX]          = S
+
+@njit(cache=True, nogil=True)
+def _update_accumulators(A, j, logS):
+    S                      = exp(logS)
+    A[j, ACC_AVERAGE]     += S
+    A[j, ACC_LOG_AVERAGE] += logS
+    A[j, ACC_MIN]          = min(A[j, ACC_MIN], S)
+    A[j, ACC_MAX]          = max(A[j, ACC_MAX], S)
+
+@njit(cache=True, nogil=True)
+def _update_bridge_extremes(A, j, logS_prev, logS, variance, log_u_max, log_u_min):
+    # Exact draws of the maximum and the minimum of a Brownian bridge of the given variance from logS_prev to logS,
+    # P(max >= m) = exp(-2(m - logS_prev)(m - logS)/variance), so the accumulators are continuously monitored extremes.
+    # The bridge is exact for the Euler scheme, whose log-price has the frozen variance v dt over the step. The QE and
+    # TG schemes sample the integrated variance only through the trapezoidal rule 0.5(v + v_next) dt, and their
+    # log-price is not a Brownian bridge given the endpoints, so for them the extremes are an approximation.
+    d2                     = (logS - logS_prev)**2
+    A[j, ACC_MAX]          = max(A[j, ACC_MAX], exp(0.5*(logS_prev + logS + sqrt(d2 - 2.*variance*log_u_max))))
+    A[j, ACC_MIN]          = min(A[j, ACC_MIN], exp(0.5*(logS_prev + logS - sqrt(d2 - 2.*variance*log_u_min))))
+
+@njit(cache=True, nogil=True)
+def _finalize_accumulators(A, j, logS, N_T):
+    A[j, ACC_TERMINAL]     = exp(logS)
+    A[j, ACC_AVERAGE]     /= N_T
+    A[j, ACC_LOG_AVERAGE] /= N_T
+
+@njit(cache=True, nogil=True)
+def _observation_columns(observation_steps, N_T):
+    obs_col = np.full(N_T, -1, dtype=np.int64)
+    if observation_steps is None:
+        return obs_col
+
+    for c in range(observation_steps.shape[0]):
+        if observation_steps[c] < 0 or observation_steps[c] >= N_T:
+            raise error("Observation steps must lie in [0, N_T).")
+        if obs_col[observation_steps[c]] >= 0:
+            raise error("Observation steps must be distinct.")
+        obs_col[observation_steps[c]] = c
+    return obs_col
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_euler_streaming(state:         MarketState,
+                                    heston_params: HestonParameters,
+                                    T:             float = 1.,
+                                    N_T:           int   = 100,
+                                    n_simulations: int   = 10_000,
+                                    observation_steps: np.ndarray = None,
+                                    seed:              int        = -1,
+                                    path_offset:       int        = 0,
+                                    bridge:            bool       = False
+                                    ) -> np.ndarray:
+    """Streaming simulation engine for the Heston model using the Euler scheme.
+    Only the current state of every path is kept; the normals are drawn step by step and the path is folded into
+    the per-path accumulators (terminal value, average, log-average, running min and max) over the same N_T grid 
+    points as in simulate_heston_euler. Memory usage is O(n_simulations) instead of O(n_simulations*N_T).
+    With bridge set, the running min and max also cover the paths between grid points: the log-price between two
+    grid points is a Brownian bridge with the variance of the step, whose extremes are sampled exactly, so barrier
+    and lookback payoffs are priced under continuous monitoring with a coarse grid (N_T of 20-50).
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a number of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        observation_steps (np.ndarray, optional): Grid indices in [0, N_T) at which the stock price is recorded. Defaults to None.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+    Raises:
+        error: Contract termination time must be positive.
+        error: Observation steps must lie in [0, N_T) and be distinct.
+    Returns:
+        A tuple containing the accumulator matrix of shape (4*n_simulations, N_ACC) (see derivatives.ACC_*), 
+        the terminal stochastic variance and the stock prices at the observation steps of shape 
+        (4*n_simulations, len(observation_steps)). The number of paths is quadrupled to account for the antithetic variates.
+    """    
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+    
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    
+    dt         = T/float(N_T)
+    sqrt1_rho2 = sqrt(1-rho**2)
+    logs0      = log(s0)
+
+    obs_col    = _observation_columns(observation_steps, N_T)
+    A          = np.empty((4*n_simulations, N_ACC))
+    S_obs      = np.empty((4*n_simulations, obs_col.max() + 1))
+    logS       = np.empty(4*n_simulations)
+    V          = np.empty(4*n_simulations)
+
+    for n in prange(n_simulations):
+        log_u_max, log_u_min = 0., 0.
+        for k in range(4):
+            logS[4*n+k] = logs0
+            V[4*n+k]    = v0
+            _init_accumulators(A, 4*n+k, logs0)
+            if obs_col[0] >= 0:
+                S_obs[4*n+k, obs_col[0]] = s0
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                j                = 4*n+k
+                z_s              = ANTITHETIC_SIGNS[k, 0]*Z_0
+                z_v              = rho*z_s + sqrt1_rho2*ANTITHETIC_SIGNS[k, 1]*Z_1
+                logs_prev, v_prev = logS[j], V[j]
+                logS[j], V[j]    = _euler_step(logS[j], V[j], dt, r, kappa, vbar, gamma, z_s, z_v)
+                _update_accumulators(A, j, logS[j])
+                if bridge:
+                    _update_bridge_extremes(A, j, logs_prev, logS[j], max(v_prev, 0.)*dt, log_u_max, log_u_min)
+                if obs_col[i+1] >= 0:
+                    S_obs[j, obs_col[i+1]] = exp(logS[j])
+
+        for k in range(4):
+            _finalize_accumulators(A, 4*n+k, logS[4*n+k], N_T)
+
+    return A, V, S_obs
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_qe_streaming(state:         MarketState,
+                                          heston_params: HestonParameters,
+                                          T:             float = 1.,
+                                          N_T:           int   = 100,
+                                          n_simulations: int   = 10_000,
+                                          Psi_c:         float = 1.5,
+                                          gamma_1:       float = 0.0,
+                                          observation_steps: np.ndarray = None,
+                                          seed:              int        = -1,
+                                          path_offset:       int        = 0,
+                                          bridge:            bool       = False
+                                          ) -> np.ndarray: 
+    """Streaming simulation engine for the Heston model using the Quadratic-Exponential Andersen scheme.
+    See simulate_heston_euler_streaming for the accumulator layout.
+
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        Psi_c (float, optional):          Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        observation_steps (np.ndarray, optional): Grid indices in [0, N_T) at which the stock price is recorded. Defaults to None.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+
+    Raises:
+        Error: The critical value \psi_c must be in the interval [1,2]
+        Error: The parameter \gamma_1 must be in the interval [0,1]
+
+    Returns:
+        A tuple containing the accumulator matrix, the terminal stochastic variance and the observed stock prices.
+    """    
+    if Psi_c>2 or Psi_c<1:
+        raise error('The critical value \psi_c must be in the interval [1,2]')
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
         
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
+    gamma_2 = 1.0 - gamma_1
+    
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    
+    dt         = T/float(N_T)
+    E          = exp(-kappa*dt)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+    p1         = (1. - E)*(gamma**2)*E/kappa
+    p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3         = vbar * (1.- E)
+    rdtK0      = r*dt + K_0
+    logs0      = log(s0)
+
+    obs_col    = _observation_columns(observation_steps, N_T)
+    A          = np.empty((4*n_simulations, N_ACC))
+    S_obs      = np.empty((4*n_simulations, obs_col.max() + 1))
+    logS       = np.empty(4*n_simulations)
+    V          = np.empty(4*n_simulations)
+
+    for n in prange(n_simulations):
+        log_u_max, log_u_min = 0., 0.
+        for k in range(4):
+            logS[4*n+k] = logs0
+            V[4*n+k]    = v0
+            _init_accumulators(A, 4*n+k, logs0)
+            if obs_col[0] >= 0:
+                S_obs[4*n+k, obs_col[0]] = s0
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                j       = 4*n+k
+                v_next  = _qe_variance_step(V[j], ANTITHETIC_SIGNS[k, 1]*Z_1, E, p1, p2, p3, Psi_c)
+                logs_prev = logS[j]
+                logS[j]   = _andersen_log_step(logS[j], V[j], v_next, rdtK0, K_1, K_2, K_3, K_4, ANTITHETIC_SIGNS[k, 0]*Z_0)
+                _update_accumulators(A, j, logS[j])
+                if bridge:
+                    # approximate bridge variance of the QE/TG step, see _update_bridge_extremes
+                    _update_bridge_extremes(A, j, logs_prev, logS[j], 0.5*(V[j] + v_next)*dt, log_u_max, log_u_min)
+                V[j]      = v_next
+                if obs_col[i+1] >= 0:
+                    S_obs[j, obs_col[i+1]] = exp(logS[j])
+
+        for k in range(4):
+            _finalize_accumulators(A, 4*n+k, logS[4*n+k], N_T)
+
+    return A, V, S_obs
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_tg_streaming(state:         MarketState,
+                                          heston_params: HestonParameters,
+                                          x_grid:        np.ndarray,
+                                          f_nu_grid:     np.ndarray,
+                                          f_sigma_grid:  np.ndarray,
+                                          T:             float = 1.,
+                                          N_T:           int   = 100,
+                                          n_simulations: int   = 10_000,
+                                          gamma_1:       float = 0.0,
+                                          observation_steps: np.ndarray = None,
+                                          seed:              int        = -1,
+                                          path_offset:       int        = 0,
+                                          bridge:            bool       = False
+                                          ) -> np.ndarray: 
+    """Streaming simulation engine for the Heston model using the Truncated Gaussian Andersen scheme.
+    See simulate_heston_euler_streaming for the accumulator layout.
+
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        x_grid (np.ndarray):              Increasing grid of \psi values (see tg_lookup_tables).
+        f_nu_grid (np.ndarray):           Values of f_\nu on x_grid.
+        f_sigma_grid (np.ndarray):        Values of f_\sigma on x_grid.
+        T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        observation_steps (np.ndarray, optional): Grid indices in [0, N_T) at which the stock price is recorded. Defaults to None.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+
+    Raises:
+        error: The parameter \gamma_1 must be in the interval [0,1].
+        error: Contract termination time must be positive.
 
-            V[4*n+2,i+1]    = max(nu - sigma*Z[1, n, i], 0)
-            logS[4*n+2,i+1] = logS[4*n+2,i] + rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i]
+    Returns:
+        A tuple containing the accumulator matrix, the terminal stochastic variance and the observed stock prices.
+    """    
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
             
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    
+    gamma_2    = 1. - gamma_1
+    dt         = T/float(N_T)
+    E          = exp(-kappa*dt)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+    p1         = (1. - E)*(gamma**2)*E/kappa
+    p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3         = vbar * (1.- E)
+    rdtK0      = r*dt + K_0
+    logs0      = log(s0)
+
+    obs_col    = _observation_columns(observation_steps, N_T)
+    A          = np.empty((4*n_simulations, N_ACC))
+    S_obs      = np.empty((4*n_simulations, obs_col.max() + 1))
+    logS       = np.empty(4*n_simulations)
+    V          = np.empty(4*n_simulations)
+
+    for n in prange(n_simulations):
+        log_u_max, log_u_min = 0., 0.
+        for k in range(4):
+            logS[4*n+k] = logs0
+            V[4*n+k]    = v0
+            _init_accumulators(A, 4*n+k, logs0)
+            if obs_col[0] >= 0:
+                S_obs[4*n+k, obs_col[0]] = s0
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                j       = 4*n+k
+                v_next  = _tg_variance_step(V[j], ANTITHETIC_SIGNS[k, 1]*Z_1, E, p1, p2, p3, x_grid, f_nu_grid, f_sigma_grid)
+                logs_prev = logS[j]
+                logS[j]   = _andersen_log_step(logS[j], V[j], v_next, rdtK0, K_1, K_2, K_3, K_4, ANTITHETIC_SIGNS[k, 0]*Z_0)
+                _update_accumulators(A, j, logS[j])
+                if bridge:
+                    # approximate bridge variance of the QE/TG step, see _update_bridge_extremes
+                    _update_bridge_extremes(A, j, logs_prev, logS[j], 0.5*(V[j] + v_next)*dt, log_u_max, log_u_min)
+                V[j]      = v_next
+                if obs_col[i+1] >= 0:
+                    S_obs[j, obs_col[i+1]] = exp(logS[j])
+
+        for k in range(4):
+            _finalize_accumulators(A, 4*n+k, logS[4*n+k], N_T)
+
+    return A, V, S_obs
+
+@njit(parallel=True, cache=True, nogil=True)
+def _surface_batch_moments(S_obs:            np.ndarray,
+                           strikes:          np.ndarray,
+                           discount_factors: np.ndarray,
+                           call:             bool):
+    n_paths, n_maturities = S_obs.shape
+    n_strikes             = strikes.shape[0]
+    sign                  = 1. if call else -1.
+
+    mean = np.empty((n_maturities, n_strikes))
+    var  = np.empty((n_maturities, n_strikes))
+
+    for q in prange(n_maturities*n_strikes):
+        j, k = q // n_strikes, q % n_strikes
+        K, DF = strikes[k], discount_factors[j]
+
+        total = 0.
+        for p in range(n_paths):
+            total += max(sign*(S_obs[p, j] - K), 0.)*DF
+        m = total/n_paths
+
+        total = 0.
+        for p in range(n_paths):
+            total += (max(sign*(S_obs[p, j] - K), 0.)*DF - m)**2
+
+        mean[j, k] = m
+        var[j, k]  = total/n_paths
+
+    return mean, var
+
+def mc_price_surface(simulate:         Callable,
+                     state:            MarketState,
+                     heston_params:    HestonParameters,
+                     strikes:          np.ndarray,
+                     maturities:       np.ndarray,
+                     N_T:              int   = 100,
+                     absolute_error:   float = 0.01,
+                     confidence_level: float = 0.05,
+                     batch_size:       int   = 10_000,
+                     MAX_ITER:         int   = 100_000,
+                     call:             bool  = True,
+                     verbose:          bool  = False,
+                     random_seed:      int   = None,
+                     counter_rng:      bool  = False,
+                     **kwargs):
+    """A function that prices a whole surface of European options (strikes x maturities) from a single set of paths.
+    The paths are simulated up to the longest maturity with a streaming engine, the stock price is recorded at the grid
+    point closest to every maturity, and the simulation stops only when the confidence interval of every instrument is
+    shorter than absolute_error.
+    Args:
+        simulate (Callable):                 Streaming simulation engine (simulate_heston_*_streaming).
+        state (MarketState):                 Market state.
+        heston_params (HestonParameters):    Heston parameters.
+        strikes (np.ndarray):                Strikes of the options.
+        maturities (np.ndarray):             Maturities of the options expressed as a number of years.
+        N_T (int, optional):                 Number of steps in time up to the longest maturity. Defaults to 100.
+        absolute_error (float, optional):    Absolute error of every price. Defaults to 0.01 (corresponds to 1 cent).
+        confidence_level (float, optional):  Confidence level for the prices. Defaults to 0.05.
+        batch_size (int, optional):          Path-batch size. Defaults to 10_000.
+        MAX_ITER (int, optional):            Maximum number of iterations. Defaults to 100_000.
+        call (bool, optional):               Price calls if true and puts otherwise. Defaults to True.
+        verbose (bool, optional):            Verbose flag. If true, the technical information is printed. Defaults to False.
+        random_seed (int, optional):         Random seed. Defaults to None.
+        counter_rng (bool, optional):        If true, the paths are drawn from the counter-based Philox stream. Defaults to False.
+        **kwargs:                            Additional arguments for the simulation engine.
+    Raises:
+        error: Maturities must be positive.
+    Returns:
+        The matrix of prices of shape (len(maturities), len(strikes)).
+    """
+    strikes    = np.ascontiguousarray(strikes, dtype=np.float64).ravel()
+    maturities = np.ascontiguousarray(maturities, dtype=np.float64).ravel()
+
+    if np.any(maturities <= 0):
+        raise error("Maturities must be positive.")
+
+    # The engines return N_T grid points t_i = i*T/N_T, i < N_T, so one extra point makes the longest maturity the last one.
+    # Maturities closer than dt/2 share a grid point, which is recorded once and scattered back to all of them.
+    dt             = maturities.max()/N_T
+    steps          = np.clip(np.rint(maturities/dt).astype(np.int64), 1, N_T)
+    steps, columns = np.unique(steps, return_inverse=True)
+
+    args = {'state':             state,
+            'heston_params':     heston_params,
+            'T':                 dt*(N_T + 1),
+            'N_T':               N_T + 1,
+            'n_simulations':     batch_size,
+            'observation_steps': steps,
+            **kwargs}
+
+    discount_factors = np.exp(-state.interest_rate * maturities)
+    iter_count       = 0
+
+    length_conf_interval = np.ones((maturities.shape[0], strikes.shape[0]))
+    n                    = 0
+    C                    = -2*normal_quantile(confidence_level*0.5)
+    stats                = RunningStats()
+
+    if counter_rng:
+        args['seed']        = random_seed if random_seed is not None else int(np.random.randint(2**62))
+        args['path_offset'] = 0
+    elif random_seed is not None:
+        set_seed(random_seed)
+
+    while length_conf_interval.max() > absolute_error and iter_count < MAX_ITER:
+        S_obs           = np.ascontiguousarray(simulate(**args)[2][:, columns])
+        if counter_rng:
+            args['path_offset'] += batch_size
+        mean, var       = _surface_batch_moments(S_obs, strikes, discount_factors, call)
+
+        iter_count     += 1
+
+        stats.merge(RunningStats(S_obs.shape[0], mean, var*S_obs.shape[0]))
+        n                    = stats.count
+        length_conf_interval = stats.ci_length(C)
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+
+        print(f"Surface shape:              {maturities.shape[0]} x {strikes.shape[0]}\nNumber of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {n}\nAbsolute error:             {absolute_error}\nMax conf intl length:       {length_conf_interval.max()}\nConfidence level:           {confidence_level}\n")
+
+    return stats.mean
+
+# Columns of the scenario matrix of the batched engines: market state, contract expiration and Heston parameters.
+SC_STOCK_PRICE, SC_INTEREST_RATE, SC_MATURITY, SC_KAPPA, SC_GAMMA, SC_RHO, SC_VBAR, SC_V0, N_SC = 0, 1, 2, 3, 4, 5, 6, 7, 8
+
+def stack_scenarios(states:        Union[MarketState, list],
+                    heston_params: Union[HestonParameters, list],
+                    T:             Union[float, np.ndarray] = 1.) -> np.ndarray:
+    """Stack market states, Heston parameters and expirations into the scenario matrix of the batched engines.
+    Every argument is either a single value shared by all scenarios or one value per scenario.
+    Args:
+        states (MarketState or list):             Market state(-s).
+        heston_params (HestonParameters or list): Heston parameters.
+        T (float or np.ndarray, optional):        Contract expiration(-s) passed to the engine. Defaults to 1..
+    Raises:
+        ValueError: The arguments give different numbers of scenarios.
+    Returns:
+        The scenario matrix of shape (n_scenarios, N_SC) (see SC_*).
+    """
+    states        = [states] if isinstance(states, MarketState) else list(states)
+    heston_params = [heston_params] if isinstance(heston_params, HestonParameters) else list(heston_params)
+    T             = np.atleast_1d(np.asarray(T, dtype=np.float64))
+
+    n_scenarios = max(len(states), len(heston_params), T.shape[0])
+    for size in (len(states), len(heston_params), T.shape[0]):
+        if size not in (1, n_scenarios):
+            raise ValueError("The scenarios must be given by single values or by sequences of the same length.")
+
+    scenarios = np.empty((n_scenarios, N_SC))
+    scenarios[:, SC_STOCK_PRICE]   = [state.stock_price for state in states]
+    scenarios[:, SC_INTEREST_RATE] = [state.interest_rate for state in states]
+    scenarios[:, SC_MATURITY]      = T
+    scenarios[:, SC_KAPPA]         = [params.kappa for params in heston_params]
+    scenarios[:, SC_GAMMA]         = [params.gamma for params in heston_params]
+    scenarios[:, SC_RHO]           = [params.rho for params in heston_params]
+    scenarios[:, SC_VBAR]          = [params.vbar for params in heston_params]
+    scenarios[:, SC_V0]            = [params.v0 for params in heston_params]
+    return scenarios
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_euler_scenarios(scenarios:     np.ndarray,
+                                    N_T:           int   = 100,
+                                    n_simulations: int   = 1_000,
+                                    seed:          int   = -1,
+                                    path_offset:   int   = 0,
+                                    bridge:        bool  = False
+                                    ) -> np.ndarray:
+    """Streaming Euler engine for many scenarios (rows of the scenario matrix, see stack_scenarios) in one parallel 
+    loop over scenarios x paths. With the counter-based generator every scenario sees the same normals as 
+    simulate_heston_euler_streaming with the same seed and path_offset, so the scenarios are priced with common 
+    random numbers.
+    Args:
+        scenarios (np.ndarray):           Scenario matrix of shape (n_scenarios, N_SC).
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations per scenario. Defaults to 1_000.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+    Raises:
+        error: Contract termination time must be positive.
+    Returns:
+        The accumulator tensor of shape (n_scenarios, 4*n_simulations, N_ACC) (see derivatives.ACC_*).
+    """
+    n_scenarios = scenarios.shape[0]
+    if n_scenarios > 0 and scenarios[:, SC_MATURITY].min() <= 0:
+        raise error("Contract termination time must be positive.")
+
+    A = np.empty((n_scenarios, 4*n_simulations, N_ACC))
+
+    for q in prange(n_scenarios*n_simulations):
+        c, n  = q // n_simulations, q % n_simulations
+        r, logs0, v0 = scenarios[c, SC_INTEREST_RATE], log(scenarios[c, SC_STOCK_PRICE]), scenarios[c, SC_V0]
+        rho, kappa, vbar, gamma = scenarios[c, SC_RHO], scenarios[c, SC_KAPPA], scenarios[c, SC_VBAR], scenarios[c, SC_GAMMA]
+        dt         = scenarios[c, SC_MATURITY]/float(N_T)
+        sqrt1_rho2 = sqrt(1-rho**2)
+        A_c        = A[c]
+        logS       = np.full(4, logs0)
+        V          = np.full(4, v0)
+        log_u_max, log_u_min = 0., 0.
+
+        for k in range(4):
+            _init_accumulators(A_c, 4*n+k, logs0)
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                z_s              = ANTITHETIC_SIGNS[k, 0]*Z_0
+                z_v              = rho*z_s + sqrt1_rho2*ANTITHETIC_SIGNS[k, 1]*Z_1
+                logs_prev, v_prev = logS[k], V[k]
+                logS[k], V[k]    = _euler_step(logS[k], V[k], dt, r, kappa, vbar, gamma, z_s, z_v)
+                _update_accumulators(A_c, 4*n+k, logS[k])
+                if bridge:
+                    _update_bridge_extremes(A_c, 4*n+k, logs_prev, logS[k], max(v_prev, 0.)*dt, log_u_max, log_u_min)
+
+        for k in range(4):
+            _finalize_accumulators(A_c, 4*n+k, logS[k], N_T)
+
+    return A
+
+@njit(cache=True, nogil=True)
+def _andersen_constants(scenario, N_T, gamma_1):
+    # E, p1, p2, p3 of the variance step and r*dt + K_0, K_1, ..., K_4 of the log step of a scenario row
+    r, rho, kappa, vbar, gamma = scenario[SC_INTEREST_RATE], scenario[SC_RHO], scenario[SC_KAPPA], scenario[SC_VBAR], scenario[SC_GAMMA]
+    gamma_2 = 1.0 - gamma_1
+    dt      = scenario[SC_MATURITY]/float(N_T)
+    E       = exp(-kappa*dt)
+    K_0     = -(rho*kappa*vbar/gamma)*dt
+    K_1     = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2     = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3     = gamma_1 * dt * (1.0 - rho**2)
+    K_4     = gamma_2 * dt * (1.0 - rho**2)
+    p1      = (1. - E)*(gamma**2)*E/kappa
+    p2      = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3      = vbar * (1.- E)
+    return E, p1, p2, p3, r*dt + K_0, K_1, K_2, K_3, K_4
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_qe_scenarios(scenarios:     np.ndarray,
+                                          N_T:           int   = 100,
+                                          n_simulations: int   = 1_000,
+                                          Psi_c:         float = 1.5,
+                                          gamma_1:       float = 0.0,
+                                          seed:          int   = -1,
+                                          path_offset:   int   = 0,
+                                          bridge:        bool  = False
+                                          ) -> np.ndarray:
+    """Streaming Quadratic-Exponential Andersen engine for many scenarios in one parallel loop over scenarios x paths.
+    See simulate_heston_euler_scenarios and simulate_heston_andersen_qe_streaming.
+    Args:
+        scenarios (np.ndarray):           Scenario matrix of shape (n_scenarios, N_SC).
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations per scenario. Defaults to 1_000.
+        Psi_c (float, optional):          Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+    Raises:
+        Error: The critical value \psi_c must be in the interval [1,2]
+        Error: The parameter \gamma_1 must be in the interval [0,1]
+        Error: Contract termination time must be positive.
+    Returns:
+        The accumulator tensor of shape (n_scenarios, 4*n_simulations, N_ACC).
+    """
+    if Psi_c>2 or Psi_c<1:
+        raise error('The critical value \psi_c must be in the interval [1,2]')
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    n_scenarios = scenarios.shape[0]
+    if n_scenarios > 0 and scenarios[:, SC_MATURITY].min() <= 0:
+        raise error("Contract termination time must be positive.")
+
+    A = np.empty((n_scenarios, 4*n_simulations, N_ACC))
+
+    for q in prange(n_scenarios*n_simulations):
+        c, n  = q // n_simulations, q % n_simulations
+        E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4 = _andersen_constants(scenarios[c], N_T, gamma_1)
+        logs0 = log(scenarios[c, SC_STOCK_PRICE])
+        A_c   = A[c]
+        logS  = np.full(4, logs0)
+        V     = np.full(4, scenarios[c, SC_V0])
+        dt    = scenarios[c, SC_MATURITY]/float(N_T)
+        log_u_max, log_u_min = 0., 0.
+
+        for k in range(4):
+            _init_accumulators(A_c, 4*n+k, logs0)
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                v_next  = _qe_variance_step(V[k], ANTITHETIC_SIGNS[k, 1]*Z_1, E, p1, p2, p3, Psi_c)
+                logs_prev = logS[k]
+                logS[k]   = _andersen_log_step(logS[k], V[k], v_next, rdtK0, K_1, K_2, K_3, K_4, ANTITHETIC_SIGNS[k, 0]*Z_0)
+                _update_accumulators(A_c, 4*n+k, logS[k])
+                if bridge:
+                    # approximate bridge variance of the QE/TG step, see _update_bridge_extremes
+                    _update_bridge_extremes(A_c, 4*n+k, logs_prev, logS[k], 0.5*(V[k] + v_next)*dt, log_u_max, log_u_min)
+                V[k]      = v_next
+
+        for k in range(4):
+            _finalize_accumulators(A_c, 4*n+k, logS[k], N_T)
+
+    return A
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_tg_scenarios(scenarios:     np.ndarray,
+                                          x_grid:        np.ndarray,
+                                          f_nu_grid:     np.ndarray,
+                                          f_sigma_grid:  np.ndarray,
+                                          N_T:           int   = 100,
+                                          n_simulations: int   = 1_000,
+                                          gamma_1:       float = 0.0,
+                                          seed:          int   = -1,
+                                          path_offset:   int   = 0,
+                                          bridge:        bool  = False
+                                          ) -> np.ndarray:
+    """Streaming Truncated Gaussian Andersen engine for many scenarios in one parallel loop over scenarios x paths.
+    See simulate_heston_euler_scenarios and simulate_heston_andersen_tg_streaming.
+    Args:
+        scenarios (np.ndarray):           Scenario matrix of shape (n_scenarios, N_SC).
+        x_grid (np.ndarray):              Grid of \psi (see tg_lookup_tables).
+        f_nu_grid (np.ndarray):           Values of f_nu on x_grid.
+        f_sigma_grid (np.ndarray):        Values of f_sigma on x_grid.
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations per scenario. Defaults to 1_000.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+        bridge (bool, optional):          Sample the running min and max over the Brownian bridges between grid points. Defaults to False.
+    Raises:
+        Error: The parameter \gamma_1 must be in the interval [0,1]
+        Error: Contract termination time must be positive.
+    Returns:
+        The accumulator tensor of shape (n_scenarios, 4*n_simulations, N_ACC).
+    """
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    n_scenarios = scenarios.shape[0]
+    if n_scenarios > 0 and scenarios[:, SC_MATURITY].min() <= 0:
+        raise error("Contract termination time must be positive.")
+
+    A = np.empty((n_scenarios, 4*n_simulations, N_ACC))
+
+    for q in prange(n_scenarios*n_simulations):
+        c, n  = q // n_simulations, q % n_simulations
+        E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4 = _andersen_constants(scenarios[c], N_T, gamma_1)
+        logs0 = log(scenarios[c, SC_STOCK_PRICE])
+        A_c   = A[c]
+        logS  = np.full(4, logs0)
+        V     = np.full(4, scenarios[c, SC_V0])
+        dt    = scenarios[c, SC_MATURITY]/float(N_T)
+        log_u_max, log_u_min = 0., 0.
+
+        for k in range(4):
+            _init_accumulators(A_c, 4*n+k, logs0)
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+            if bridge:
+                u_max, u_min         = _draw_uniform_pair(seed, path_offset + n, i)
+                log_u_max, log_u_min = log(u_max), log(u_min)
+
+            for k in range(4):
+                v_next  = _tg_variance_step(V[k], ANTITHETIC_SIGNS[k, 1]*Z_1, E, p1, p2, p3, x_grid, f_nu_grid, f_sigma_grid)
+                logs_prev = logS[k]
+                logS[k]   = _andersen_log_step(logS[k], V[k], v_next, rdtK0, K_1, K_2, K_3, K_4, ANTITHETIC_SIGNS[k, 0]*Z_0)
+                _update_accumulators(A_c, 4*n+k, logS[k])
+                if bridge:
+                    # approximate bridge variance of the QE/TG step, see _update_bridge_extremes
+                    _update_bridge_extremes(A_c, 4*n+k, logs_prev, logS[k], 0.5*(V[k] + v_next)*dt, log_u_max, log_u_min)
+                V[k]      = v_next
+
+        for k in range(4):
+            _finalize_accumulators(A_c, 4*n+k, logS[k], N_T)
+
+    return A
+
+def mc_price_scenarios(payoffs:          Union[Callable, list],
+                       simulate:         Callable,
+                       states:           Union[MarketState, list],
+                       heston_params:    Union[HestonParameters, list],
+                       T:                Union[float, np.ndarray] = 1.,
+                       N_T:              int   = 100,
+                       absolute_error:   float = 0.01,
+                       confidence_level: float = 0.05,
+                       batch_size:       int   = 1_000,
+                       MAX_ITER:         int   = 100_000,
+                       verbose:          bool  = False,
+                       random_seed:      int   = None,
+                       counter_rng:      bool  = False,
+                       **kwargs):
+    """A function that prices one derivative per scenario (market state, Heston parameters and expiration) with a 
+    batched engine, so that a whole stress test is one simulate call per batch instead of one mc_price call per 
+    scenario. The scenarios whose confidence interval is shorter than absolute_error are dropped from the next 
+    batches.
+    Args:
+        payoffs (Payoff or list):                 Streaming payoff (derivatives.*_streaming_payoff) shared by all scenarios 
+                                                  or one per scenario.
+        simulate (Callable):                      Batched simulation engine (simulate_heston_*_scenarios).
+        states (MarketState or list):             Market state(-s), see stack_scenarios.
+        heston_params (HestonParameters or list): Heston parameters.
+        T (float or np.ndarray, optional):        Contract expiration(-s) passed to the engine. Defaults to 1..
+        N_T (int, optional):                      Number of steps in time. Defaults to 100.
+        absolute_error (float, optional):         Absolute error of every price. Defaults to 0.01 (corresponds to 1 cent).
+        confidence_level (float, optional):       Confidence level for the prices. Defaults to 0.05.
+        batch_size (int, optional):               Path-batch size per scenario. Defaults to 1_000.
+        MAX_ITER (int, optional):                 Maximum number of iterations. Defaults to 100_000.
+        verbose (bool, optional):                 Verbose flag. If true, the technical information is printed. Defaults to False.
+        random_seed (int, optional):              Random seed. Defaults to None.
+        counter_rng (bool, optional):             If true, the paths are drawn from the counter-based Philox stream. Defaults to False.
+        **kwargs:                                 Additional arguments for the simulation engine.
+    Raises:
+        ValueError: The payoffs and the scenarios differ in number.
+    Returns:
+        A tuple of the vector of prices and the vector of the lengths of their confidence intervals.
+    """
+    scenarios      = stack_scenarios(states, heston_params, T)
+    n_scenarios    = scenarios.shape[0]
+    payoffs        = list(payoffs) if isinstance(payoffs, (list, tuple)) else [payoffs]*n_scenarios
+    if len(payoffs) != n_scenarios:
+        raise ValueError("Give one payoff per scenario or a single payoff.")
+
+    args = {'N_T':           N_T,
+            'n_simulations': batch_size,
+            **kwargs}
+
+    iter_count = 0
+
+    length_conf_interval = np.ones(n_scenarios)
+    C                    = -2*normal_quantile(confidence_level*0.5)
+    stats                = RunningStats(np.zeros(n_scenarios, dtype=np.int64), np.zeros(n_scenarios), np.zeros(n_scenarios))
+    active               = np.arange(n_scenarios)
+
+    if counter_rng:
+        args['seed']        = random_seed if random_seed is not None else int(np.random.randint(2**62))
+        args['path_offset'] = 0
+    elif random_seed is not None:
+        set_seed(random_seed)
+
+    while active.shape[0] > 0 and iter_count < MAX_ITER:
+        A = simulate(np.ascontiguousarray(scenarios[active]), **args)
+        if counter_rng:
+            args['path_offset'] += batch_size
+        batch_new = evaluate_payoffs_scenarios([payoffs[c] for c in active], A)
+
+        iter_count += 1
+
+        subset = RunningStats(stats.count[active], stats.mean[active], stats.M2[active]).merge(RunningStats.from_batch(batch_new))
+        stats.count[active], stats.mean[active], stats.M2[active] = subset.count, subset.mean, subset.M2
+        length_conf_interval[active] = subset.ci_length(C)
+        active                       = active[length_conf_interval[active] > absolute_error]
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+
+        print(f"Number of scenarios:        {n_scenarios}\nNot converged:              {active.shape[0]}\nNumber of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {stats.count.min()} to {stats.count.max()} per scenario\nAbsolute error:             {absolute_error}\nMax conf intl length:       {length_conf_interval.max()}\nConfidence level:           {confidence_level}\n")
+
+    return stats.mean, length_conf_interval
+
+# Columns of the matrix returned by the greeks engines: terminal stock price, the standardized stock noise Z* and
+# the conditional standard deviation s of log S_T given the variance path, then the pathwise derivatives of the 
+# conditional mean mu and of s^2 in the directions of GREEK_DIRECTIONS.
+G_TERMINAL, G_Z, G_SIGMA, G_DMU, G_DS2, N_G = 0, 1, 2, 3, 6, 9
+GREEK_DIRECTIONS = ("vega", "kappa", "rho")
+GREEKS           = ("delta", "gamma") + GREEK_DIRECTIONS
+
+@njit(cache=True, nogil=True)
+def _finalize_greeks(G, j, logS):
+    s              = sqrt(G[j, G_SIGMA])
+    G[j, G_TERMINAL] = exp(logS)
+    G[j, G_Z]      = G[j, G_Z]/s if s > 0. else 0.
+    G[j, G_SIGMA]  = s
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_euler_greeks(state:         MarketState,
+                                 heston_params: HestonParameters,
+                                 T:             float = 1.,
+                                 N_T:           int   = 100,
+                                 n_simulations: int   = 10_000,
+                                 seed:          int   = -1,
+                                 path_offset:   int   = 0
+                                 ) -> np.ndarray:
+    """Euler scheme with the tangent recursions needed for the Greeks, on the same grid and random numbers as 
+    simulate_heston_euler_streaming.
+
+    Given the variance path (i.e. Z_V), log S_T is Gaussian with mean log S_0 + mu and variance s^2, where
+    mu = sum (r - v^+/2) dt + rho sqrt(v^+ dt) Z_V and s^2 = (1 - rho^2) sum v^+ dt. The engine propagates the
+    derivatives of v, mu and s^2 with respect to v0, kappa and rho with Z_V held fixed.
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a number of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+    Raises:
+        error: Contract termination time must be positive.
+    Returns:
+        A tuple containing the matrix of shape (4*n_simulations, N_G) (see G_*) and the terminal stochastic variance.
+    """
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    dt         = T/float(N_T)
+    one_rho2   = 1 - rho**2
+    sqrt1_rho2 = sqrt(one_rho2)
+    logs0      = log(s0)
+
+    G          = np.zeros((4*n_simulations, N_G))
+    D          = np.zeros((4*n_simulations, 3))
+    logS       = np.empty(4*n_simulations)
+    V          = np.empty(4*n_simulations)
+
+    for n in prange(n_simulations):
+        for k in range(4):
+            logS[4*n+k] = logs0
+            V[4*n+k]    = v0
+            D[4*n+k, 0] = 1.
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+
+            for k in range(4):
+                j    = 4*n+k
+                z_s  = ANTITHETIC_SIGNS[k, 0]*Z_0
+                z_v  = rho*z_s + sqrt1_rho2*ANTITHETIC_SIGNS[k, 1]*Z_1
+                # stock noise independent of z_v: z_s = rho*z_v + sqrt(1 - rho^2)*xi
+                xi   = sqrt1_rho2*z_s - rho*ANTITHETIC_SIGNS[k, 1]*Z_1
+                v    = V[j]
+                vmax = max(v, 0.)
+                sq   = sqrt(vmax*dt)
+
+                for d in range(3):
+                    dvmax = D[j, d] if v > 0. else 0.
+                    dsq   = 0.5*sqrt(dt/v)*D[j, d] if v > 0. else 0.
+                    G[j, G_DMU+d] += -0.5*dvmax*dt + rho*dsq*z_v
+                    G[j, G_DS2+d] += one_rho2*dvmax*dt
+                    D[j, d]       += -kappa*dvmax*dt + gamma*dsq*z_v
+
+                D[j, 1]       += (vbar - vmax)*dt
+                G[j, G_DMU+2] += sq*z_v
+                G[j, G_DS2+2] += -2.*rho*vmax*dt
+                G[j, G_SIGMA] += one_rho2*vmax*dt
+                G[j, G_Z]     += sqrt1_rho2*sq*xi
+
+                logS[j], V[j] = _euler_step(logS[j], v, dt, r, kappa, vbar, gamma, z_s, z_v)
+
+        for k in range(4):
+            _finalize_greeks(G, 4*n+k, logS[4*n+k])
+
+    return G, V
+
+@njit(cache=True, nogil=True)
+def _qe_variance_tangent(v, dv, z_v, E, dE, p1, dp1, p2, dp2, p3, dp3, Psi_c):
+    # derivative of _qe_variance_step along (dv, dE, dp1, dp2, dp3) with z_v held fixed
+    m    = p3 + v*E
+    s_2  = v*p1 + p2
+    Psi  = s_2/(m**2)
+    dm   = dp3 + dv*E + v*dE
+    ds_2 = dv*p1 + v*dp1 + dp2
+    dPsi = ds_2/(m**2) - 2.*s_2*dm/(m**3)
+
+    if Psi <= Psi_c:
+        c   = 2. / Psi
+        dc  = -2.*dPsi/(Psi**2)
+        q   = sqrt(c*(c - 1.))
+        b2  = c - 1. + q
+        db2 = dc*(1. + (2.*c - 1.)/(2.*q))
+        a   = m/(1. + b2)
+        da  = dm/(1. + b2) - m*db2/((1. + b2)**2)
+        b   = sqrt(b2)
+        return a*(b + z_v)**2, da*(b + z_v)**2 + a*(b + z_v)*db2/b
+
+    p    = (Psi - 1.)/(Psi + 1.)
+    dp   = 2.*dPsi/((Psi + 1.)**2)
+    beta = (1.0 - p)/m
+    u    = Phi(z_v)
+    if u < p:
+        return 0., 0.
+    dbeta = -dp/m - (1. - p)*dm/(m**2)
+    L     = log((1.-p)/(1.-u))
+    return L/beta, -dp/((1. - p)*beta) - L*dbeta/(beta**2)
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_qe_greeks(state:         MarketState,
+                                       heston_params: HestonParameters,
+                                       T:             float = 1.,
+                                       N_T:           int   = 100,
+                                       n_simulations: int   = 10_000,
+                                       Psi_c:         float = 1.5,
+                                       gamma_1:       float = 0.0,
+                                       seed:          int   = -1,
+                                       path_offset:   int   = 0
+                                       ) -> np.ndarray:
+    """Quadratic-Exponential Andersen scheme with the tangent recursions needed for the Greeks, on the same grid
+    and random numbers as simulate_heston_andersen_qe_streaming.
+
+    Given the variance path, log S_T is Gaussian with mean log S_0 + mu, mu = sum r dt + K_0 + K_1 v_i + K_2 v_{i+1},
+    and variance s^2 = sum K_3 v_i + K_4 v_{i+1}. The derivatives of the QE variance step, of mu and of s^2 with
+    respect to v0, kappa and rho are propagated with the uniforms/normals of the variance held fixed.
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        Psi_c (float, optional):          Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.0.
+        seed (int, optional):             Key of the counter-based (Philox) generator; a negative value selects Numba's global generator. Defaults to -1.
+        path_offset (int, optional):      Index of the first path in the counter-based stream. Defaults to 0.
+    Raises:
+        Error: The critical value \psi_c must be in the interval [1,2]
+        Error: The parameter \gamma_1 must be in the interval [0,1]
+    Returns:
+        A tuple containing the matrix of shape (4*n_simulations, N_G) (see G_*) and the terminal stochastic variance.
+    """
+    if Psi_c>2 or Psi_c<1:
+        raise error('The critical value \psi_c must be in the interval [1,2]')
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    gamma_2 = 1.0 - gamma_1
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    dt         = T/float(N_T)
+    E          = exp(-kappa*dt)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+    p1         = (1. - E)*(gamma**2)*E/kappa
+    p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3         = vbar * (1.- E)
+    rdtK0      = r*dt + K_0
+    logs0      = log(s0)
+
+    # derivatives of the step constants in the directions (v0, kappa, rho)
+    dE_kappa   = -dt*E
+    dE         = np.array([0., dE_kappa, 0.])
+    dp1        = np.array([0., (gamma**2)*dE_kappa*(1. - 2.*E)/kappa - p1/kappa, 0.])
+    dp2        = np.array([0., -vbar*(gamma**2)*(1. - E)*dE_kappa/kappa - p2/kappa, 0.])
+    dp3        = np.array([0., -vbar*dE_kappa, 0.])
+    dK0        = np.array([0., -(rho*vbar/gamma)*dt, -(kappa*vbar/gamma)*dt])
+    dK1        = np.array([0., gamma_1*dt*rho/gamma, gamma_1*dt*kappa/gamma - 1./gamma])
+    dK2        = np.array([0., gamma_2*dt*rho/gamma, gamma_2*dt*kappa/gamma + 1./gamma])
+    dK3        = np.array([0., 0., -2.*rho*gamma_1*dt])
+    dK4        = np.array([0., 0., -2.*rho*gamma_2*dt])
+
+    G          = np.zeros((4*n_simulations, N_G))
+    D          = np.zeros((4*n_simulations, 3))
+    logS       = np.empty(4*n_simulations)
+    V          = np.empty(4*n_simulations)
+
+    for n in prange(n_simulations):
+        for k in range(4):
+            logS[4*n+k] = logs0
+            V[4*n+k]    = v0
+            D[4*n+k, 0] = 1.
+
+        for i in range(N_T - 1):
+            Z_0, Z_1 = _draw_normal_pair(seed, path_offset + n, i)
+
+            for k in range(4):
+                j      = 4*n+k
+                z_s    = ANTITHETIC_SIGNS[k, 0]*Z_0
+                z_v    = ANTITHETIC_SIGNS[k, 1]*Z_1
+                v      = V[j]
+                v_next = _qe_variance_step(v, z_v, E, p1, p2, p3, Psi_c)
+
+                for d in range(3):
+                    dv_next        = _qe_variance_tangent(v, D[j, d], z_v, E, dE[d], p1, dp1[d], p2, dp2[d], p3, dp3[d], Psi_c)[1]
+                    G[j, G_DMU+d] += dK0[d] + dK1[d]*v + K_1*D[j, d] + dK2[d]*v_next + K_2*dv_next
+                    G[j, G_DS2+d] += dK3[d]*v + K_3*D[j, d] + dK4[d]*v_next + K_4*dv_next
+                    D[j, d]        = dv_next
+
+                G[j, G_SIGMA] += K_3*v + K_4*v_next
+                G[j, G_Z]     += sqrt(K_3*v + K_4*v_next)*z_s
+                logS[j]        = _andersen_log_step(logS[j], v, v_next, rdtK0, K_1, K_2, K_3, K_4, z_s)
+                V[j]           = v_next
+
+        for k in range(4):
+            _finalize_greeks(G, 4*n+k, logS[4*n+k])
+
+    return G, V
+
+def _greek_samples(payoff:      Callable,
+                   G:           np.ndarray,
+                   stock_price: float,
+                   greeks:      tuple) -> tuple:
+    """Per-path price and Greek samples from the output of a greeks engine.
+    Lipschitz payoffs (calls, puts) use the pathwise estimator through mu and s and the mixed pathwise/likelihood-ratio
+    gamma; discontinuous payoffs (digitals) use the likelihood ratio of the conditional Gaussian law of log S_T."""
+    values, derivatives = evaluate_terminal(payoff, G[:, G_TERMINAL])
+    Z, s                = G[:, G_Z], G[:, G_SIGMA]
+    inv_s               = np.divide(1., s, out=np.zeros_like(s), where=s > 0.)
+    samples             = {}
+
+    if payoff.code in LIPSCHITZ_CODES:
+        g = derivatives*G[:, G_TERMINAL]
+        for name in greeks:
+            if name == "delta":
+                samples[name] = g/stock_price
+            elif name == "gamma":
+                samples[name] = g*(Z*inv_s - 1.)/stock_price**2
             else:
-                inx             = int(Psi/dx)
-        
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
+                d             = GREEK_DIRECTIONS.index(name)
+                samples[name] = g*(G[:, G_DMU+d] + 0.5*Z*inv_s*G[:, G_DS2+d])
+    else:
+        for name in greeks:
+            if name == "delta":
+                samples[name] = values*Z*inv_s/stock_price
+            elif name == "gamma":
+                samples[name] = values*((Z**2 - 1.)*inv_s**2 - Z*inv_s)/stock_price**2
+            else:
+                d             = GREEK_DIRECTIONS.index(name)
+                samples[name] = values*(Z*inv_s*G[:, G_DMU+d] + 0.5*(Z**2 - 1.)*inv_s**2*G[:, G_DS2+d])
 
-            V[4*n+3,i+1]    = max(nu + sigma*Z[1, n, i], 0)
-            logS[4*n+3,i+1] = logS[4*n+3,i] + rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i]
+    return values, samples
 
-    return [np.exp(logS), V]
\ No newline at end of file
+# Greeks engine used by mc_price(greeks=...) in place of a price-only engine; the paths coincide under the same Philox seed.
+GREEK_ENGINES = {simulate_heston_euler:                 simulate_heston_euler_greeks,
+                 simulate_heston_euler_streaming:       simulate_heston_euler_greeks,
+                 simulate_heston_andersen_qe:           simulate_heston_andersen_qe_greeks,
+                 simulate_heston_andersen_qe_streaming: simulate_heston_andersen_qe_greeks}
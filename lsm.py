@@ -0,0 +1,307 @@
+import numpy as np
+
+import os
+import tempfile
+
+from contextlib import nullcontext
+
+from math import exp, log, sqrt
+from time import perf_counter
+from typing import Callable
+
+from numba import njit, prange
+
+from hestonmc import HestonParameters, MarketState, RunningStats, normal_quantile, stack_scenarios
+from hestonmc import ANTITHETIC_SIGNS, philox_normal_pair, _andersen_constants, _euler_step, _qe_variance_step, _andersen_log_step
+from hestonmc import simulate_heston_euler, simulate_heston_euler_streaming, simulate_heston_andersen_qe, simulate_heston_andersen_qe_streaming
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+SCHEME_EULER, SCHEME_QE = 0, 1
+
+# scheme of the exercise-date kernels that reproduces an engine step by step
+LSM_SCHEMES = {simulate_heston_euler:                 SCHEME_EULER,
+               simulate_heston_euler_streaming:       SCHEME_EULER,
+               simulate_heston_andersen_qe:           SCHEME_QE,
+               simulate_heston_andersen_qe_streaming: SCHEME_QE}
+
+# layout of the step constants (see _step_constants)
+P_DT, P_R, P_KAPPA, P_VBAR, P_GAMMA, P_RHO, P_E, P_P1, P_P2, P_P3, P_RDTK0, P_K1, P_K2, P_K3, P_K4, P_PSI_C, N_P = range(17)
+
+def _step_constants(state:         MarketState,
+                    heston_params: HestonParameters,
+                    T:             float,
+                    N_T:           int,
+                    Psi_c:         float,
+                    gamma_1:       float) -> np.ndarray:
+    p                                   = np.empty(N_P)
+    p[P_DT], p[P_R]                     = T/N_T, state.interest_rate
+    p[P_KAPPA], p[P_VBAR], p[P_GAMMA]   = heston_params.kappa, heston_params.vbar, heston_params.gamma
+    p[P_RHO], p[P_PSI_C]                = heston_params.rho, Psi_c
+    p[P_E:P_PSI_C]                      = _andersen_constants(stack_scenarios(state, heston_params, T)[0], N_T, gamma_1)
+    return p
+
+@njit(cache=True, nogil=True)
+def _advance(scheme, logS, v, z_0, z_1, p):
+    # one step of the Euler or the QE engine driven by the same pair of normals as the engine
+    if scheme == SCHEME_EULER:
+        rho = p[P_RHO]
+        return _euler_step(logS, v, p[P_DT], p[P_R], p[P_KAPPA], p[P_VBAR], p[P_GAMMA], z_0, rho*z_0 + sqrt(1. - rho**2)*z_1)
+    v_next = _qe_variance_step(v, z_1, p[P_E], p[P_P1], p[P_P2], p[P_P3], p[P_PSI_C])
+    return _andersen_log_step(logS, v, v_next, p[P_RDTK0], p[P_K1], p[P_K2], p[P_K3], p[P_K4], z_0), v_next
+
+@njit(parallel=True, cache=True, nogil=True)
+def _exercise_states(logs0, v0, p, scheme, exercise_steps, n_simulations, seed, path_offset, S_out, V_out):
+    # stock prices and variances of 4*n_simulations antithetic paths at the exercise steps only; the paths in between
+    # live in registers, so the memory is n_dates x paths whatever N_T
+    n_dates = exercise_steps.shape[0]
+    for n in prange(n_simulations):
+        logS = np.full(4, logs0)
+        V    = np.full(4, v0)
+        d    = 0
+        for i in range(exercise_steps[n_dates - 1]):
+            Z_0, Z_1 = philox_normal_pair(seed, path_offset + n, i)
+            for k in range(4):
+                logS[k], V[k] = _advance(scheme, logS[k], V[k], ANTITHETIC_SIGNS[k, 0]*Z_0, ANTITHETIC_SIGNS[k, 1]*Z_1, p)
+            if exercise_steps[d] == i + 1:
+                for k in range(4):
+                    S_out[d, 4*n+k] = exp(logS[k])
+                    V_out[d, 4*n+k] = V[k]
+                d += 1
+
+def _basis_powers(degree: int) -> np.ndarray:
+    # exponents (a, b) of the monomials (S/K)^a (V/vbar)^b with a + b <= degree
+    return np.array([(a, total - a) for total in range(degree + 1) for a in range(total, -1, -1)], dtype=np.int64)
+
+def _basis(S: np.ndarray, V: np.ndarray, strike: float, vbar: float, powers: np.ndarray) -> np.ndarray:
+    x = np.asarray(S, dtype=np.float64)/strike
+    w = np.maximum(np.asarray(V, dtype=np.float64), 0.)/vbar
+    return x[:, None]**powers[:, 0] * w[:, None]**powers[:, 1]
+
+@njit(cache=True, nogil=True)
+def _fitted_value(s, v, k, coefficients, powers, strike, sign, vbar, discounts):
+    # discounted value max(h, C_k) of the fitted exercise policy at date k; the contract is exercised at the last date
+    h = max(sign*(s - strike), 0.)
+    if k == discounts.shape[0] - 1:
+        return discounts[k]*h
+    x, w, c = s/strike, max(v, 0.)/vbar, coefficients[k, -1]*h/strike
+    for m in range(powers.shape[0]):
+        c += coefficients[k, m] * x**powers[m, 0] * w**powers[m, 1]
+    return discounts[k]*max(h, c)
+
+@njit(parallel=True, cache=True, nogil=True)
+def _dual_samples(logs0, v0, p, scheme, exercise_steps, S, V, n_inner, seed, path_offset,
+                  coefficients, powers, strike, sign, vbar, discounts):
+    # max_k (D_k h_k - M_k) along every outer path for the martingale M with increments V_k(X_k) - E[V_k(X_k) | X_{k-1}]
+    # of the fitted value function (Andersen and Broadie, 2004); the conditional expectations are averages over
+    # n_inner one-period paths from the outer state in antithetic pairs, keyed by stream 1 of the counter-based generator;
+    # path_offset counts simulations like the engines, so outer path j is path 4*path_offset + j of that stream
+    n_dates, n_paths = S.shape
+    n_pairs          = max(n_inner // 2, 1)
+    U                = np.empty(n_paths)
+    for j in prange(n_paths):
+        M    = 0.
+        best = -np.inf
+        for k in range(n_dates):
+            logs_k, v_k, i_k = (logs0, v0, 0) if k == 0 else (log(S[k-1, j]), V[k-1, j], exercise_steps[k-1])
+            mean = 0.
+            for q in range(n_pairs):
+                logS_a, v_a, logS_b, v_b = logs_k, v_k, logs_k, v_k
+                for i in range(i_k, exercise_steps[k]):
+                    Z_0, Z_1     = philox_normal_pair(seed, (4*path_offset + j)*n_pairs + q, i, 1)
+                    logS_a, v_a  = _advance(scheme, logS_a, v_a, Z_0, Z_1, p)
+                    logS_b, v_b  = _advance(scheme, logS_b, v_b, -Z_0, -Z_1, p)
+                mean += (_fitted_value(exp(logS_a), v_a, k, coefficients, powers, strike, sign, vbar, discounts) +
+                         _fitted_value(exp(logS_b), v_b, k, coefficients, powers, strike, sign, vbar, discounts))
+            M   += _fitted_value(S[k, j], V[k, j], k, coefficients, powers, strike, sign, vbar, discounts) - 0.5*mean/n_pairs
+            best = max(best, discounts[k]*max(sign*(S[k, j] - strike), 0.) - M)
+        U[j] = best
+    return U
+
+def _policy_values(S:            np.ndarray,
+                   V:            np.ndarray,
+                   coefficients: np.ndarray,
+                   powers:       np.ndarray,
+                   strike:       float,
+                   sign:         float,
+                   vbar:         float,
+                   discounts:    np.ndarray) -> np.ndarray:
+    # discounted cash flows of the fitted exercise policy: exercise at the first date where h > 0 and h >= C_k
+    n_dates, n_paths = S.shape
+    values = np.zeros(n_paths)
+    alive  = np.ones(n_paths, dtype=bool)
+    for k in range(n_dates):
+        h    = np.maximum(sign*(S[k] - strike), 0.)
+        stop = alive & (h > 0.)
+        if k < n_dates - 1:
+            itm       = np.nonzero(stop)[0]
+            stop[itm] = h[itm] >= _basis(S[k, itm], V[k, itm], strike, vbar, powers) @ coefficients[k]
+        values[stop] = discounts[k]*h[stop]
+        alive       &= ~stop
+    return values
+
+def _regression(X: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # least squares through the normal equations: the n x m basis is reduced to an m x m system in one pass, which
+    # is an order of magnitude faster than an SVD of the tall matrix and well conditioned enough for scaled monomials
+    return np.linalg.lstsq(X.T @ X, X.T @ y, rcond=None)[0]
+
+def _antithetic_means(values: np.ndarray) -> np.ndarray:
+    # the four antithetic copies of a simulation are not independent, so they count as one sample
+    return values.reshape(-1, 4).mean(axis=1)
+
+def lsm_price(simulate:         Callable,
+              state:            MarketState,
+              heston_params:    HestonParameters,
+              strike:           float,
+              T:                float = 1.,
+              N_T:              int   = 100,
+              exercise_dates:   int   = 50,
+              call:             bool  = False,
+              n_simulations:    int   = 250_000,
+              n_lower:          int   = None,
+              n_dual:           int   = 1_000,
+              n_inner:          int   = 100,
+              degree:           int   = 3,
+              batch_size:       int   = 25_000,
+              storage:          str   = None,
+              dtype:            type  = np.float64,
+              confidence_level: float = 0.05,
+              verbose:          bool  = False,
+              random_seed:      int   = None,
+              Psi_c:            float = 1.5,
+              gamma_1:          float = 0.0) -> dict:
+    """Bermudan option price by Longstaff-Schwartz regression (Longstaff and Schwartz, 2001) with a lower and an
+    upper bound and the confidence interval they span.
+
+    The paths follow the Euler or the QE engine step by step with the counter-based generator, but only the states
+    (S, V) at the exercise dates are kept: 4*n_simulations x exercise_dates x 2 numbers, in memory or, with storage,
+    in memory-mapped files, so 1M paths x 50 dates take 800 MB (400 MB in float32) whatever N_T. The continuation
+    values are regressed on the monomials (S/K)^a (V/vbar)^b, a + b <= degree, over the in-the-money paths, backwards
+    from the last date. The fitted policy is then applied to independent paths (the lower bound) and turned into an
+    Andersen-Broadie dual upper bound with n_inner one-period paths per outer path and date. Unlike the engines, the
+    grid runs to T: the exercise dates are steps N_T/exercise_dates, ..., N_T of size T/N_T, the last one at T.
+    Args:
+        simulate (Callable):                Engine whose scheme is used (see LSM_SCHEMES).
+        state (MarketState):                Market state.
+        heston_params (HestonParameters):   Heston parameters.
+        strike (float):                     Strike of the option.
+        T (float, optional):                Maturity, the last exercise date. Defaults to 1..
+        N_T (int, optional):                Number of steps in time. Defaults to 100.
+        exercise_dates (int, optional):     Number of equally spaced exercise dates; N_T must be a multiple of it. Defaults to 50.
+        call (bool, optional):              Price a call if true and a put otherwise. Defaults to False.
+        n_simulations (int, optional):      Number of simulations of the regression (4 antithetic paths each). Defaults to 250_000.
+        n_lower (int, optional):            Number of simulations of the lower bound. Defaults to n_simulations.
+        n_dual (int, optional):             Number of simulations of the upper bound. Defaults to 1_000.
+        n_inner (int, optional):            Number of inner paths per outer path and date of the upper bound. Defaults to 100.
+        degree (int, optional):             Total degree of the regression basis. Defaults to 3.
+        batch_size (int, optional):         Number of simulations per engine call. Defaults to 25_000.
+        storage (str, optional):            Directory of the memory-mapped exercise states; None keeps them in memory. Defaults to None.
+        dtype (type, optional):             Floating-point type of the stored states. Defaults to np.float64.
+        confidence_level (float, optional): Confidence level of the interval. Defaults to 0.05.
+        verbose (bool, optional):           Verbose flag. If true, the bounds and the timings are printed. Defaults to False.
+        random_seed (int, optional):        Key of the counter-based generator. Defaults to None (a random key).
+        Psi_c (float, optional):            Critical value of \\psi of the QE scheme. Defaults to 1.5.
+        gamma_1 (float, optional):          Integration parameter of the QE scheme. Defaults to 0.0.
+    Raises:
+        ValueError: An engine without an exercise-date kernel or N_T not a multiple of exercise_dates.
+    Returns:
+        A dict with the lower bound 'price' (the policy on independent paths), the 'upper' bound, the confidence
+        'interval' (lower - half its CI, upper + half its CI), the biased 'in_sample' estimate, the regression
+        'coefficients' of shape (exercise_dates, n_basis) and the 'exercise_times'.
+    """
+    if simulate not in LSM_SCHEMES:
+        raise ValueError(f"No exercise-date kernel for {getattr(simulate, '__name__', simulate)}.")
+    if N_T % exercise_dates != 0:
+        raise ValueError("N_T must be a multiple of exercise_dates.")
+
+    start          = perf_counter()
+    scheme         = LSM_SCHEMES[simulate]
+    seed           = random_seed if random_seed is not None else int(np.random.randint(2**62))
+    n_lower        = n_lower if n_lower is not None else n_simulations
+    p              = _step_constants(state, heston_params, T, N_T, Psi_c, gamma_1)
+    logs0, v0      = log(state.stock_price), heston_params.v0
+    exercise_steps = np.arange(1, exercise_dates + 1, dtype=np.int64) * (N_T // exercise_dates)
+    times          = exercise_steps * T / N_T
+    discounts      = np.exp(-state.interest_rate * times)
+    sign           = 1. if call else -1.
+    powers         = _basis_powers(degree)
+    vbar           = heston_params.vbar
+    C              = -2*normal_quantile(confidence_level*0.5)
+
+    def simulate_states(S, V, n, path_offset):
+        for first in range(0, n, batch_size):
+            size = min(batch_size, n - first)
+            _exercise_states(logs0, v0, p, scheme, exercise_steps, size, seed, path_offset + first,
+                             np.asarray(S[:, 4*first:4*(first + size)]), np.asarray(V[:, 4*first:4*(first + size)]))
+
+    with tempfile.TemporaryDirectory(dir=storage) if storage is not None else nullcontext() as directory:
+        shape = (exercise_dates, 4*n_simulations)
+        if directory is None:
+            S, V = np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype)
+        else:
+            S = np.memmap(os.path.join(directory, "S.dat"), dtype=dtype, mode="w+", shape=shape)
+            V = np.memmap(os.path.join(directory, "V.dat"), dtype=dtype, mode="w+", shape=shape)
+        simulate_states(S, V, n_simulations, 0)
+        simulated = perf_counter()
+
+        # backward induction on the discounted cash flows of the policy fitted so far
+        coefficients = np.zeros((exercise_dates, powers.shape[0]))
+        values       = np.zeros((exercise_dates, powers.shape[0] + 1))
+        cash         = discounts[-1]*np.maximum(sign*(np.asarray(S[-1], dtype=np.float64) - strike), 0.)
+        for k in range(exercise_dates - 2, -1, -1):
+            s, v = np.asarray(S[k], dtype=np.float64), np.asarray(V[k])
+            h    = np.maximum(sign*(s - strike), 0.)
+            itm  = np.nonzero(h > 0.)[0]
+            if itm.shape[0] <= powers.shape[0]:
+                coefficients[k, 0] = values[k, 0] = cash.mean()/discounts[k]
+                continue
+            X                  = _basis(s[itm], v[itm], strike, vbar, powers)
+            coefficients[k]    = _regression(X, cash[itm]/discounts[k])
+            exercise           = itm[h[itm] >= X @ coefficients[k]]
+            # the value function of the upper bound also has to be right out of the money, so it is fitted on all paths
+            values[k]          = _regression(np.column_stack([_basis(s, v, strike, vbar, powers), h/strike]), cash/discounts[k])
+            cash[exercise]     = discounts[k]*h[exercise]
+        in_sample = RunningStats.from_batch(_antithetic_means(cash))
+        del S, V, cash
+    fitted = perf_counter()
+
+    lower = RunningStats()
+    for first in range(0, n_lower, batch_size):
+        size = min(batch_size, n_lower - first)
+        S, V = np.empty((exercise_dates, 4*size)), np.empty((exercise_dates, 4*size))
+        simulate_states(S, V, size, n_simulations + first)
+        lower.update(_antithetic_means(_policy_values(S, V, coefficients, powers, strike, sign, vbar, discounts)))
+    evaluated = perf_counter()
+
+    upper = RunningStats()
+    for first in range(0, n_dual, batch_size):
+        size = min(batch_size, n_dual - first)
+        S, V = np.empty((exercise_dates, 4*size)), np.empty((exercise_dates, 4*size))
+        simulate_states(S, V, size, n_simulations + n_lower + first)
+        upper.update(_antithetic_means(_dual_samples(logs0, v0, p, scheme, exercise_steps, S, V, n_inner, seed,
+                                                     n_simulations + n_lower + first, values, powers,
+                                                     float(strike), sign, vbar, discounts)))
+    dual = perf_counter()
+
+    interval = (lower.mean - 0.5*lower.ci_length(C), upper.mean + 0.5*upper.ci_length(C))
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+        print(f"Exercise dates:             {exercise_dates} (N_T = {N_T}), basis degree {degree} ({powers.shape[0]} functions)")
+        print(f"Regression paths:           {4*n_simulations} ({'memory' if storage is None else 'memory-mapped'}, {np.dtype(dtype).name})")
+        print(f"In-sample estimate:         {in_sample.mean:.6f}")
+        print(f"Lower bound:                {lower.mean:.6f} +- {0.5*lower.ci_length(C):.6f} ({4*n_lower} paths)")
+        print(f"Upper bound:                {upper.mean:.6f} +- {0.5*upper.ci_length(C):.6f} ({4*n_dual} paths x {n_inner} inner)")
+        print(f"Confidence interval:        [{interval[0]:.6f}, {interval[1]:.6f}] at level {confidence_level}")
+        print(f"Time:                       simulation {simulated - start:.3f} s, regression {fitted - simulated:.3f} s, "
+              f"lower bound {evaluated - fitted:.3f} s, upper bound {dual - evaluated:.3f} s\n")
+
+    return {'price':          lower.mean,
+            'upper':          upper.mean,
+            'interval':       interval,
+            'in_sample':      in_sample.mean,
+            'coefficients':   coefficients,
+            'exercise_times': times}
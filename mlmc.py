@@ -0,0 +1,165 @@
+import numpy as np
+import warnings
+
+from math import sqrt, log2
+from time import perf_counter
+from typing import Callable
+
+from hestonmc import HestonParameters, MarketState, RunningStats
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+def _level_samples(payoff:        Callable,
+                   simulate:      Callable,
+                   state:         MarketState,
+                   heston_params: HestonParameters,
+                   T:             float,
+                   n_steps:       int,
+                   level:         int,
+                   n_samples:     int,
+                   rng:           np.random.Generator,
+                   kwargs:        dict) -> np.ndarray:
+    """Samples of P_l - P_{l-1} (or of P_0 on level 0) from coarse/fine paths driven by the same Brownian increments.
+    The engines return N_T grid points t_i = i*T/N_T, i < N_T, so they are called with n_steps + 1 points over
+    T + T/n_steps to put the last grid point at T. Every sample averages the four antithetic copies of a path."""
+    def price(n, Z):
+        P = payoff(simulate(state = state, heston_params = heston_params, T = T + T/n, N_T = n + 1,
+                            n_simulations = n_samples, normals = Z, **kwargs)[0])
+        return P.reshape(n_samples, 4).mean(axis=1)
+
+    Z_fine = np.zeros((2, n_samples, n_steps + 1))
+    Z_fine[:, :, :n_steps] = rng.standard_normal((2, n_samples, n_steps))
+
+    if level == 0:
+        return price(n_steps, Z_fine)
+
+    # a coarse step is the sum of two fine Brownian increments
+    n_coarse                   = n_steps // 2
+    Z_coarse                   = np.zeros((2, n_samples, n_coarse + 1))
+    Z_coarse[:, :, :n_coarse]  = (Z_fine[:, :, 0:n_steps:2] + Z_fine[:, :, 1:n_steps:2]) / sqrt(2.)
+
+    return price(n_steps, Z_fine) - price(n_coarse, Z_coarse)
+
+def _rate(levels: np.ndarray,
+          values: np.ndarray,
+          floor:  float) -> float:
+    # least-squares estimate of the decay rate of values[l] ~ 2^(-rate*l) over the levels l >= 1
+    mask = (levels >= 1) & (values > 0)
+    if mask.sum() < 2:
+        return floor
+    return max(floor, -np.polyfit(levels[mask], np.log2(values[mask]), 1)[0])
+
+def mlmc_price(payoff:        Callable,
+               simulate:      Callable,
+               state:         MarketState,
+               heston_params: HestonParameters,
+               T:             float = 1.,
+               N0:            int   = 4,
+               rmse:          float = 0.01,
+               L_min:         int   = 2,
+               L_max:         int   = 10,
+               N_init:        int   = 1_000,
+               batch_size:    int   = 10_000,
+               max_batch_steps: int = 2**22,
+               theta:         float = 0.25,
+               verbose:       bool  = False,
+               random_seed:   int   = None,
+               **kwargs):
+    """Multilevel Monte-Carlo pricing (Giles, 2008) over the time-step levels N_T = N0*2^l of a full-path engine.
+
+    Level l > 0 estimates E[P_l - P_{l-1}] from coarse/fine path pairs that share their Brownian increments.
+    The variance V_l and the cost C_l (wall time per sample) of every level are estimated online, the number of
+    samples per level is set to N_l ~ sqrt(V_l/C_l) * sum_k sqrt(V_k C_k) / ((1-theta) rmse^2), and levels are
+    added until the estimated bias, |E[P_L - P_{L-1}]|/(2^alpha - 1), is below sqrt(theta)*rmse.
+
+    Args:
+        payoff (Callable):                 Payoff function on the stock price matrix.
+        simulate (Callable):               Full-path simulation engine accepting normals.
+        state (MarketState):               Market state.
+        heston_params (HestonParameters):  Heston parameters.
+        T (float, optional):               Contract expiration T. Defaults to 1..
+        N0 (int, optional):                Number of time steps on level 0. Defaults to 4.
+        rmse (float, optional):            Target root mean squared error (bias included). Defaults to 0.01.
+        L_min (int, optional):             Minimum finest level. Defaults to 2.
+        L_max (int, optional):             Maximum finest level. Defaults to 10.
+        N_init (int, optional):            Number of pilot samples on a new level. Defaults to 1_000.
+        batch_size (int, optional):        Maximum number of samples per simulate call. Defaults to 10_000.
+        max_batch_steps (int, optional):   Maximum samples x time steps per simulate call. Defaults to 2**22.
+        theta (float, optional):           Share of the squared error given to the bias. Defaults to 0.25.
+        verbose (bool, optional):          Verbose flag. If true, the level statistics are printed. Defaults to False.
+        random_seed (int, optional):       Random seed. Defaults to None.
+        **kwargs:                          Additional arguments for the simulation engine.
+    Returns:
+        The price of the derivative.
+    """
+    rngs   = [np.random.default_rng(seed) for seed in np.random.SeedSequence(random_seed).spawn(L_max + 1)]
+    stats  = [RunningStats() for _ in range(L_max + 1)]
+    cost   = np.zeros(L_max + 1)
+    spent  = np.zeros(L_max + 1)   # wall time of every level, so that cost is the mean over all its batches
+    L      = max(L_min, 1)
+    dN     = np.array([N_init]*(L + 1) + [0]*(L_max - L), dtype=np.int64)
+    alpha  = beta = gamma = 0.
+
+    # compile the engine before timing the levels
+    _level_samples(payoff, simulate, state, heston_params, T, 2, 1, 1, np.random.default_rng(0), kwargs)
+
+    while dN.sum() > 0:
+        for l in np.nonzero(dN)[0]:
+            n_steps = N0 * 2**l
+            while dN[l] > 0:
+                n       = int(min(dN[l], batch_size, max(1, max_batch_steps // n_steps)))
+                start   = perf_counter()
+                stats[l].update(_level_samples(payoff, simulate, state, heston_params, T, n_steps, l, n, rngs[l], kwargs))
+                spent[l] += perf_counter() - start
+                cost[l]   = spent[l] / stats[l].count
+                dN[l]  -= n
+
+        levels = np.arange(L + 1)
+        m      = np.array([abs(stats[l].mean) for l in levels])
+        V      = np.array([stats[l].variance for l in levels])
+        C      = cost[:L + 1]
+        N      = np.array([stats[l].count for l in levels])
+
+        alpha  = _rate(levels, m, 0.5)
+        beta   = _rate(levels, V, 0.5)
+        gamma  = max(log2(C[-1] / C[-2]), 0.5) if C[-2] > 0 else 1.
+
+        # the estimates of the deep levels are noisy at first: do not let them fall below the extrapolated decay
+        for l in range(2, L + 1):
+            m[l] = max(m[l], 0.5 * m[l-1] / 2**alpha)
+            V[l] = max(V[l], 0.5 * V[l-1] / 2**beta)
+
+        Ns        = np.ceil(np.sqrt(V / C) * np.sum(np.sqrt(V * C)) / ((1. - theta) * rmse**2)).astype(np.int64)
+        dN[:L+1]  = np.maximum(0, Ns - N)
+
+        if np.all(dN[:L+1] <= 0.01 * N):
+            bias = max(m[-1], m[-2] / 2**alpha) / (2**alpha - 1.)
+            if bias > sqrt(theta) * rmse:
+                if L == L_max:
+                    warnings.warn(f"The finest level L_max = {L_max} was reached before the bias target; the RMSE target may be missed.")
+                    break
+
+                L         += 1
+                V_new      = V[-1] / 2**beta
+                C_new      = C[-1] * 2**gamma
+                cost[L]    = C_new
+                V          = np.append(V, V_new)
+                C          = np.append(C, C_new)
+                N          = np.append(N, 0)
+                Ns         = np.ceil(np.sqrt(V / C) * np.sum(np.sqrt(V * C)) / ((1. - theta) * rmse**2)).astype(np.int64)
+                dN[:L+1]   = np.maximum(0, Ns - N)
+
+    price = sum(stats[l].mean for l in range(L + 1))
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+        print(f"Finest level:               {L} (N_T = {N0 * 2**L})\nTarget RMSE:                {rmse}\nRates alpha, beta, gamma:   {alpha:.2f}, {beta:.2f}, {gamma:.2f}")
+        print(f"{'level':>5} {'N_T':>6} {'samples':>10} {'mean':>12} {'variance':>12} {'cost/sample':>12}")
+        for l in range(L + 1):
+            print(f"{l:>5} {N0 * 2**l:>6} {stats[l].count:>10} {stats[l].mean:>12.4e} {stats[l].variance:>12.4e} {cost[l]:>12.4e}")
+        print(f"Total cost:                 {sum(stats[l].count * cost[l] for l in range(L + 1)):.3f} s\n")
+
+    return price
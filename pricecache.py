@@ -0,0 +1,249 @@
+import numpy as np
+
+import json
+import hashlib
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+from typing import Callable
+
+from hestonmc import HestonParameters, MarketState, RunningStats, mc_price, normal_quantile
+from derivatives import Payoff
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+def _canonical(value):
+    # a JSON-serializable form of an engine argument that does not depend on object identity: floats by their
+    # shortest round-trip repr, arrays by their dtype, shape and a digest of their bytes, dtype classes by their name
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        return {'array': data.dtype.str, 'shape': list(data.shape), 'sha256': hashlib.sha256(data.tobytes()).hexdigest()}
+    if isinstance(value, type) and issubclass(value, np.generic):
+        return {'dtype': np.dtype(value).str}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in sorted(value.items())}
+    raise TypeError(f"Cannot build a cache key from {type(value).__name__}.")
+
+# mc_price settings that change how many paths are taken (or what is reported) but not the paths themselves
+_SAMPLING_SETTINGS = ('batch_size', 'MAX_ITER', 'verbose', 'observer')
+
+# mc_price estimators whose result is not one RunningStats of a counter-based stream and so cannot be refined
+_UNSUPPORTED_SETTINGS = ('greeks', 'qmc_replications', 'control_variate_payoff')
+
+def price_key(payoff:        Payoff,
+              simulate:      Callable,
+              state:         MarketState,
+              heston_params: HestonParameters,
+              T:             float,
+              N_T:           int,
+              random_seed:   int,
+              kwargs:        dict) -> str:
+    """Canonical hash of everything that determines the paths and the payoff of a counter-based mc_price call.
+    absolute_error and confidence_level are left out on purpose: they only decide how many paths are taken, so a
+    cached estimate serves any target it already meets and can be refined for the others.
+    Raises:
+        TypeError: The payoff is not a single derivatives.Payoff or an engine argument has no canonical form.
+        ValueError: Greeks, randomized QMC or control variates are requested.
+    """
+    if isinstance(payoff, (list, tuple)):
+        raise TypeError("Only single payoffs can be cached; price a list of payoffs one Payoff at a time.")
+    if not isinstance(payoff, Payoff):
+        raise TypeError("Only derivatives.Payoff payoffs can be cached; closures have no canonical form.")
+    unsupported = [name for name in _UNSUPPORTED_SETTINGS if kwargs.get(name) not in (None, 0)]
+    if unsupported:
+        raise ValueError(f"Only plain Monte-Carlo estimates can be cached; {', '.join(unsupported)} is not supported.")
+
+    description = {'simulate':      f"{simulate.__module__}.{simulate.__name__}",
+                   'payoff':        [payoff.code, _canonical(payoff.params), payoff.streaming],
+                   'state':         _canonical([state.stock_price, state.interest_rate]),
+                   'heston_params': _canonical([heston_params.kappa, heston_params.gamma, heston_params.rho, heston_params.vbar, heston_params.v0]),
+                   'T':             _canonical(T),
+                   'N_T':           int(N_T),
+                   'random_seed':   _canonical(random_seed),
+                   'kwargs':        _canonical({name: value for name, value in kwargs.items() if name not in _SAMPLING_SETTINGS})}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+class PriceCache:
+    """Memoization of mc_price over (engine, payoff, market state, Heston parameters, T, N_T, seed, engine arguments).
+
+    The estimates are computed with the counter-based generator, so an entry is the RunningStats of the first
+    `count` paths of a well-defined stream together with the offset at which the stream continues. A request whose
+    absolute_error the entry already meets is a hit; a request with a tighter target refines the entry by
+    simulating only the paths that are missing (mc_price with initial_stats), and a new key is a miss. Only plain
+    Monte-Carlo prices of a single Payoff are cached: greeks, qmc_replications and control_variate_payoff are
+    rejected, since their estimates cannot be continued from a RunningStats and a path offset. With a fixed
+    batch_size the refined estimate is the one a fresh run to the tighter target returns, since both stop at the
+    first batch boundary that meets it; the calibrated plan (batch_size=None) cuts its batches to the target of each
+    call, so a refinement is then an equally valid estimate on a different number of paths.
+
+    Entries live in an in-process LRU tier of at most max_entries and, if path is given, in a sqlite file shared
+    by processes, from which entries older than max_age seconds and, beyond max_disk_entries, the least recently
+    used ones are evicted. The age also applies to the memory tier. hits counts the requests served without any
+    simulation, disk_hits the hits and refinements whose entry came from the sqlite file.
+    """
+    def __init__(self,
+                 max_entries:      int   = 1_024,
+                 path:             str   = None,
+                 max_disk_entries: int   = 100_000,
+                 max_age:          float = None):
+        self.max_entries      = max_entries
+        self.path             = path
+        self.max_disk_entries = max_disk_entries
+        self.max_age          = max_age
+        self.hits             = 0
+        self.disk_hits        = 0
+        self.refinements      = 0
+        self.misses           = 0
+        self._memory          = OrderedDict()
+        self._lock            = threading.Lock()
+
+        if path is not None:
+            with self._connect() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS prices (key TEXT PRIMARY KEY, seed INTEGER, count INTEGER, mean REAL, "
+                           "M2 REAL, path_offset INTEGER, created REAL, accessed REAL)")
+                db.execute("CREATE INDEX IF NOT EXISTS prices_accessed ON prices (accessed)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30.)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _get(self, key: str):
+        with self._lock:
+            if key in self._memory:
+                if self.max_age is None or time() - self._memory[key]['created'] <= self.max_age:
+                    self._memory.move_to_end(key)
+                    return self._memory[key], False
+                del self._memory[key]
+
+        if self.path is None:
+            return None, False
+
+        now = time()
+        with self._connect() as db:
+            row = db.execute("SELECT seed, count, mean, M2, path_offset, created FROM prices WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, False
+            if self.max_age is not None and now - row[5] > self.max_age:
+                db.execute("DELETE FROM prices WHERE key = ?", (key,))
+                return None, False
+            db.execute("UPDATE prices SET accessed = ? WHERE key = ?", (now, key))
+
+        entry = {'seed': row[0], 'stats': RunningStats(row[1], row[2], row[3]), 'path_offset': row[4], 'created': row[5]}
+        self._remember(key, entry)
+        return entry, True
+
+    def _remember(self, key: str, entry: dict):
+        with self._lock:
+            self._memory[key] = entry
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def _put(self, key: str, entry: dict):
+        self._remember(key, entry)
+        if self.path is None:
+            return
+
+        now   = time()
+        stats = entry['stats']
+        with self._connect() as db:
+            db.execute("INSERT OR REPLACE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (key, entry['seed'], int(stats.count), float(stats.mean), float(stats.M2), int(entry['path_offset']), entry['created'], now))
+            if self.max_age is not None:
+                db.execute("DELETE FROM prices WHERE created < ?", (now - self.max_age,))
+            db.execute("DELETE FROM prices WHERE key IN (SELECT key FROM prices ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                       (self.max_disk_entries,))
+
+    def price(self,
+              payoff:           Payoff,
+              simulate:         Callable,
+              state:            MarketState,
+              heston_params:    HestonParameters,
+              T:                float = 1.,
+              N_T:              int   = 100,
+              absolute_error:   float = 0.01,
+              confidence_level: float = 0.05,
+              random_seed:      int   = None,
+              **kwargs) -> float:
+        """Price a derivative like mc_price(..., counter_rng=True), reusing and refining cached estimates.
+        Args:
+            payoff (Payoff):                    Payoff of the derivative.
+            simulate (Callable):                Simulation engine accepting seed and path_offset.
+            state (MarketState):                Market state.
+            heston_params (HestonParameters):   Heston parameters.
+            T (float, optional):                Contract expiration T. Defaults to 1..
+            N_T (int, optional):                Number of steps in time. Defaults to 100.
+            absolute_error (float, optional):   Absolute error of the price. Defaults to 0.01 (corresponds to 1 cent).
+            confidence_level (float, optional): Confidence level for the price. Defaults to 0.05.
+            random_seed (int, optional):        Key of the counter-based generator. Defaults to None (a random key, drawn
+                                                once per cache entry).
+            **kwargs:                           Additional arguments for mc_price and the simulation engine; greeks,
+                                                qmc_replications and control_variate_payoff are not supported.
+        Raises:
+            TypeError: The payoff is not a single Payoff or an engine argument has no canonical form.
+            ValueError: Greeks, randomized QMC or control variates are requested.
+        Returns:
+            The price of the derivative.
+        """
+        key      = price_key(payoff, simulate, state, heston_params, T, N_T, random_seed, kwargs)
+        C        = -2*normal_quantile(confidence_level*0.5)
+        entry, from_disk = self._get(key)
+
+        if entry is not None and entry['stats'].ci_length(C) <= absolute_error:
+            with self._lock:
+                self.hits      += 1
+                self.disk_hits += from_disk
+            return entry['stats'].mean
+
+        if entry is None:
+            seed = random_seed if random_seed is not None else int(np.random.randint(2**62))
+            entry = {'seed': seed, 'stats': None, 'path_offset': 0, 'created': time()}
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.refinements += 1
+                self.disk_hits   += from_disk
+
+        price, stats, path_offset = mc_price(payoff, simulate, state, heston_params, T = T, N_T = N_T,
+                                             absolute_error = absolute_error, confidence_level = confidence_level,
+                                             random_seed = entry['seed'], counter_rng = True, initial_stats = entry['stats'],
+                                             path_offset = entry['path_offset'], full_output = True, **kwargs)
+
+        self._put(key, {**entry, 'stats': stats, 'path_offset': path_offset})
+        return price
+
+    def counters(self) -> dict:
+        """Hit (memory or disk), disk hit, refinement and miss counts and the number of entries in memory."""
+        with self._lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'refinements': self.refinements,
+                    'misses': self.misses, 'entries': len(self._memory)}
+
+    def clear(self):
+        """Drop every entry from both tiers and reset the counters."""
+        with self._lock:
+            self._memory.clear()
+            self.hits = self.disk_hits = self.refinements = self.misses = 0
+        if self.path is not None:
+            with self._connect() as db:
+                db.execute("DELETE FROM prices")
@@ -0,0 +1,282 @@
+import numpy as np
+
+import asyncio
+import itertools
+
+from concurrent.futures import ThreadPoolExecutor
+from math import inf
+
+from numba import get_num_threads
+
+from hestonmc import HestonParameters, MarketState, RunningStats, normal_quantile
+from hestonmc import simulate_heston_euler_streaming, simulate_heston_andersen_qe_streaming, simulate_heston_andersen_tg_streaming, tg_lookup_tables
+from derivatives import Payoff, evaluate_payoffs_accumulated
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+# Streaming engines of the service by scheme name, with the function that builds their extra arguments
+SERVICE_ENGINES = {'euler': (simulate_heston_euler_streaming, None),
+                   'qe':    (simulate_heston_andersen_qe_streaming, None),
+                   'tg':    (simulate_heston_andersen_tg_streaming, tg_lookup_tables)}
+
+class _Request:
+    def __init__(self, payoff, absolute_error, priority, deadline, future, submitted):
+        self.payoff         = payoff
+        self.absolute_error = absolute_error
+        self.priority       = priority
+        self.deadline       = deadline   # event loop time, inf without a latency budget
+        self.future         = future
+        self.submitted      = submitted
+        self.stats          = RunningStats()
+        self.batches        = 0
+        self.shared         = 1          # largest number of requests that priced on the same batch
+
+class _Group:
+    # requests that share (scheme, HestonParameters, MarketState, N_T, T) and therefore the paths of every batch
+    def __init__(self, key, simulate, args, sequence):
+        self.key         = key
+        self.simulate    = simulate
+        self.args        = args
+        self.sequence    = sequence
+        self.requests    = []
+        self.path_offset = 0
+        self.running     = False
+
+    def urgency(self) -> tuple:
+        # higher priority first, then earliest deadline first, then first come first served
+        return (-max(request.priority for request in self.requests), min(request.deadline for request in self.requests), self.sequence)
+
+class PricingService:
+    """Asyncio front end of the streaming engines that prices derivatives.Payoff requests.
+
+    Requests that share the scheme, the Heston parameters, the market state, N_T and T are coalesced: one batch of
+    paths is simulated for all of them and evaluated by all their payoffs in one pass over the accumulators, and every
+    request keeps its own RunningStats, so a request that joins while others are running starts with the next batch.
+    A request is answered as soon as its confidence interval is shorter than its absolute_error or, if it has a
+    deadline, when its latency budget runs out, with the estimate and the interval of the paths simulated so far.
+
+    The batches run on an executor (the kernels release the GIL, so the event loop stays responsive) and the next one
+    goes to the group with the highest-priority request, ties broken by the earliest deadline. Every group keeps one
+    batch in flight and draws from the counter-based stream keyed by random_seed, so the price of a lone request does
+    not depend on the load. Several workers call the parallel kernels concurrently, which needs a thread-safe Numba
+    threading layer (tbb or omp); one worker that uses all the Numba threads is usually as fast.
+    Args:
+        max_workers (int, optional):        Number of batches simulated at the same time. Defaults to 1.
+        batch_size (int, optional):         Largest number of simulations per batch (4 paths each); smaller batches
+                                            meet deadlines more closely. Defaults to 2_500.
+        confidence_level (float, optional): Confidence level of the intervals. Defaults to 0.05.
+        random_seed (int, optional):        Key of the counter-based generator. Defaults to None (a random key).
+        bridge (bool, optional):            Monitor the running min and max continuously (see simulate_heston_euler_streaming).
+                                            Defaults to False.
+        coalesce (bool, optional):          Coalesce the requests; if false, every request has its own batches. Defaults to True.
+        executor (Executor, optional):      Executor of the batches. Defaults to a ThreadPoolExecutor of max_workers threads.
+    """
+    def __init__(self,
+                 max_workers:      int   = 1,
+                 batch_size:       int   = 2_500,
+                 confidence_level: float = 0.05,
+                 random_seed:      int   = None,
+                 bridge:           bool  = False,
+                 coalesce:         bool  = True,
+                 executor                = None):
+        self.max_workers = max_workers
+        self.batch_size  = batch_size
+        self.min_batch   = min(batch_size, 16 * get_num_threads())
+        self.C           = -2*normal_quantile(confidence_level*0.5)
+        self.seed        = random_seed if random_seed is not None else int(np.random.randint(2**62))
+        self.bridge      = bridge
+        self.coalesce    = coalesce
+        self.counters    = {'requests': 0, 'batches': 0, 'paths': 0, 'expired': 0}
+        self._executor   = executor if executor is not None else ThreadPoolExecutor(max_workers, thread_name_prefix="pricing")
+        self._owned      = executor is None
+        self._groups     = {}
+        self._tables     = {}
+        self._sequence   = itertools.count()
+        self._workers    = []
+        self._wakeup     = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stop the workers, fail the pending requests and shut the executor down if the service owns it."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for group in self._groups.values():
+            for request in group.requests:
+                if not request.future.done():
+                    request.future.set_exception(RuntimeError("The pricing service was closed."))
+        self._groups = {}
+        if self._owned:
+            self._executor.shutdown(wait=True)
+
+    async def price(self,
+                    payoff:         Payoff,
+                    scheme:         str,
+                    state:          MarketState,
+                    heston_params:  HestonParameters,
+                    N_T:            int   = 100,
+                    T:              float = None,
+                    absolute_error: float = 0.01,
+                    priority:       int   = 0,
+                    deadline:       float = None) -> dict:
+        """Price a payoff.
+        Args:
+            payoff (Payoff):                  Payoff; it is evaluated on the accumulators of the streaming engine.
+            scheme (str):                     Key of SERVICE_ENGINES.
+            state (MarketState):              Market state.
+            heston_params (HestonParameters): Parameters of the Heston model.
+            N_T (int, optional):              Number of steps in time. Defaults to 100.
+            T (float, optional):              Contract expiration T of the engine. Defaults to the maturity of the payoff.
+            absolute_error (float, optional): Target length of the confidence interval. Defaults to 0.01.
+            priority (int, optional):         Requests of a higher priority are simulated first. Defaults to 0.
+            deadline (float, optional):       Latency budget in seconds. Defaults to None (wait for the target).
+                                              Cancelling the call withdraws the request from its batches as well.
+        Raises:
+            ValueError: Unknown scheme.
+        Returns:
+            A dict with the estimate 'price' (nan if no batch finished in time), the length of the confidence interval
+            'ci_length', the number of paths 'n' and of batches 'batches', whether the target was met ('converged'),
+            the 'latency' in seconds and 'shared', the largest number of requests that shared a batch with this one.
+        """
+        if scheme not in SERVICE_ENGINES:
+            raise ValueError(f"Unknown scheme {scheme}; expected one of {', '.join(SERVICE_ENGINES)}.")
+        self._start()
+
+        loop    = asyncio.get_running_loop()
+        now     = loop.time()
+        T       = float(payoff.maturity) if T is None else T
+        request = _Request(payoff, absolute_error, priority, now + deadline if deadline is not None else inf, loop.create_future(), now)
+        group   = await self._group(scheme, state, heston_params, N_T, T)
+        group.requests.append(request)
+        self.counters['requests'] += 1
+        self._wakeup.set()
+
+        try:
+            done, _ = await asyncio.wait({request.future}, timeout=deadline)
+        except asyncio.CancelledError:
+            # the caller stopped waiting (wait_for, a client disconnect): the batches must not keep pricing for it
+            self._withdraw(group, request)
+            raise
+        if not done:
+            self.counters['expired'] += 1
+            request.future.set_result(False)
+            self._withdraw(group, request)
+        request.future.result()
+
+        stats = request.stats
+        return {'price':     float(stats.mean) if stats.count > 0 else np.nan,
+                'ci_length': float(stats.ci_length(self.C)) if stats.count > 1 else inf,
+                'n':         stats.count,
+                'batches':   request.batches,
+                'converged': request.future.result(),
+                'latency':   loop.time() - now,
+                'shared':    request.shared}
+
+    def _start(self):
+        if self._workers:
+            return
+        self._wakeup  = asyncio.Event()
+        self._workers = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def _group(self, scheme, state, heston_params, N_T, T) -> _Group:
+        key = (scheme, HestonParameters(*heston_params), MarketState(*state), int(N_T), float(T))
+        if not self.coalesce:
+            key = key + (next(self._sequence),)
+
+        simulate, tables = SERVICE_ENGINES[scheme]
+        if tables is not None:
+            # building (or loading) the lookup tables takes long: run it on the executor, once for all the waiting requests
+            if scheme not in self._tables:
+                self._tables[scheme] = asyncio.get_running_loop().run_in_executor(self._executor, tables)
+            future = self._tables[scheme]
+            try:
+                tables = await asyncio.shield(future)
+            except Exception:
+                if self._tables.get(scheme) is future:
+                    del self._tables[scheme]
+                raise
+
+        if key in self._groups:
+            return self._groups[key]
+        args = {'state': key[2], 'heston_params': key[1], 'T': key[4], 'N_T': key[3], 'seed': self.seed, 'bridge': self.bridge,
+                **(tables or {})}
+        self._groups[key] = _Group(key, simulate, args, next(self._sequence))
+        return self._groups[key]
+
+    def _withdraw(self, group, request):
+        # drop a request that is no longer waited for; a batch in flight skips it since its future is done
+        if not request.future.done():
+            request.future.cancel()
+        if request in group.requests:
+            group.requests.remove(request)
+        if not group.requests and not group.running and self._groups.get(group.key) is group:
+            del self._groups[group.key]
+
+    def _next_group(self) -> _Group:
+        ready = [group for group in self._groups.values() if not group.running and group.requests]
+        return min(ready, key=_Group.urgency) if ready else None
+
+    def _batch_size(self, requests) -> int:
+        # cut the batch to the paths projected for the most demanding request, as BatchPlanner does for mc_price
+        needed = 0.
+        for request in requests:
+            if request.stats.count < 2:
+                return self.batch_size
+            projected = (self.C / request.absolute_error)**2 * request.stats.variance
+            needed    = max(needed, 1.02*projected - request.stats.count)
+        return int(min(self.batch_size, max(self.min_batch, np.ceil(needed / 4))))
+
+    def _simulate(self, group, payoffs, n_simulations, path_offset) -> np.ndarray:
+        A = group.simulate(n_simulations=n_simulations, path_offset=path_offset, **group.args)[0]
+        return evaluate_payoffs_accumulated(payoffs, A)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            group = self._next_group()
+            if group is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            requests           = list(group.requests)
+            n_simulations      = self._batch_size(requests)
+            path_offset        = group.path_offset
+            group.path_offset += n_simulations
+            group.running      = True
+            try:
+                samples = await loop.run_in_executor(self._executor, self._simulate, group, [request.payoff for request in requests],
+                                                     n_simulations, path_offset)
+            except Exception as exc:
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(exc)
+                        group.requests.remove(request)
+                samples = None
+            finally:
+                group.running = False
+
+            if samples is not None:
+                self.counters['batches'] += 1
+                self.counters['paths']   += samples.shape[1]
+                for request, batch in zip(requests, samples):
+                    # requests whose deadline passed while the batch was running have already been answered
+                    if request.future.done():
+                        continue
+                    request.stats.update(batch)
+                    request.batches += 1
+                    request.shared   = max(request.shared, len(requests))
+                    if request.stats.count > 1 and request.stats.ci_length(self.C) <= request.absolute_error:
+                        request.future.set_result(True)
+                        group.requests.remove(request)
+
+            if not group.requests and self._groups.get(group.key) is group:
+                del self._groups[group.key]
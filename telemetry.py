@@ -0,0 +1,159 @@
+import numpy as np
+
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import Callable, Union
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+# Observers of mc_price(observer=...). mc_price calls the observer with a dict after every batch,
+#   {'event': "batch", 'method', 'iteration', 'n_simulations', 'paths', 'seconds', 'spans', 'compiled',
+#    'paths_per_second', 'bytes', 'n', 'mean', 'ci_length', 'absolute_error', 'elapsed'},
+# and once at the end of the run,
+#   {'event': "done", 'iterations', 'n', 'mean', 'ci_length', 'absolute_error', 'converged', 'seconds'}.
+# spans are the seconds spent in the engine ('simulate', or 'compile' if the call compiled a new specialization or
+# loaded it from the Numba cache), in the payoff ('payoff') and in the running statistics ('update'); the random
+# numbers and exp(log S) are computed inside the engine kernels and are part of 'simulate', except for randomized QMC,
+# whose Sobol normals are drawn in Python ('rng'). bytes is the size of the arrays returned by the engine.
+
+def broadcast(*observers: Callable) -> Callable:
+    """One observer that passes every event to all the given ones, e.g. a TelemetryRecorder and an exporter."""
+    def observer(event: dict):
+        for callback in observers:
+            callback(event)
+    return observer
+
+class TelemetryRecorder:
+    """Observer that keeps the events of one or more mc_price runs in memory."""
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event: dict):
+        self.events.append(event)
+
+    @property
+    def batches(self) -> list:
+        return [event for event in self.events if event['event'] == "batch"]
+
+    def convergence(self) -> dict:
+        """Convergence trace: arrays of the number of paths, the estimate and the length of the confidence interval
+        after every batch."""
+        batches = self.batches
+        return {'n':         np.array([event['n'] for event in batches]),
+                'mean':      np.array([event['mean'] for event in batches]),
+                'ci_length': np.array([event['ci_length'] for event in batches])}
+
+    def spans(self) -> dict:
+        """Total seconds per span over all the recorded batches."""
+        totals = {}
+        for event in self.batches:
+            for name, seconds in event['spans'].items():
+                totals[name] = totals.get(name, 0.) + seconds
+        return totals
+
+class JsonLinesExporter:
+    """Observer that appends every event as one JSON line, with the wall-clock time and the given labels, to a file.
+    Args:
+        target (str or file):    Path of the file (opened for appending) or an open text file.
+        labels (dict, optional): Fields added to every line, e.g. the name of the book or of the worker. Defaults to None.
+    """
+    def __init__(self,
+                 target: Union[str, object],
+                 labels: dict = None):
+        self.labels = labels or {}
+        self._owned = isinstance(target, str)
+        self._file  = open(target, "a") if self._owned else target
+        self._lock  = threading.Lock()
+
+    def __call__(self, event: dict):
+        line = json.dumps({'time': time(), **self.labels, **event})
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+
+class PrometheusExporter:
+    """Observer that aggregates the events into counters and gauges and renders them in the Prometheus text
+    exposition format, either on demand (render) or on an HTTP endpoint (serve).
+
+    Counters: batches, paths, bytes and seconds per span, and the finished runs; gauges: paths per second, number of
+    paths, estimate (of the first payoff) and length of the confidence interval of the last batch.
+    Args:
+        namespace (str, optional): Prefix of the metric names. Defaults to "hestonmc".
+        labels (dict, optional):   Labels of every metric, e.g. {'engine': "qe"}. Defaults to None.
+    """
+    def __init__(self,
+                 namespace: str  = "hestonmc",
+                 labels:    dict = None):
+        self.namespace = namespace
+        self.labels    = labels or {}
+        self.counters  = {'batches_total': 0, 'paths_total': 0, 'bytes_total': 0, 'runs_total': 0}
+        self.spans     = {}
+        self.gauges    = {}
+        self._lock     = threading.Lock()
+
+    def __call__(self, event: dict):
+        with self._lock:
+            if event['event'] == "done":
+                self.counters['runs_total'] += 1
+                return
+            self.counters['batches_total'] += 1
+            self.counters['paths_total']   += event['paths']
+            self.counters['bytes_total']   += event['bytes']
+            for name, seconds in event['spans'].items():
+                self.spans[name] = self.spans.get(name, 0.) + seconds
+            self.gauges = {'paths_per_second': event['paths_per_second'],
+                           'paths':            event['n'],
+                           'estimate':         float(np.ravel(event['mean'])[0]),
+                           'ci_length':        event['ci_length']}
+
+    def _labels(self, **extra) -> str:
+        labels = {**self.labels, **extra}
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            for name, value in self.counters.items():
+                lines += [f"# TYPE {self.namespace}_{name} counter", f"{self.namespace}_{name}{self._labels()} {value}"]
+            lines.append(f"# TYPE {self.namespace}_span_seconds_total counter")
+            for span, seconds in self.spans.items():
+                lines.append(f"{self.namespace}_span_seconds_total{self._labels(span=span)} {seconds!r}")
+            for name, value in self.gauges.items():
+                lines += [f"# TYPE {self.namespace}_{name} gauge", f"{self.namespace}_{name}{self._labels()} {value!r}"]
+            return "\n".join(lines) + "\n"
+
+    def serve(self,
+              port: int = 9100,
+              host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve render() on http://host:port/metrics from a daemon thread; call shutdown() on the returned server to stop."""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from math import erf, log, sqrt
+
+from hestonmc import HestonParameters, MarketState, mc_price, simulate_heston_andersen_qe, simulate_heston_euler_streaming
+from hestonmc import simulate_heston_andersen_qe_streaming
+from derivatives import barrier_payoff, european_call_payoff, european_put_payoff, evaluate_payoffs, evaluate_payoffs_accumulated
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+# without vol-of-vol the log-price is a Brownian motion with volatility 0.2 and the bridge is exact
+BLACK_PARAMS  = HestonParameters(kappa = 1., gamma = 1e-8, rho = 0., vbar = 0.04, v0 = 0.04)
+
+def _normal_cdf(x):
+    return 0.5*(1. + erf(x/sqrt(2.)))
+
+def _up_and_out_call(S, K, H, sigma, T):
+    # continuously monitored up-and-out call without rates, K < H (Reiner and Rubinstein, 1991)
+    s                   = sigma*sqrt(T)
+    x,  x1              = log(S/K)/s + 0.5*s, log(S/H)/s + 0.5*s
+    y,  y1              = log(H*H/(S*K))/s + 0.5*s, log(H/S)/s + 0.5*s
+    A = S*_normal_cdf(x) - K*_normal_cdf(x - s)
+    B = S*_normal_cdf(x1) - K*_normal_cdf(x1 - s)
+    C = H*_normal_cdf(-y) - K*S/H*_normal_cdf(-y + s)
+    D = H*_normal_cdf(-y1) - K*S/H*_normal_cdf(-y1 + s)
+    return A - B + C - D
+
+@pytest.mark.parametrize("direction, barrier", [("up", 120.), ("down", 85.)])
+@pytest.mark.parametrize("call", [True, False])
+def test_knock_in_plus_knock_out_is_vanilla(direction, barrier, call):
+    vanilla  = european_call_payoff if call else european_put_payoff
+    args     = {'state': STATE, 'heston_params': HESTON_PARAMS, 'T': 1., 'N_T': 20, 'n_simulations': 2_000, 'seed': 5}
+    S        = simulate_heston_andersen_qe(**args)[0]
+    A        = simulate_heston_andersen_qe_streaming(bridge=True, **args)[0]
+
+    for values, streaming in ((evaluate_payoffs, False), (evaluate_payoffs_accumulated, True)):
+        payoffs  = [barrier_payoff(1., 100., barrier, direction, knock, call, streaming=streaming) for knock in ("in", "out")]
+        payoffs += [vanilla(1., 100.)]
+        knock_in, knock_out, plain = values(payoffs, A if streaming else S)
+
+        np.testing.assert_allclose(knock_in + knock_out, plain, rtol=1e-12, atol=1e-12)
+        assert 0. < np.mean(knock_in > 0.) < np.mean(plain > 0.)
+
+def _up_and_out_price(simulate, heston_params, N_T, bridge, absolute_error, T=1.):
+    return mc_price(barrier_payoff(1., 100., 120., "up", "out", streaming=True), simulate, STATE, heston_params, T=T, N_T=N_T,
+                    absolute_error=absolute_error, random_seed=1, counter_rng=True, batch_size=50_000, bridge=bridge)
+
+def test_bridge_monitoring_matches_the_continuous_barrier():
+    grid_errors = []
+    for N_T in (5, 20, 80):
+        # the engines stop at the last grid point, T (N_T - 1) / N_T
+        reference = _up_and_out_call(100., 100., 120., 0.2, (N_T - 1)/N_T)
+        grid_errors.append(_up_and_out_price(simulate_heston_euler_streaming, BLACK_PARAMS, N_T, False, 0.02) - reference)
+
+        assert abs(_up_and_out_price(simulate_heston_euler_streaming, BLACK_PARAMS, N_T, True, 0.02) - reference) <= 0.02
+
+    # monitoring on the grid only overprices the knock-out, less and less as N_T grows
+    assert grid_errors[0] > grid_errors[1] > grid_errors[2] > 0.02
+
+def test_bridge_monitoring_converges_under_stochastic_volatility():
+    # QE/TG bridge the log-price with the trapezoidal variance, an approximation that vanishes as N_T grows;
+    # T is stretched so that every grid ends at the horizon 1
+    price = lambda N_T, bridge: _up_and_out_price(simulate_heston_andersen_qe_streaming, HESTON_PARAMS, N_T, bridge, 0.03, T=N_T/(N_T - 1))
+    fine  = price(80, True)
+    error = {N_T: price(N_T, True) - fine for N_T in (10, 20)}
+
+    assert error[10] > error[20]
+    assert abs(error[20]) <= 0.06 < 0.3 < price(20, False) - fine
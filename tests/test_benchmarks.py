@@ -0,0 +1,46 @@
+import copy
+import pytest
+
+from benchmarks import PARAMETER_SETS, benchmark_suite, compare_to_baseline
+
+@pytest.fixture(scope="module")
+def run():
+    return benchmark_suite(schemes=("euler",), N_Ts=(20,), batch_sizes=(5_000,), threads=(1,), parameter_sets={2: PARAMETER_SETS[1]},
+                           absolute_error=0.2, repeats=1)
+
+def _changed(run, **changes):
+    changed = copy.deepcopy(run)
+    for row in changed['results']:
+        row.update({metric: change(row[metric]) for metric, change in changes.items()})
+    return changed
+
+def test_suite_is_reproducible(run):
+    # the counter-based paths make everything but the timings independent of the run
+    again = benchmark_suite(schemes=("euler",), N_Ts=(20,), batch_sizes=(5_000,), threads=(1,), parameter_sets={2: PARAMETER_SETS[1]},
+                            absolute_error=0.2, repeats=1)
+
+    for row, other in zip(run['results'], again['results']):
+        assert (row['price'], row['paths'], row['bias']) == (other['price'], other['paths'], other['bias'])
+
+def test_same_run_does_not_regress(run):
+    assert compare_to_baseline(run, run) == []
+    assert compare_to_baseline(_changed(run, time_to_tolerance=lambda t: 1.05*t, paths_per_second=lambda p: p/1.05), run) == []
+
+@pytest.mark.parametrize("changes, metrics", [({'time_to_tolerance': lambda t: 2.*t, 'paths_per_second': lambda p: p/2.},
+                                               ['time_to_tolerance', 'paths_per_second']),
+                                              ({'bias': lambda b: b + 0.5 if b >= 0. else b - 0.5}, ['bias']),
+                                              ({'peak_memory_mb': lambda m: 100.}, ['peak_memory_mb'])])
+def test_regressions_are_flagged(run, changes, metrics):
+    baseline = _changed(run, peak_memory_mb=lambda m: 10.)
+    current  = _changed(baseline, **changes)
+
+    regressions = compare_to_baseline(current, baseline)
+    assert [regression['metric'] for regression in regressions] == metrics
+    for regression in regressions:
+        assert regression['current'] == current['results'][0][regression['metric']]
+        assert regression['baseline'] == baseline['results'][0][regression['metric']]
+
+def test_cases_missing_from_the_baseline_are_skipped(run):
+    current = _changed(run, N_T=lambda N_T: 2*N_T, time_to_tolerance=lambda t: 10.*t)
+
+    assert compare_to_baseline(current, run) == []
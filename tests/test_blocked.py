@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, tg_lookup_tables, simulate_heston_andersen_qe, simulate_heston_andersen_tg
+
+STATE         = MarketState(100., 0.02)
+# Psi crosses Psi_c along the paths, so both branches of the QE variance step are taken
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.6, rho = -0.7, vbar = 0.04, v0 = 0.06)
+
+@pytest.mark.parametrize("simulate, tables", [(simulate_heston_andersen_qe, False), (simulate_heston_andersen_tg, True)])
+@pytest.mark.parametrize("block_size", [1, 16, 1_000])
+def test_blocked_kernel_equals_the_path_by_path_kernel(simulate, tables, block_size):
+    # 203 simulations leave a partial last block for the block sizes that do not divide it
+    args            = {'state': STATE, 'heston_params': HESTON_PARAMS, 'T': 1., 'N_T': 30, 'n_simulations': 203, 'seed': 4,
+                       **(tg_lookup_tables() if tables else {})}
+    S_path,  V_path  = simulate(block_size=0, **args)
+    S_block, V_block = simulate(block_size=block_size, **args)
+
+    np.testing.assert_array_equal(S_block, S_path)
+    np.testing.assert_array_equal(V_block, V_path)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, heston_price_cos, mc_price, simulate_heston_euler
+from derivatives import discounted_stock_payoff, european_call_payoff
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1.5, gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+N_T           = 51
+# the engines stop at the last grid point, T (N_T - 1) / N_T
+REFERENCE     = heston_price_cos(STATE, HESTON_PARAMS, np.array([105.]), np.array([(N_T - 1)/N_T]))[0, 0]
+
+def _price(**kwargs):
+    events = []
+    price  = mc_price(european_call_payoff(1., 105.), simulate_heston_euler, STATE, HESTON_PARAMS, T=1., N_T=N_T, absolute_error=0.05,
+                      random_seed=2, counter_rng=True, batch_size=10_000, observer=events.append, **kwargs)
+    done   = events[-1]
+    return price, done['n'], done['ci_length']
+
+def test_control_variates_reduce_the_variance_without_bias():
+    # the means of the controls (None) are computed by control_variate_mean
+    plain  = _price()
+    stock  = _price(control_variate_payoff=discounted_stock_payoff(1.))
+    both   = _price(control_variate_payoff=[discounted_stock_payoff(1.), european_call_payoff(1., 100.)], mu=[None, None])
+
+    assert plain[1] > 2*stock[1] > 2*5*both[1]
+    for price, _, ci_length in (plain, stock, both):
+        assert abs(price - REFERENCE) <= ci_length
+
+def test_one_mean_per_control_variate():
+    with pytest.raises(ValueError, match="one mean per control variate"):
+        _price(control_variate_payoff=[discounted_stock_payoff(1.), european_call_payoff(1., 100.)], mu=[100.])
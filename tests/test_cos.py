@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from math import erf, exp, log, sqrt
+
+from hestonmc import HestonParameters, MarketState, heston_characteristic_function, heston_price_cos
+
+STATE      = MarketState(100., 0.03)
+STRIKES    = np.array([60., 90., 100., 110., 150.])
+MATURITIES = np.array([0.1, 0.5, 1., 3.])
+
+def _black(S, K, T, r, sigma, call):
+    d1   = (log(S/K) + (r + 0.5*sigma**2)*T)/(sigma*sqrt(T))
+    d2   = d1 - sigma*sqrt(T)
+    N    = lambda x: 0.5*(1. + erf(x/sqrt(2.)))
+    price = S*N(d1) - K*exp(-r*T)*N(d2)
+    return price if call else price - S + K*exp(-r*T)
+
+@pytest.mark.parametrize("call", [True, False])
+@pytest.mark.parametrize("gamma", [1e-5, 1e-8])
+def test_cos_converges_to_black_without_vol_of_vol(call, gamma):
+    # with v0 = vbar and no vol-of-vol the variance stays at 0.04: Black with volatility 0.2, up to O(gamma)
+    prices    = heston_price_cos(STATE, HestonParameters(kappa = 1., gamma = gamma, rho = -0.5, vbar = 0.04, v0 = 0.04),
+                                 STRIKES, MATURITIES, call=call)
+    reference = np.array([[_black(100., K, T, 0.03, 0.2, call) for K in STRIKES] for T in MATURITIES])
+
+    assert prices.shape == (len(MATURITIES), len(STRIKES))
+    np.testing.assert_allclose(prices, reference, atol=10.*gamma)
+
+def test_characteristic_function_without_vol_of_vol_is_gaussian():
+    # the model deviates from the Gaussian by O(gamma), so with a tiny gamma only rounding errors are left
+    u = np.array([1e-3, 0.5, 5., 20.])
+
+    np.testing.assert_allclose(heston_characteristic_function(u, 1., HestonParameters(1., 1e-12, -0.5, 0.04, 0.04), 0.03),
+                               np.exp(1j*u*(0.03 - 0.02) - 0.02*u**2), rtol=1e-9)
+
+def test_put_call_parity():
+    heston_params = HestonParameters(kappa = 0.5, gamma = 1., rho = -0.9, vbar = 0.04, v0 = 0.04)
+    calls         = heston_price_cos(STATE, heston_params, STRIKES, MATURITIES)
+    puts          = heston_price_cos(STATE, heston_params, STRIKES, MATURITIES, call=False)
+
+    np.testing.assert_allclose(calls - puts, 100. - STRIKES*np.exp(-0.03*MATURITIES[:, None]), atol=1e-10)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, RunningStats, mc_price, simulate_heston_andersen_qe
+from derivatives import european_call_payoff
+from distributed import mc_price_distributed
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+
+def test_merge_of_chunks_equals_one_shot():
+    sample = np.random.default_rng(0).standard_normal(1_000)*3. + 1.
+    merged = RunningStats()
+    for chunk in np.array_split(sample, [1, 10, 10, 400]):
+        merged.merge(RunningStats.from_batch(chunk) if chunk.size > 0 else RunningStats())
+    one_shot = RunningStats.from_batch(sample)
+
+    assert merged.count == one_shot.count
+    assert merged.mean == pytest.approx(one_shot.mean, rel=1e-12)
+    assert merged.M2 == pytest.approx(one_shot.M2, rel=1e-12)
+
+def test_merge_with_empty_stats():
+    stats = RunningStats.from_batch(np.array([1., 2., 4.]))
+
+    assert RunningStats().merge(stats).mean == stats.mean
+    assert RunningStats(stats.count, stats.mean, stats.M2).merge(RunningStats()).M2 == stats.M2
+
+@pytest.mark.parametrize("backend", ["process", "socket"])
+def test_distributed_equals_single_process(backend):
+    payoff = european_call_payoff(1., 100.)
+    single = mc_price(payoff, simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20, absolute_error=0.1,
+                      batch_size=5_000, random_seed=1, counter_rng=True)
+    spread = mc_price_distributed(payoff, simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20, absolute_error=0.1,
+                                  batch_size=5_000, random_seed=1, n_workers=2, backend=backend)
+
+    assert spread == single
+
+def test_worker_failure_is_raised():
+    with pytest.raises(RuntimeError, match="worker failed"):
+        mc_price_distributed(european_call_payoff(1., 100.), simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20,
+                             absolute_error=0.1, batch_size=5_000, random_seed=1, n_workers=1, unknown_argument=1)
+
+def test_verbose_output_keeps_the_authkey_secret(capsys):
+    authkey = bytes(range(16))
+    mc_price_distributed(european_call_payoff(1., 100.), simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20,
+                         absolute_error=0.5, batch_size=5_000, random_seed=1, n_workers=1, backend="socket", authkey=authkey,
+                         verbose=True)
+    output = capsys.readouterr().out
+
+    assert "Coordinator listening on 127.0.0.1:" in output
+    assert authkey.hex() not in output
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from hestonmc import MarketState, simulate_heston_euler, simulate_heston_andersen_qe
+from benchmarks import PARAMETER_SETS, float32_regression
+
+@pytest.mark.parametrize("heston_params", [PARAMETER_SETS[0], PARAMETER_SETS[2]])
+def test_single_precision_prices_stay_within_tolerance(heston_params):
+    # both precisions run on the same normals, so the differences are rounding only
+    results = float32_regression(parameter_sets=[heston_params], batch_size=5_000, n_batches=2)
+
+    assert len(results) == 27
+    assert [result for result in results if not result['passed']] == []
+
+@pytest.mark.parametrize("simulate", [simulate_heston_euler, simulate_heston_andersen_qe])
+def test_single_precision_paths_follow_the_double_precision_paths(simulate):
+    args        = {'state': MarketState(100., 0.), 'heston_params': PARAMETER_SETS[1], 'T': 1., 'N_T': 50, 'n_simulations': 500, 'seed': 7}
+    S_32, V_32  = simulate(dtype=np.float32, **args)
+    S_64, _     = simulate(dtype=np.float64, **args)
+
+    assert S_32.dtype == V_32.dtype == np.float32
+    np.testing.assert_allclose(S_32, S_64, rtol=1e-4)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, heston_price_cos, mc_price, G_TERMINAL
+from hestonmc import simulate_heston_euler, simulate_heston_euler_streaming, simulate_heston_euler_greeks
+from hestonmc import simulate_heston_andersen_qe_streaming, simulate_heston_andersen_qe_greeks
+from derivatives import ACC_TERMINAL, european_call_payoff, digital_call_payoff
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1.5, gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+N_T           = 51
+# the engines stop at the last grid point, T (N_T - 1) / N_T
+HORIZON       = (N_T - 1) / N_T
+
+def _call(stock_price=100., v0=0.04, strike=100.):
+    return heston_price_cos(MarketState(stock_price, 0.), HESTON_PARAMS._replace(v0=v0), np.array([strike]), np.array([HORIZON]))[0, 0]
+
+def _digital(stock_price=100., v0=0.04):
+    return -(_call(stock_price, v0, 100.5) - _call(stock_price, v0, 99.5))
+
+def _finite_differences(price, h=1., dv=1e-4):
+    return {'delta': (price(100. + h) - price(100. - h)) / (2*h),
+            'gamma': (price(100. + h) - 2*price(100.) + price(100. - h)) / h**2,
+            'vega':  (price(v0=0.04 + dv) - price(v0=0.04 - dv)) / (2*dv)}
+
+@pytest.mark.parametrize("payoff, price", [(european_call_payoff(1., 100.), _call),      # pathwise
+                                           (digital_call_payoff(1., 100.), _digital)])   # likelihood ratio
+def test_greeks_match_finite_differences_of_cos(payoff, price):
+    estimate, greeks = mc_price(payoff, simulate_heston_euler, STATE, HESTON_PARAMS, T=1., N_T=N_T, absolute_error=0.05,
+                                random_seed=3, counter_rng=True, batch_size=20_000, greeks=("delta", "gamma", "vega"))
+    reference = _finite_differences(price)
+
+    for name, (value, ci_length) in greeks.items():
+        assert abs(value - reference[name]) <= ci_length, name
+
+@pytest.mark.parametrize("simulate, greeks_engine", [(simulate_heston_euler_streaming, simulate_heston_euler_greeks),
+                                                     (simulate_heston_andersen_qe_streaming, simulate_heston_andersen_qe_greeks)])
+def test_greeks_engines_follow_the_price_paths(simulate, greeks_engine):
+    args = {'state': STATE, 'heston_params': HESTON_PARAMS, 'T': 1., 'N_T': 20, 'n_simulations': 100, 'seed': 3, 'path_offset': 5}
+
+    assert np.array_equal(greeks_engine(**args)[0][:, G_TERMINAL], simulate(**args)[0][:, ACC_TERMINAL])
@@ -0,0 +1,16 @@
+import pytest
+
+from hestonmc import HestonParameters, MarketState, simulate_heston_andersen_qe
+from lsm import lsm_price
+
+# American puts of Clarke and Parrott (1999): K = 10, T = 0.25, r = 0.1; the Bermudan with 25 dates is a hair below
+HESTON_PARAMS = HestonParameters(kappa = 5., gamma = 0.9, rho = 0.1, vbar = 0.16, v0 = 0.0625)
+
+@pytest.mark.parametrize("stock_price, reference", [(8., 2.0000), (10., 0.5200), (12., 0.0821)])
+def test_bounds_bracket_the_american_put(stock_price, reference):
+    result = lsm_price(simulate_heston_andersen_qe, MarketState(stock_price, 0.1), HESTON_PARAMS, 10., T=0.25, N_T=50,
+                       exercise_dates=25, n_simulations=20_000, n_dual=500, n_inner=50, random_seed=1)
+
+    assert result['price'] <= result['upper'] <= result['price'] + 0.02
+    assert result['price'] == pytest.approx(reference, abs=0.01)
+    assert result['interval'][0] <= reference <= result['interval'][1]
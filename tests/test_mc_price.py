@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from hestonmc import BatchPlanner, HestonParameters, MarketState, RunningStats, mc_price, simulate_heston_andersen_qe
+from derivatives import european_call_payoff
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+
+def test_single_qmc_replication_is_rejected():
+    # one replication has no spread to build the confidence interval from
+    with pytest.raises(ValueError, match="at least 2"):
+        mc_price(european_call_payoff(1., 100.), simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20, qmc_replications=1)
+
+def _batches(**kwargs):
+    events = []
+    price  = mc_price(european_call_payoff(1., 100.), simulate_heston_andersen_qe, STATE, HESTON_PARAMS, N_T=20, absolute_error=0.1,
+                      random_seed=5, counter_rng=True, observer=events.append, **kwargs)
+    return price, [event['n_simulations'] for event in events if event['event'] == "batch"]
+
+def test_fixed_batch_size_is_deterministic():
+    # a fixed batch_size is neither calibrated on the timings nor cut to the target, so reruns take the same batches
+    price, batches = _batches(batch_size=3_000)
+
+    assert batches == [3_000]*len(batches) and len(batches) > 1
+    assert _batches(batch_size=3_000) == (price, batches)
+
+def test_fixed_planner_ignores_the_timings():
+    planner = BatchPlanner(20, 0.1, 3.92, batch_size=3_000)
+    stats   = RunningStats.from_batch(np.random.default_rng(0).normal(7., 10., 12_000))
+    for seconds in (1., 0.01, 100.):
+        planner.record(3_000, 12_000, seconds)
+        assert planner.next(stats) == 3_000
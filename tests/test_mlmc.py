@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, heston_price_cos, simulate_heston_euler, simulate_heston_andersen_qe
+from derivatives import european_call_payoff
+from mlmc import mlmc_price, _level_samples
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1.5, gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+PAYOFF        = european_call_payoff(1., 100.)
+
+def test_mlmc_price_reaches_the_cos_price():
+    reference = heston_price_cos(STATE, HESTON_PARAMS, np.array([100.]), np.array([1.]))[0, 0]
+
+    assert abs(mlmc_price(PAYOFF, simulate_heston_andersen_qe, STATE, HESTON_PARAMS, rmse=0.05, random_seed=1) - reference) <= 0.05
+
+@pytest.mark.parametrize("simulate", [simulate_heston_euler, simulate_heston_andersen_qe])
+def test_coarse_fine_coupling_reduces_the_variance(simulate):
+    def variance(n_steps, level):
+        return _level_samples(PAYOFF, simulate, STATE, HESTON_PARAMS, 1., n_steps, level, 4_000, np.random.default_rng(0), {}).var()
+
+    # P_l - P_{l-1} on shared increments varies far less than P_l, and less and less as the grids refine
+    assert variance(64, 4) < variance(16, 2) < variance(16, 0)
+    assert variance(64, 4) < 0.1 * variance(64, 0)
@@ -0,0 +1,37 @@
+import numpy as np
+import os
+import subprocess
+import sys
+
+from hestonmc import HestonParameters, MarketState, simulate_heston_euler_streaming, simulate_heston_andersen_qe
+
+ARGS = {'T': 1., 'N_T': 10, 'n_simulations': 50, 'seed': 4, 'path_offset': 0}
+
+def test_parameters_are_floats():
+    state, heston_params = MarketState(100, 0), HestonParameters(1, 1, 0, 1, 1)
+
+    assert all(type(field) is float for field in state + heston_params)
+    assert heston_params._replace(v0 = 0.04).v0 == 0.04 and state.stock_price == 100.
+
+def test_kernels_take_the_parameters_in_one_specialization():
+    # the fields are coerced to float, so integer arguments select the compiled float specialization
+    for engine in (simulate_heston_euler_streaming, simulate_heston_andersen_qe):
+        floats       = engine(MarketState(100., 0.), HestonParameters(1., 1., 0., 1., 1.), **ARGS)[0]
+        n_signatures = len(engine.signatures)
+        integers     = engine(MarketState(100, 0), HestonParameters(1, 1, 0, 1, 1), **ARGS)[0]
+
+        assert len(engine.signatures) == n_signatures
+        np.testing.assert_array_equal(integers, floats)
+
+def test_kernels_load_from_the_cache_in_a_new_process(tmp_path):
+    # jitclass arguments were never loaded from the Numba cache; the namedtuples are, so a second process only runs
+    root   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env    = {**os.environ, 'NUMBA_CACHE_DIR': str(tmp_path), 'PYTHONPATH': root}
+    script = ("import hestonmc as hmc\n"
+              "engine = hmc.simulate_heston_euler_streaming\n"
+              "engine(hmc.MarketState(100, 0), hmc.HestonParameters(1, 0.5, -0.5, 0.04, 0.04), T=1., N_T=4, n_simulations=2, seed=1, path_offset=0)\n"
+              "print(sum(engine.stats.cache_hits.values()), sum(engine.stats.cache_misses.values()))")
+    runs   = [subprocess.run([sys.executable, "-c", script], cwd=root, env=env, capture_output=True, text=True, check=True).stdout.split()
+              for _ in range(2)]
+
+    assert runs == [["0", "1"], ["1", "0"]]
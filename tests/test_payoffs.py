@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import derivatives
+from derivatives import ACC_TERMINAL, ACC_AVERAGE, ACC_LOG_AVERAGE, ACC_MIN, ACC_MAX, N_ACC
+
+MATURITY, STRIKE, INTEREST_RATE = 2., 100., 0.03
+
+S = 100.*np.exp(np.cumsum(np.random.default_rng(1).normal(0., 0.05, size=(257, 24)), axis=1))
+
+# the closures the Payoff factories replaced, written out in NumPy
+DT = MATURITY/S.shape[1]
+DF = np.exp(-INTEREST_RATE*MATURITY)
+AM = np.sum(S, axis=1)*DT
+GM = np.exp(np.sum(np.log(S), axis=1)*DT)
+BASELINE = {'european_call': np.maximum(S[:, -1] - STRIKE, 0.)*DF,
+            'european_put':  np.maximum(STRIKE - S[:, -1], 0.)*DF,
+            'asian_call_AM': np.maximum(AM - STRIKE, 0.)*DF,
+            'asian_put_AM':  np.maximum(STRIKE - AM, 0.)*DF,
+            'asian_call_GM': np.maximum(GM - STRIKE, 0.)*DF,
+            'asian_put_GM':  np.maximum(STRIKE - GM, 0.)*DF}
+
+def _accumulators(S):
+    # what a streaming engine accumulates along the same paths
+    A = np.empty((S.shape[0], N_ACC))
+    A[:, ACC_TERMINAL]    = S[:, -1]
+    A[:, ACC_AVERAGE]     = np.mean(S, axis=1)
+    A[:, ACC_LOG_AVERAGE] = np.mean(np.log(S), axis=1)
+    A[:, ACC_MIN]         = np.min(S, axis=1)
+    A[:, ACC_MAX]         = np.max(S, axis=1)
+    return A
+
+@pytest.mark.parametrize("name", BASELINE)
+def test_payoffs_match_the_baseline_closures(name):
+    payoff = getattr(derivatives, f"{name}_payoff")(MATURITY, STRIKE, INTEREST_RATE)
+
+    np.testing.assert_allclose(payoff(S), BASELINE[name], rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize("name", BASELINE)
+def test_streaming_payoffs_match_the_baseline_closures(name):
+    payoff = getattr(derivatives, f"{name}_streaming_payoff")(MATURITY, STRIKE, INTEREST_RATE)
+
+    np.testing.assert_allclose(payoff(_accumulators(S)), BASELINE[name], rtol=1e-12, atol=1e-12)
+
+def test_evaluate_payoffs_stacks_the_single_payoffs():
+    payoffs = [getattr(derivatives, f"{name}_payoff")(MATURITY, STRIKE, INTEREST_RATE) for name in BASELINE]
+
+    np.testing.assert_allclose(derivatives.evaluate_payoffs(payoffs, S), np.stack(list(BASELINE.values())), rtol=1e-12, atol=1e-12)
@@ -0,0 +1,76 @@
+import pytest
+import time
+
+from hestonmc import HestonParameters, MarketState, mc_price, simulate_heston_andersen_qe
+from derivatives import european_call_payoff, european_put_payoff
+from pricecache import PriceCache
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+
+def _run(absolute_error, **kwargs):
+    events = []
+    price, stats, path_offset = mc_price(european_call_payoff(1., 100.), simulate_heston_andersen_qe, STATE, HESTON_PARAMS,
+                                         T=1., N_T=20, absolute_error=absolute_error, random_seed=7, counter_rng=True,
+                                         full_output=True, observer=events.append, **kwargs)
+    batches = [event for event in events if event['event'] == "batch"]
+    return stats, path_offset, batches
+
+def test_refinement_plans_like_a_fresh_run():
+    # the planner must project the remaining batches from the paths of each batch, not from the cached ones
+    fresh, _, fresh_batches = _run(0.1)
+    coarse, path_offset, _  = _run(0.4)
+    refined, _, batches     = _run(0.1, initial_stats=coarse, path_offset=path_offset)
+
+    assert len(batches) <= len(fresh_batches) + 1
+    assert refined.count == pytest.approx(fresh.count, rel=0.25)
+
+def _price(cache, payoff, absolute_error, **kwargs):
+    return cache.price(payoff, simulate_heston_andersen_qe, STATE, HESTON_PARAMS, T=1., N_T=20, absolute_error=absolute_error,
+                       random_seed=7, batch_size=5_000, **kwargs)
+
+def test_hit_refine_and_miss():
+    cache  = PriceCache()
+    payoff = european_call_payoff(1., 100.)
+
+    coarse = _price(cache, payoff, 0.4)
+    assert _price(cache, payoff, 0.5) == coarse
+    refined = _price(cache, payoff, 0.1)
+    _price(cache, european_put_payoff(1., 100.), 0.4)
+
+    assert cache.counters() == {'hits': 1, 'disk_hits': 0, 'refinements': 1, 'misses': 2, 'entries': 2}
+    # with a fixed batch_size the refinement stops where a fresh run does
+    assert refined == _price(PriceCache(), payoff, 0.1)
+
+def test_sqlite_round_trip(tmp_path):
+    path   = str(tmp_path / "prices.sqlite")
+    payoff = european_call_payoff(1., 100.)
+    price  = _price(PriceCache(path=path), payoff, 0.4)
+
+    cache = PriceCache(path=path)
+    assert _price(cache, payoff, 0.4) == price
+    assert cache.counters()['disk_hits'] == 1 and cache.counters()['misses'] == 0
+
+def test_max_age_evicts_entries(tmp_path):
+    path   = str(tmp_path / "prices.sqlite")
+    payoff = european_call_payoff(1., 100.)
+    memory = PriceCache(max_age=0.05)
+    _price(memory, payoff, 0.4)
+    _price(PriceCache(path=path), payoff, 0.4)
+    time.sleep(0.1)
+
+    disk = PriceCache(path=path, max_age=0.05)
+    _price(memory, payoff, 0.4)
+    _price(disk, payoff, 0.4)
+    assert memory.counters()['misses'] == 2 and memory.counters()['hits'] == 0
+    assert disk.counters()['misses'] == 1 and disk.counters()['disk_hits'] == 0
+
+@pytest.mark.parametrize("kwargs", [{'greeks': ("delta",)}, {'qmc_replications': 8},
+                                    {'control_variate_payoff': european_put_payoff(1., 100.), 'mu': 7.}])
+def test_unsupported_estimators_are_rejected(kwargs):
+    with pytest.raises(ValueError, match="plain Monte-Carlo"):
+        _price(PriceCache(), european_call_payoff(1., 100.), 0.4, **kwargs)
+
+def test_payoff_lists_are_rejected():
+    with pytest.raises(TypeError, match="single payoffs"):
+        _price(PriceCache(), [european_call_payoff(1., 100.), european_put_payoff(1., 100.)], 0.4)
@@ -0,0 +1,106 @@
+import asyncio
+import numpy as np
+import pytest
+import time
+
+import pricingservice
+
+from hestonmc import HestonParameters, MarketState
+from derivatives import european_call_streaming_payoff, european_put_streaming_payoff
+from pricingservice import PricingService
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+OTHER_PARAMS  = HestonParameters(kappa = 2., gamma = 0.3, rho = -0.5, vbar = 0.05, v0 = 0.04)
+
+def _serve(clients, **kwargs):
+    async def run():
+        async with PricingService(random_seed=3, **kwargs) as service:
+            return await clients(service), dict(service.counters)
+    return asyncio.run(run())
+
+def test_requests_on_the_same_paths_are_coalesced():
+    async def clients(service):
+        return await asyncio.gather(*[service.price(european_call_streaming_payoff(1., strike), "qe", STATE, HESTON_PARAMS, N_T=20,
+                                                    absolute_error=0.1) for strike in (90., 100., 110.)])
+
+    coalesced, counters = _serve(clients, batch_size=5_000)
+    alone, alone_counters = _serve(clients, batch_size=5_000, coalesce=False)
+
+    assert all(reply['converged'] and reply['shared'] == 3 for reply in coalesced)
+    assert all(reply['shared'] == 1 for reply in alone)
+    assert counters['batches'] < alone_counters['batches']
+    # a request draws the same paths whether or not it shares them
+    assert [reply['price'] for reply in coalesced] == pytest.approx([reply['price'] for reply in alone], abs=0.1)
+
+def test_higher_priorities_are_served_first():
+    finished = []
+
+    async def clients(service):
+        async def client(name, heston_params, priority):
+            reply = await service.price(european_put_streaming_payoff(1., 100.), "euler", STATE, heston_params, N_T=20,
+                                        absolute_error=0.05, priority=priority)
+            finished.append(name)
+            return reply
+        low = asyncio.ensure_future(client("low", HESTON_PARAMS, 0))
+        await asyncio.sleep(0)
+        return await asyncio.gather(low, client("high", OTHER_PARAMS, 1))
+
+    _serve(clients, batch_size=1_000)
+
+    assert finished == ["high", "low"]
+
+def test_deadlines_answer_with_the_paths_so_far():
+    async def clients(service):
+        return await service.price(european_call_streaming_payoff(1., 100.), "qe", STATE, HESTON_PARAMS, N_T=20,
+                                   absolute_error=1e-4, deadline=0.5)
+
+    reply, counters = _serve(clients, batch_size=1_000)
+
+    assert not reply['converged'] and counters['expired'] == 1
+    assert reply['n'] > 0 and np.isfinite(reply['price']) and reply['ci_length'] > 1e-4
+    assert 0.5 <= reply['latency'] < 2.
+
+def test_cancelled_requests_are_withdrawn():
+    async def clients(service):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(service.price(european_call_streaming_payoff(1., 100.), "qe", STATE, HESTON_PARAMS, N_T=20,
+                                                 absolute_error=1e-4), timeout=0.3)
+        batches = service.counters['batches']
+        await asyncio.sleep(0.3)
+        return batches, dict(service._groups)
+
+    (batches, groups), counters = _serve(clients, batch_size=1_000)
+
+    assert not groups
+    # at most the batch in flight when the request was cancelled finishes
+    assert counters['batches'] <= batches + 1
+
+def test_lookup_tables_are_built_off_the_event_loop(monkeypatch):
+    simulate, tables = pricingservice.SERVICE_ENGINES['tg']
+    builds           = []
+
+    def slow_tables():
+        builds.append(1)
+        time.sleep(0.3)
+        return tables()
+
+    monkeypatch.setitem(pricingservice.SERVICE_ENGINES, 'tg', (simulate, slow_tables))
+
+    async def clients(service):
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        task    = asyncio.ensure_future(ticker())
+        replies = await asyncio.gather(*[service.price(european_call_streaming_payoff(1., strike), "tg", STATE, HESTON_PARAMS, N_T=20,
+                                                       absolute_error=0.2) for strike in (95., 105.)])
+        task.cancel()
+        return replies, ticks
+
+    (replies, ticks), _ = _serve(clients, batch_size=5_000)
+
+    assert len(builds) == 1 and ticks >= 10
+    assert all(reply['converged'] and reply['shared'] == 2 for reply in replies)
@@ -0,0 +1,49 @@
+import numpy as np
+import os
+import pytest
+import subprocess
+import sys
+
+from hestonmc import HestonParameters, MarketState, philox4x32
+from hestonmc import simulate_heston_euler, simulate_heston_andersen_qe, simulate_heston_andersen_qe_streaming
+
+ROOT          = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+
+# known-answer vectors of Philox4x32-10 from Random123 (kat_vectors): counter, key, output
+PHILOX_KAT = [((0x00000000, 0x00000000, 0x00000000, 0x00000000), (0x00000000, 0x00000000), (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8)),
+              ((0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff), (0xffffffff, 0xffffffff), (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd)),
+              ((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0), (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))]
+
+@pytest.mark.parametrize("counter, key, expected", PHILOX_KAT)
+def test_philox_known_answers(counter, key, expected):
+    assert tuple(int(word) for word in philox4x32(*counter, *key)) == expected
+
+@pytest.mark.parametrize("simulate", [simulate_heston_euler, simulate_heston_andersen_qe, simulate_heston_andersen_qe_streaming])
+def test_batch_splits_give_the_same_paths(simulate):
+    args  = {'state': STATE, 'heston_params': HESTON_PARAMS, 'T': 1., 'N_T': 20, 'seed': 11}
+    whole = simulate(n_simulations=100, path_offset=50, **args)[0]
+    split = np.vstack([simulate(n_simulations=n, path_offset=50 + offset, **args)[0] for offset, n in ((0, 1), (1, 36), (37, 63))])
+
+    assert np.array_equal(whole, split)
+
+THREADS_SCRIPT = """
+import hashlib
+from numba import set_num_threads
+from hestonmc import HestonParameters, MarketState, simulate_heston_andersen_qe, simulate_heston_andersen_qe_streaming
+
+args = {'state': MarketState(100., 0.), 'heston_params': HestonParameters(1., 0.4, -0.1, 0.04, 0.04), 'T': 1., 'N_T': 20,
+        'n_simulations': 1_000, 'seed': 11, 'path_offset': 123}
+for threads in (1, 4):
+    set_num_threads(threads)
+    print(hashlib.sha256(simulate_heston_andersen_qe(**args)[0].tobytes()).hexdigest(),
+          hashlib.sha256(simulate_heston_andersen_qe_streaming(**args)[0].tobytes()).hexdigest())
+"""
+
+def test_paths_do_not_depend_on_the_number_of_threads():
+    env    = {**os.environ, 'NUMBA_NUM_THREADS': "4", 'PYTHONPATH': ROOT}
+    result = subprocess.run([sys.executable, "-c", THREADS_SCRIPT], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    one, four = result.stdout.split("\n")[:2]
+
+    assert one == four
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters, MarketState, tg_lookup_tables, stack_scenarios, mc_price, mc_price_scenarios
+from hestonmc import simulate_heston_euler_streaming, simulate_heston_andersen_qe_streaming, simulate_heston_andersen_tg_streaming
+from hestonmc import simulate_heston_euler_scenarios, simulate_heston_andersen_qe_scenarios, simulate_heston_andersen_tg_scenarios
+from derivatives import european_call_streaming_payoff
+
+STATES        = [MarketState(90., 0.01), MarketState(100., 0.02), MarketState(110., 0.03)]
+HESTON_PARAMS = [HestonParameters(kappa = 1., gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04),
+                 HestonParameters(kappa = 2., gamma = 0.6, rho = -0.7, vbar = 0.06, v0 = 0.03),
+                 HestonParameters(kappa = 0.5, gamma = 0.3, rho = -0.2, vbar = 0.03, v0 = 0.05)]
+MATURITIES    = np.array([0.5, 1., 2.])
+
+@pytest.mark.parametrize("bridge", [False, True])
+@pytest.mark.parametrize("scenarios, streaming, tables", [(simulate_heston_euler_scenarios, simulate_heston_euler_streaming, False),
+                                                          (simulate_heston_andersen_qe_scenarios, simulate_heston_andersen_qe_streaming, False),
+                                                          (simulate_heston_andersen_tg_scenarios, simulate_heston_andersen_tg_streaming, True)])
+def test_scenario_engines_equal_per_scenario_runs(scenarios, streaming, tables, bridge):
+    args = {'N_T': 20, 'n_simulations': 100, 'seed': 5, 'path_offset': 7, 'bridge': bridge, **(tg_lookup_tables() if tables else {})}
+    A    = scenarios(stack_scenarios(STATES, HESTON_PARAMS, MATURITIES), **args)
+
+    assert A.shape[0] == len(STATES)
+    for c, (state, heston_params, T) in enumerate(zip(STATES, HESTON_PARAMS, MATURITIES)):
+        np.testing.assert_array_equal(A[c], streaming(state, heston_params, T=T, **args)[0])
+
+def test_scenario_prices_equal_per_scenario_prices():
+    # every scenario stops at the same batch as its own mc_price run, so even the estimates agree to the last digit
+    payoffs   = [european_call_streaming_payoff(T, 100., state.interest_rate) for state, T in zip(STATES, MATURITIES)]
+    args      = {'N_T': 20, 'absolute_error': 0.2, 'batch_size': 2_000, 'random_seed': 3, 'counter_rng': True}
+    prices, ci_lengths = mc_price_scenarios(payoffs, simulate_heston_andersen_qe_scenarios, STATES, HESTON_PARAMS, MATURITIES, **args)
+
+    for c, (state, heston_params, T) in enumerate(zip(STATES, HESTON_PARAMS, MATURITIES)):
+        events = []
+        price  = mc_price(payoffs[c], simulate_heston_andersen_qe_streaming, state, heston_params, T=T, observer=events.append, **args)
+        assert prices[c] == pytest.approx(price, rel=1e-12)
+        assert ci_lengths[c] == pytest.approx(events[-1]['ci_length'], rel=1e-12)
+
+def test_stack_scenarios_broadcasts_single_values():
+    scenarios = stack_scenarios(STATES[0], HESTON_PARAMS, 1.)
+
+    assert scenarios.shape[0] == len(HESTON_PARAMS)
+    with pytest.raises(ValueError):
+        stack_scenarios(STATES[:2], HESTON_PARAMS, 1.)
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import derivatives
+from hestonmc import HestonParameters, MarketState, tg_lookup_tables, _standard_normal_tensor
+from hestonmc import simulate_heston_euler, simulate_heston_andersen_qe, simulate_heston_andersen_tg
+from hestonmc import simulate_heston_euler_streaming, simulate_heston_andersen_qe_streaming, simulate_heston_andersen_tg_streaming
+from derivatives import ACC_TERMINAL, ACC_AVERAGE, ACC_LOG_AVERAGE, ACC_MIN, ACC_MAX
+
+STATE         = MarketState(100., 0.02)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+PAYOFFS       = ("european_call", "european_put", "asian_call_AM", "asian_put_AM", "asian_call_GM", "asian_put_GM")
+
+@pytest.mark.parametrize("full, streaming, tables", [(simulate_heston_euler, simulate_heston_euler_streaming, False),
+                                                     (simulate_heston_andersen_qe, simulate_heston_andersen_qe_streaming, False),
+                                                     (simulate_heston_andersen_tg, simulate_heston_andersen_tg_streaming, True)])
+def test_streaming_engines_fold_the_full_paths(full, streaming, tables):
+    args = {'state': STATE, 'heston_params': HESTON_PARAMS, 'T': 1., 'N_T': 30, 'n_simulations': 200, **(tg_lookup_tables() if tables else {})}
+    # the streaming engine draws the normals of the counter-based stream step by step, the full-path one takes them at once
+    S    = full(normals=_standard_normal_tensor(9, 3, 200, 30), **args)[0]
+    A    = streaming(seed=9, path_offset=3, **args)[0]
+
+    for column, folded in ((ACC_TERMINAL, S[:, -1]), (ACC_AVERAGE, S.mean(axis=1)), (ACC_LOG_AVERAGE, np.log(S).mean(axis=1)),
+                           (ACC_MIN, S.min(axis=1)), (ACC_MAX, S.max(axis=1))):
+        np.testing.assert_allclose(A[:, column], folded, rtol=1e-12)
+    for name in PAYOFFS:
+        np.testing.assert_allclose(getattr(derivatives, f"{name}_streaming_payoff")(1., 100., 0.02)(A),
+                                   getattr(derivatives, f"{name}_payoff")(1., 100., 0.02)(S), rtol=1e-10, atol=1e-10)
@@ -0,0 +1,23 @@
+import numpy as np
+
+from hestonmc import HestonParameters, MarketState, heston_price_cos, mc_price_surface, simulate_heston_andersen_qe_streaming
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.1, vbar = 0.04, v0 = 0.04)
+
+def test_colliding_maturities_share_a_column():
+    # 0.5 and 0.502 round to the same grid step, so both must get the price observed there
+    maturities = [0.5, 0.502, 1.0]
+    prices     = mc_price_surface(simulate_heston_andersen_qe_streaming, STATE, HESTON_PARAMS, [100.], maturities, N_T=100,
+                                  absolute_error=0.1, random_seed=1, counter_rng=True)
+    reference  = heston_price_cos(STATE, HESTON_PARAMS, [100.], maturities)
+
+    assert prices[0, 0] == prices[1, 0]
+    np.testing.assert_allclose(prices, reference, atol=0.1)
+
+def test_equal_maturities():
+    prices = mc_price_surface(simulate_heston_andersen_qe_streaming, STATE, HESTON_PARAMS, [90., 110.], [1., 1.], N_T=50,
+                              absolute_error=0.2, random_seed=1, counter_rng=True)
+
+    np.testing.assert_array_equal(prices[0], prices[1])
+    assert np.all(prices > 0)
@@ -0,0 +1,94 @@
+import io
+import json
+import pytest
+import re
+import urllib.error
+import urllib.request
+
+from hestonmc import HestonParameters, MarketState, mc_price, simulate_heston_euler
+from derivatives import european_call_payoff
+from telemetry import JsonLinesExporter, PrometheusExporter, TelemetryRecorder, broadcast
+
+STATE         = MarketState(100., 0.)
+HESTON_PARAMS = HestonParameters(kappa = 1., gamma = 0.4, rho = -0.5, vbar = 0.04, v0 = 0.04)
+
+# the schema documented at the top of telemetry.py
+BATCH_FIELDS  = {'event', 'method', 'iteration', 'n_simulations', 'paths', 'seconds', 'spans', 'compiled', 'paths_per_second', 'bytes',
+                 'n', 'mean', 'ci_length', 'absolute_error', 'elapsed'}
+DONE_FIELDS   = {'event', 'iterations', 'n', 'mean', 'ci_length', 'absolute_error', 'converged', 'seconds'}
+SPANS         = {'compile', 'simulate', 'rng', 'payoff', 'update'}
+# a sample of the text exposition format: name, optional labels and a float
+SAMPLE        = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_][a-zA-Z0-9_]*="[^"]*"(,[a-zA-Z_][a-zA-Z0-9_]*="[^"]*")*\})? (\S+)$')
+
+def _run(*observers):
+    return mc_price(european_call_payoff(1., 100.), simulate_heston_euler, STATE, HESTON_PARAMS, N_T=20, absolute_error=0.2,
+                    random_seed=1, counter_rng=True, batch_size=2_000, observer=broadcast(*observers))
+
+def test_events_follow_the_schema():
+    recorder = TelemetryRecorder()
+    price    = _run(recorder)
+    batches, done = recorder.batches, recorder.events[-1]
+
+    assert len(batches) > 1 and len(recorder.events) == len(batches) + 1
+    for iteration, event in enumerate(batches, 1):
+        assert set(event) == BATCH_FIELDS and event['event'] == "batch"
+        assert event['iteration'] == iteration and event['paths'] == 4*event['n_simulations']
+        assert set(event['spans']) <= SPANS and sum(event['spans'].values()) <= event['seconds']
+    assert [event['n'] for event in batches] == [2_000*4*k for k in range(1, len(batches) + 1)]
+
+    assert set(done) == DONE_FIELDS and done['event'] == "done"
+    assert (done['iterations'], done['n'], done['mean'], done['ci_length']) == (len(batches), batches[-1]['n'], price, batches[-1]['ci_length'])
+    assert done['converged'] and done['ci_length'] <= done['absolute_error'] == 0.2
+
+    trace = recorder.convergence()
+    assert trace['n'].tolist() == [event['n'] for event in batches] and trace['mean'][-1] == price
+
+def test_json_lines_carry_the_labels():
+    output = io.StringIO()
+    _run(JsonLinesExporter(output, labels={'book': "test"}))
+    lines  = [json.loads(line) for line in output.getvalue().splitlines()]
+
+    assert [line['event'] for line in lines[-2:]] == ["batch", "done"]
+    assert all(line['book'] == "test" and 'time' in line for line in lines)
+
+def test_prometheus_render_format():
+    recorder, exporter = TelemetryRecorder(), PrometheusExporter(labels={'engine': "euler"})
+    _run(recorder, exporter)
+    text = exporter.render()
+
+    assert text.endswith("\n")
+    types, samples = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            assert kind in ("counter", "gauge") and name not in types
+            types[name] = kind
+            continue
+        match = SAMPLE.match(line)
+        assert match is not None, line
+        # every sample comes after the TYPE line of its metric and carries the exporter's labels
+        assert match.group(1) in types and 'engine="euler"' in match.group(2)
+        samples[match.group(1) + match.group(2)] = float(match.group(4))
+
+    assert all(kind == "counter" for name, kind in types.items() if name.endswith("_total"))
+    batches = recorder.batches
+    assert samples['hestonmc_batches_total{engine="euler"}'] == len(batches)
+    assert samples['hestonmc_paths_total{engine="euler"}'] == sum(event['paths'] for event in batches)
+    assert samples['hestonmc_runs_total{engine="euler"}'] == 1
+    assert samples['hestonmc_estimate{engine="euler"}'] == batches[-1]['mean']
+    for span, seconds in recorder.spans().items():
+        assert samples[f'hestonmc_span_seconds_total{{engine="euler",span="{span}"}}'] == pytest.approx(seconds)
+
+def test_prometheus_endpoint():
+    exporter = PrometheusExporter(namespace="test")
+    exporter({'event': "done"})
+    server   = exporter.serve(port=0)
+    url      = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(url + "/metrics") as response:
+            assert response.headers['Content-Type'].startswith("text/plain")
+            assert response.read().decode() == exporter.render()
+        with pytest.raises(urllib.error.HTTPError, match="404"):
+            urllib.request.urlopen(url + "/other")
+    finally:
+        server.shutdown()
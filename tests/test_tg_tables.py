@@ -0,0 +1,33 @@
+import numpy as np
+import os
+import subprocess
+import sys
+
+from hestonmc import tg_lookup_tables
+
+def test_cache_round_trip(tmp_path):
+    computed = tg_lookup_tables(psi_max=50., n_points=257, cache_dir=None)
+    written  = tg_lookup_tables(psi_max=50., n_points=257, cache_dir=str(tmp_path))
+    loaded   = tg_lookup_tables(psi_max=50., n_points=257, cache_dir=str(tmp_path))
+
+    # only the finished table is left behind, and the second call maps it instead of solving again
+    assert os.listdir(tmp_path) == ["tg_table start=0 stop=50 N=257.npy"]
+    assert isinstance(loaded['x_grid'].base, np.memmap)
+    for name in ("x_grid", "f_nu_grid", "f_sigma_grid"):
+        np.testing.assert_array_equal(written[name], computed[name])
+        np.testing.assert_array_equal(loaded[name], computed[name])
+
+def test_tables_are_keyed_by_their_grid(tmp_path):
+    tg_lookup_tables(psi_max=50., n_points=257, cache_dir=str(tmp_path))
+    other = tg_lookup_tables(psi_max=20., n_points=129, cache_dir=str(tmp_path))
+
+    assert sorted(os.listdir(tmp_path)) == ["tg_table start=0 stop=20 N=129.npy", "tg_table start=0 stop=50 N=257.npy"]
+    assert other['x_grid'].shape == (129,) and other['x_grid'][-1] == 20.
+
+def test_cache_directory_follows_the_environment(tmp_path):
+    root   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env    = {**os.environ, 'HESTONMC_CACHE_DIR': str(tmp_path), 'PYTHONPATH': root}
+    result = subprocess.run([sys.executable, "-c", "import hestonmc; print(hestonmc.TG_CACHE_DIR)"], cwd=root, env=env,
+                            capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == str(tmp_path)
@@ -0,0 +1,116 @@
+import numpy as np
+
+import os
+from time import perf_counter
+
+def _compile_events(dispatcher) -> int:
+    stats = getattr(dispatcher, 'stats', None)
+    return 0 if stats is None else sum(stats.cache_misses.values())
+
+def _timed(name: str, dispatcher, call, report: dict) -> None:
+    # the first call compiles (or loads from the cache) and runs, the second one only runs
+    misses = _compile_events(dispatcher)
+    start  = perf_counter()
+    call()
+    first  = perf_counter() - start
+    start  = perf_counter()
+    call()
+    run    = perf_counter() - start
+
+    if name in report:
+        source = report[name]['source']
+    else:
+        source = "compiled" if _compile_events(dispatcher) > misses else "cache"
+    report[name] = {'compile': report.get(name, {}).get('compile', 0.) + max(first - run, 0.), 'run': run, 'source': source}
+
+def warmup(dtypes:      tuple = (np.float64,),
+           counter_rng: tuple = (False, True),
+           tg:          bool  = True,
+           verbose:     bool  = False) -> dict:
+    """Compile, or load from the Numba cache, every engine and payoff kernel for the argument types mc_price,
+    mc_price_surface, mc_price_scenarios and the Greeks use, so that the first request of a worker only runs.
+
+    Numba compiles one specialization per argument types, and an omitted optional argument is a type of its own,
+    so the engines are called the way mc_price calls them: with and without the counter-based seed and path_offset
+    (counter_rng), and in the given floating-point types.
+    Args:
+        dtypes (tuple, optional):      Path precisions of the full-path engines. Defaults to (np.float64,).
+        counter_rng (tuple, optional): Warm the global-generator (False) and/or the counter-based (True) variants.
+                                       Defaults to (False, True).
+        tg (bool, optional):           Warm the Truncated Gaussian engines too; this loads the lookup tables. Defaults to True.
+        verbose (bool, optional):      Verbose flag. If true, the compile and run times are printed. Defaults to False.
+    Returns:
+        A dict {kernel: {'compile': seconds, 'run': seconds, 'source': "compiled" or "cache"}}, where compile is the
+        time of the first call minus the time of a second one, summed over the warmed specializations.
+    """
+    start = perf_counter()
+    import hestonmc as hmc
+    import derivatives as drv
+    report = {'import': {'compile': 0., 'run': perf_counter() - start, 'source': "-"}}
+
+    state         = hmc.MarketState(100., 0.)
+    heston_params = hmc.HestonParameters(1., 0.5, -0.5, 0.04, 0.04)
+    T, N_T, n     = 1., 4, 2
+    tables        = hmc.tg_lookup_tables() if tg else None
+    schemes       = [(hmc.simulate_heston_euler,       hmc.simulate_heston_euler_streaming,       hmc.simulate_heston_euler_scenarios,       {}),
+                     (hmc.simulate_heston_andersen_qe, hmc.simulate_heston_andersen_qe_streaming, hmc.simulate_heston_andersen_qe_scenarios, {})]
+    if tg:
+        schemes.append((hmc.simulate_heston_andersen_tg, hmc.simulate_heston_andersen_tg_streaming, hmc.simulate_heston_andersen_tg_scenarios, tables))
+
+    scenarios = hmc.stack_scenarios(state, heston_params, T)
+    payoffs   = [drv.european_call_payoff(T, 100.), drv.asian_call_GM_payoff(T, 100.)]
+    streaming = [drv.european_call_streaming_payoff(T, 100.)]
+
+    for counter in counter_rng:
+        rng = {'seed': 1, 'path_offset': 0} if counter else {}
+        for dense, stream, batched, kwargs in schemes:
+            for dtype in dtypes:
+                args = {'dtype': dtype} if dtype is not np.float64 else {}
+                S    = None
+                def call():
+                    nonlocal S
+                    S = dense(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = n, **kwargs, **rng, **args)[0]
+                _timed(dense.__name__, dense, call, report)
+                for payoff in payoffs:
+                    _timed("payoffs", drv._evaluate_payoffs, lambda: payoff(S), report)
+
+            A = None
+            def call():
+                nonlocal A
+                A = stream(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = n, **kwargs, **rng)[0]
+            _timed(stream.__name__, stream, call, report)
+            _timed("payoffs_accumulated", drv._evaluate_payoffs_accumulated, lambda: streaming[0](A), report)
+
+            def call():
+                nonlocal A
+                A = batched(scenarios, **kwargs, N_T = N_T, n_simulations = n, **rng)
+            _timed(batched.__name__, batched, call, report)
+            _timed("payoffs_scenarios", drv._evaluate_payoffs_scenarios, lambda: drv.evaluate_payoffs_scenarios(streaming, A), report)
+
+        for engine in set(hmc.GREEK_ENGINES.values()):
+            _timed(engine.__name__, engine, lambda: engine(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = n, **rng), report)
+
+    G = hmc.simulate_heston_euler_greeks(state, heston_params, T, N_T, n)[0]
+    _timed("terminal", drv._evaluate_terminal, lambda: drv.evaluate_terminal(payoffs[0], G[:, hmc.G_TERMINAL]), report)
+
+    if verbose:
+        print(f"{'kernel':<42} {'source':>9} {'compile, s':>11} {'run, ms':>9}")
+        for name, times in report.items():
+            print(f"{name:<42} {times['source']:>9} {times['compile']:>11.3f} {times['run']*1e3:>9.3f}")
+        print(f"{'total':<42} {'':>9} {sum(t['compile'] for t in report.values()):>11.3f} {sum(t['run'] for t in report.values())*1e3:>9.3f}\n")
+
+    return report
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prime the Numba cache of the engines and the payoff kernels, e.g. when a worker image is built.")
+    parser.add_argument("--cache-dir", default=None, help="Numba cache directory (NUMBA_CACHE_DIR); the workers must use the same one.")
+    parser.add_argument("--float32", action="store_true", help="Warm the single-precision engines too.")
+    cli = parser.parse_args()
+
+    # the cache directory is read when the engines are defined, i.e. before hestonmc is imported
+    if cli.cache_dir is not None:
+        os.environ['NUMBA_CACHE_DIR'] = os.path.abspath(cli.cache_dir)
+
+    warmup(dtypes = (np.float64, np.float32) if cli.float32 else (np.float64,), verbose = True)